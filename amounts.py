@@ -0,0 +1,62 @@
+# amounts.py
+import re
+from decimal import Decimal, InvalidOperation
+
+
+def parse_eur_amount(s: str) -> Decimal | None:
+    """
+    Parses amounts like '34,00 EUR', '34.00', 'EUR 34,00' into Decimal(34.00).
+    Returns None if not parseable.
+    """
+    if not s:
+        return None
+    s = str(s).strip()
+
+    m = re.search(r'(\d{1,3}(?:[.\s]\d{3})*(?:[.,]\d{1,2})?|\d+(?:[.,]\d{1,2})?)', s)
+    if not m:
+        return None
+
+    num = m.group(1).replace(" ", "")
+
+    # normalize thousand/decimal separators
+    if "," in num and "." in num:
+        if num.rfind(",") > num.rfind("."):
+            num = num.replace(".", "").replace(",", ".")
+        else:
+            num = num.replace(",", "")
+    else:
+        if "," in num:
+            num = num.replace(".", "").replace(",", ".")
+
+    # if user wrote "5" (no decimals), treat as "5.00"
+    if re.fullmatch(r"\d+", num):
+        num = num + ".00"
+    elif re.fullmatch(r"\d+\.\d", num):
+        num = num + "0"
+
+    try:
+        return Decimal(num).quantize(Decimal("0.01"))
+    except InvalidOperation:
+        return None
+
+
+def format_eur(d: Decimal) -> str:
+    return f"{d:.2f}".replace(".", ",") + " EUR"
+
+
+_PLAIN_AMOUNT = re.compile(r"\d+(?:[.,]\d{1,2})?")
+_GROUPED_AMOUNT = re.compile(r"\d{1,3}(?:\.\d{3})+(?:,\d{1,2})?")
+
+
+def parse_strict_amount(s: str) -> Decimal | None:
+    """
+    Strenger Parser für Eingaben wie Filter-Parameter: Dezimalzahl mit Punkt oder Komma
+    ('1000', '1000.5', '1000,50') oder deutsch mit Tausenderpunkt ('1.000', '1.000,50').
+    Ein Punkt vor genau drei Ziffern ist immer Tausendertrenner. Alles andere -> None.
+    """
+    s = re.sub(r"\s*(EUR|€)$", "", str(s or "").strip(), flags=re.I)
+    if _GROUPED_AMOUNT.fullmatch(s):
+        s = s.replace(".", "")
+    elif not _PLAIN_AMOUNT.fullmatch(s):
+        return None
+    return Decimal(s.replace(",", ".")).quantize(Decimal("0.01"))
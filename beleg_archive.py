@@ -0,0 +1,399 @@
+# beleg_archive.py
+"""
+Archiv für fertige Bewirtungsbelege.
+
+- PDFs liegen content-addressed im Blob-Store: <ARCHIVE_DIR>/blobs/ab/<sha256>.pdf
+  (gleicher Inhalt = eine Datei, Schreiben atomar über Temp-Datei + rename)
+- Metadaten (Tenant, Datum, Restaurant, Beträge, Teilnehmer) stehen in SQLite
+  und sind nach Tenant/Datum bzw. Tenant/Betrag indiziert
+- Monats-Export als ZIP (PDFs + DATEV-artige CSV), gestreamt in kleinen Chunks
+"""
+import os
+import csv
+import io
+import json
+import uuid
+import sqlite3
+import hashlib
+import zipfile
+import tempfile
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from pathlib import Path
+from typing import Iterator
+
+from amounts import parse_eur_amount
+from metrics import Counter
+
+# -----------------------------
+# Konfiguration (ENV)
+# -----------------------------
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "on").strip().lower() not in ("0", "off", "false", "no")
+ARCHIVE_DIR = Path(os.getenv("ARCHIVE_DIR", "archive"))
+ARCHIVE_CHUNK_BYTES = int(os.getenv("ARCHIVE_CHUNK_BYTES", str(64 * 1024)))
+
+ARCHIVE_WRITES = Counter("archive_belege_total", "Belege written to the archive", ["result"])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS belege (
+    beleg_id         TEXT PRIMARY KEY,
+    tenant           TEXT NOT NULL,
+    created_at       TEXT NOT NULL,
+    bewirtungsdatum  TEXT,              -- ISO YYYY-MM-DD, NULL wenn nicht lesbar
+    restaurant       TEXT,
+    betrag           TEXT,
+    betrag_cents     INTEGER,
+    trinkgeld        TEXT,
+    trinkgeld_cents  INTEGER,
+    betrag_quelle    TEXT,
+    personen         TEXT,              -- JSON-Liste
+    filename         TEXT NOT NULL,
+    sha256           TEXT NOT NULL,
+    size             INTEGER NOT NULL,
+    request_id       TEXT,
+    betrag_rechnung        TEXT,      -- Rechnungsbetrag ohne Trinkgeld
+    betrag_rechnung_cents  INTEGER
+);
+CREATE INDEX IF NOT EXISTS belege_tenant_datum ON belege (tenant, bewirtungsdatum);
+CREATE INDEX IF NOT EXISTS belege_tenant_betrag ON belege (tenant, betrag_cents);
+CREATE INDEX IF NOT EXISTS belege_sha256 ON belege (sha256);
+"""
+
+# nachträglich ergänzte Spalten (bestehende Archive werden beim Start erweitert)
+_ADDED_COLUMNS = {
+    "betrag_rechnung": "TEXT",
+    "betrag_rechnung_cents": "INTEGER",
+}
+
+_init_lock = threading.Lock()
+_initialized: set[Path] = set()
+
+
+@dataclass
+class ArchivedBeleg:
+    beleg_id: str
+    tenant: str
+    created_at: str
+    bewirtungsdatum: str | None
+    restaurant: str | None
+    betrag: str | None
+    betrag_cents: int | None
+    trinkgeld: str | None
+    trinkgeld_cents: int | None
+    betrag_quelle: str | None
+    personen: list[str]
+    filename: str
+    sha256: str
+    size: int
+    request_id: str | None = None
+    betrag_rechnung: str | None = None
+    betrag_rechnung_cents: int | None = None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+# -----------------------------
+# SQLite
+# -----------------------------
+def _db_path() -> Path:
+    return ARCHIVE_DIR / "index.sqlite3"
+
+
+@contextmanager
+def _connect():
+    path = _db_path()
+    with _init_lock:
+        if path not in _initialized:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(path)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_SCHEMA)
+                existing = {row[1] for row in conn.execute("PRAGMA table_info(belege)")}
+                for column, kind in _ADDED_COLUMNS.items():
+                    if column not in existing:
+                        conn.execute(f"ALTER TABLE belege ADD COLUMN {column} {kind}")
+                conn.commit()
+            finally:
+                conn.close()
+            _initialized.add(path)
+
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _row_to_beleg(row: sqlite3.Row) -> ArchivedBeleg:
+    data = dict(row)
+    data["personen"] = json.loads(data["personen"] or "[]")
+    return ArchivedBeleg(**data)
+
+
+# -----------------------------
+# Normalisierung der Metadaten
+# -----------------------------
+def iso_date(value) -> str | None:
+    """'TT.MM.JJJJ' (LLM-Schema) oder ISO -> 'YYYY-MM-DD'."""
+    value = str(value or "").strip()
+    for fmt in ("%d.%m.%Y", "%Y-%m-%d", "%d.%m.%y"):
+        try:
+            return datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def to_cents(value) -> int | None:
+    amount = parse_eur_amount(value)
+    return int(amount * 100) if amount is not None else None
+
+
+def _personen(value) -> list[str]:
+    if isinstance(value, (list, tuple)):
+        return [str(p).strip() for p in value if str(p).strip()]
+    return [p.strip() for p in str(value or "").split(",") if p.strip()]
+
+
+# -----------------------------
+# Blob-Store
+# -----------------------------
+def blob_path(sha256: str) -> Path:
+    return ARCHIVE_DIR / "blobs" / sha256[:2] / f"{sha256}.pdf"
+
+
+def _store_blob(pdf_path: str) -> tuple[str, int]:
+    """Kopiert die PDF in den Blob-Store (gehasht beim Kopieren). Returns (sha256, size)."""
+    tmp_dir = ARCHIVE_DIR / "blobs" / "tmp"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp = tempfile.mkstemp(dir=tmp_dir, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out, open(pdf_path, "rb") as src:
+            while chunk := src.read(ARCHIVE_CHUNK_BYTES):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        sha = digest.hexdigest()
+        target = blob_path(sha)
+        if target.exists():
+            os.unlink(tmp)
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp, target)
+        return sha, size
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+# -----------------------------
+# Public API
+# -----------------------------
+def archive_beleg(pdf_path: str, bew_data: dict, tenant_key: str, filename: str, request_id: str | None = None) -> ArchivedBeleg:
+    """Legt die fertige PDF samt Metadaten ab und gibt den Archiv-Eintrag zurück."""
+    try:
+        sha, size = _store_blob(pdf_path)
+        beleg = ArchivedBeleg(
+            beleg_id=uuid.uuid4().hex,
+            tenant=(tenant_key or "default").strip().lower(),
+            created_at=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            bewirtungsdatum=iso_date(bew_data.get("bewirtungsdatum")),
+            restaurant=bew_data.get("restaurant") or None,
+            betrag=bew_data.get("betrag") or None,
+            betrag_cents=to_cents(bew_data.get("betrag")),
+            trinkgeld=bew_data.get("trinkgeld") or None,
+            trinkgeld_cents=to_cents(bew_data.get("trinkgeld")),
+            betrag_quelle=bew_data.get("betrag_quelle") or None,
+            personen=_personen(bew_data.get("personen")),
+            filename=filename,
+            sha256=sha,
+            size=size,
+            request_id=request_id,
+            betrag_rechnung=bew_data.get("betrag_rechnung") or None,
+            betrag_rechnung_cents=to_cents(bew_data.get("betrag_rechnung")),
+        )
+        row = beleg.to_dict()
+        row["personen"] = json.dumps(beleg.personen, ensure_ascii=False)
+        with _connect() as conn:
+            conn.execute(
+                f"INSERT INTO belege ({', '.join(row)}) VALUES ({', '.join('?' for _ in row)})",
+                tuple(row.values()),
+            )
+    except Exception:
+        ARCHIVE_WRITES.inc(result="error")
+        raise
+    ARCHIVE_WRITES.inc(result="ok")
+    return beleg
+
+
+def get_beleg(beleg_id: str) -> ArchivedBeleg | None:
+    with _connect() as conn:
+        row = conn.execute("SELECT * FROM belege WHERE beleg_id = ?", (beleg_id,)).fetchone()
+    return _row_to_beleg(row) if row else None
+
+
+def _where(
+    tenant_key: str,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    min_betrag: Decimal | None = None,
+    max_betrag: Decimal | None = None,
+) -> tuple[str, list]:
+    clauses, params = ["tenant = ?"], [(tenant_key or "default").strip().lower()]
+    if date_from:
+        clauses.append("bewirtungsdatum >= ?")
+        params.append(date_from.isoformat())
+    if date_to:
+        clauses.append("bewirtungsdatum <= ?")
+        params.append(date_to.isoformat())
+    if min_betrag is not None:
+        clauses.append("betrag_cents >= ?")
+        params.append(int(min_betrag * 100))
+    if max_betrag is not None:
+        clauses.append("betrag_cents <= ?")
+        params.append(int(max_betrag * 100))
+    return " AND ".join(clauses), params
+
+
+def query_belege(
+    tenant_key: str,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    min_betrag: Decimal | None = None,
+    max_betrag: Decimal | None = None,
+    limit: int = 100,
+    offset: int = 0,
+) -> list[ArchivedBeleg]:
+    where, params = _where(tenant_key, date_from, date_to, min_betrag, max_betrag)
+    with _connect() as conn:
+        rows = conn.execute(
+            f"SELECT * FROM belege WHERE {where} ORDER BY bewirtungsdatum, created_at LIMIT ? OFFSET ?",
+            (*params, limit, offset),
+        ).fetchall()
+    return [_row_to_beleg(r) for r in rows]
+
+
+def iter_belege(tenant_key: str, date_from: date, date_to: date) -> Iterator[ArchivedBeleg]:
+    """
+    Alle Belege des Zeitraums, ohne limit. Die Zeilen (nur Metadaten) werden vor dem
+    ersten yield gelesen und die Verbindung geschlossen: StreamingResponse holt die
+    Chunks eines sync-Generators über wechselnde Threads, eine SQLite-Verbindung
+    darf aber nur in ihrem Thread benutzt werden.
+    """
+    where, params = _where(tenant_key, date_from, date_to)
+    with _connect() as conn:
+        rows = conn.execute(
+            f"SELECT * FROM belege WHERE {where} ORDER BY bewirtungsdatum, created_at", params
+        ).fetchall()
+    for row in rows:
+        yield _row_to_beleg(row)
+
+
+# -----------------------------
+# Monats-Export (ZIP-Stream)
+# -----------------------------
+DATEV_COLUMNS = [
+    "Belegdatum", "Belegfeld 1", "Buchungstext", "Umsatz", "Trinkgeld",
+    "Betragsquelle", "Teilnehmer", "Dateiname", "SHA-256",
+]
+
+
+def month_range(month: str) -> tuple[date, date]:
+    """'2025-03' -> (2025-03-01, 2025-03-31). ValueError bei ungültigem Monat."""
+    start = datetime.strptime(month, "%Y-%m").date()
+    nxt = date(start.year + (start.month == 12), start.month % 12 + 1, 1)
+    return start, date.fromordinal(nxt.toordinal() - 1)
+
+
+def _datev_amount(cents: int | None) -> str:
+    return "" if cents is None else f"{cents / 100:.2f}".replace(".", ",")
+
+
+def _datev_row(b: ArchivedBeleg, arcname: str) -> list[str]:
+    datum = date.fromisoformat(b.bewirtungsdatum).strftime("%d%m") if b.bewirtungsdatum else ""
+    return [
+        datum,
+        b.beleg_id[:12],
+        f"Bewirtung {b.restaurant or ''}".strip()[:60],
+        _datev_amount(b.betrag_cents),
+        _datev_amount(b.trinkgeld_cents),
+        b.betrag_quelle or "",
+        ", ".join(b.personen),
+        arcname,
+        b.sha256,
+    ]
+
+
+class _ChunkSink(io.RawIOBase):
+    """Nicht-seekbares Ziel für ZipFile: gesammelte Bytes werden vom Generator abgeholt."""
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._buf += b
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def drain(self) -> bytes:
+        out = bytes(self._buf)
+        self._buf.clear()
+        return out
+
+
+def _arcname(b: ArchivedBeleg) -> str:
+    return f"{b.bewirtungsdatum or 'ohne-datum'}_{b.beleg_id[:12]}_{b.filename}"
+
+
+def export_month_zip(tenant_key: str, month: str) -> Iterator[bytes]:
+    """
+    ZIP mit allen Belegen eines Monats (nach bewirtungsdatum) plus belege.csv (DATEV-artig,
+    Semikolon, Dezimalkomma, cp1252). Eine Abfrage: die PDFs werden gestreamt, während die
+    CSV-Zeilen in eine Spool-Datei gehen; belege.csv kommt als letzter Eintrag ins ZIP
+    (PDFs und CSV stammen so aus demselben Stand). Speicherbedarf: ein Chunk + max. 1 MiB CSV.
+    """
+    date_from, date_to = month_range(month)
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zf, \
+            tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as spool:
+        text = io.TextIOWrapper(spool, encoding="cp1252", errors="replace", newline="")
+        writer = csv.writer(text, delimiter=";", lineterminator="\r\n")
+        writer.writerow(DATEV_COLUMNS)
+
+        for b in iter_belege(tenant_key, date_from, date_to):
+            arcname = _arcname(b)
+            writer.writerow(_datev_row(b, arcname))
+            # PDFs sind schon komprimiert
+            info = zipfile.ZipInfo(arcname, date_time=datetime.fromisoformat(b.created_at).timetuple()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            with zf.open(info, "w") as out, open(blob_path(b.sha256), "rb") as src:
+                while chunk := src.read(ARCHIVE_CHUNK_BYTES):
+                    out.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+
+        text.flush()
+        text.detach()
+        spool.seek(0)
+        with zf.open("belege.csv", "w") as out:
+            while chunk := spool.read(ARCHIVE_CHUNK_BYTES):
+                out.write(chunk)
+                yield sink.drain()
+    yield sink.drain()
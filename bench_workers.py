@@ -0,0 +1,170 @@
+# bench_workers.py
+"""
+Durchsatz-Benchmark für den Multi-Worker-Betrieb (serve.py): startet den Server
+nacheinander mit 1..N Workern, schickt Korpus-Belege parallel an /full-agent
+und vergleicht Requests/s.
+
+Läuft offline über Gemini-Cassettes (siehe replay_corpus.py, Korpus vorher mit
+--mode record aufnehmen). Ohne TENANT_DATABASE_URL wird der lokale Default-Tenant
+benutzt. Der OCR-Cache ist aus, damit jeder Request die ganze Pipeline durchläuft.
+
+  python bench_workers.py corpus                     # 1..CPU-Anzahl Worker
+  python bench_workers.py corpus --workers 1 2 4 --requests 200 --concurrency 16
+"""
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import argparse
+import tempfile
+import subprocess
+import statistics
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from replay_corpus import iter_cases, offline_tenant, percentile
+from serve import available_cpus
+
+
+def __getattr__(name):
+    # APP_MODULE=bench_workers:app – jeder Worker importiert service mit Offline-Tenant
+    if name != "app":
+        raise AttributeError(name)
+    import service
+
+    if not os.getenv("TENANT_DATABASE_URL"):
+        service.get_tenant = offline_tenant
+    return service.app
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start_server(workers: int, port: int, args, workdir: Path) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "APP_MODULE": "bench_workers:app",
+        "HOST": "127.0.0.1",
+        "PORT": str(port),
+        "WEB_CONCURRENCY": str(workers),
+        "GEMINI_CASSETTE_MODE": "replay",
+        "GEMINI_CASSETTE_DIR": str(Path(args.cassettes).resolve()),
+        "GEMINI_REPLAY_LATENCY": args.latency,
+        "OCR_CACHE_TTL": os.getenv("OCR_CACHE_TTL", "3600") if args.ocr_cache else "0",
+        "SHARED_CACHE_PATH": str(workdir / "cache.sqlite3"),
+        "METRICS_MULTIPROC_DIR": str(workdir / "metrics"),
+        "ARCHIVE_DIR": str(workdir / "archive"),
+        "LOG_LEVEL": "WARNING",
+    }
+    proc = subprocess.Popen(
+        [sys.executable, str(Path(__file__).with_name("serve.py"))],
+        env=env,
+        cwd=str(Path(__file__).parent),
+        start_new_session=True,
+    )
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server with {workers} workers exited with code {proc.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/metrics", timeout=1).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    _stop_server(proc)
+    raise RuntimeError(f"server with {workers} workers did not become ready")
+
+
+def _stop_server(proc: subprocess.Popen) -> None:
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=30)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+
+
+def _run_load(port: int, cases: list, total: int, concurrency: int) -> dict:
+    url = f"http://127.0.0.1:{port}/full-agent"
+
+    def one(i: int) -> tuple[int, float]:
+        _, receipt, email_text, tenant_key = cases[i % len(cases)]
+        started = time.perf_counter()
+        with open(receipt, "rb") as f:
+            resp = client.post(
+                url,
+                data={"email_text": email_text, "tenant_key": tenant_key},
+                files={"receipt": (receipt.name, f)},
+            )
+        return resp.status_code, time.perf_counter() - started
+
+    with httpx.Client(timeout=600, limits=httpx.Limits(max_connections=concurrency)) as client:
+        # Aufwärmen: Template, Tenant, LibreOffice-Profil in jedem Worker
+        with ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(one, range(min(total, concurrency))))
+            started = time.perf_counter()
+            results = list(pool.map(one, range(total)))
+        wall = time.perf_counter() - started
+
+    seconds = [s for _, s in results]
+    return {
+        "requests": total,
+        "errors": sum(1 for status, _ in results if status != 200),
+        "wall_seconds": round(wall, 3),
+        "throughput_per_s": round(total / wall, 3) if wall > 0 else 0.0,
+        "p50_ms": round(statistics.median(seconds) * 1000, 1),
+        "p95_ms": round(percentile(seconds, 0.95) * 1000, 1),
+    }
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("corpus")
+    ap.add_argument("--workers", type=int, nargs="+", help="Worker-Anzahlen (default: 1..CPU-Anzahl)")
+    ap.add_argument("--requests", type=int, default=100)
+    ap.add_argument("--concurrency", type=int, default=None, help="parallele Clients (default: 2 x max. Worker)")
+    ap.add_argument("--latency", choices=["original", "zero"], default="zero")
+    ap.add_argument("--cassettes", default=os.getenv("GEMINI_CASSETTE_DIR", "cassettes"))
+    ap.add_argument("--ocr-cache", action="store_true", help="geteilten OCR-Cache eingeschaltet lassen")
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args(argv)
+
+    cases = list(iter_cases(Path(args.corpus)))
+    if not cases:
+        print("no cases in corpus", file=sys.stderr)
+        return 1
+    counts = args.workers or list(range(1, available_cpus() + 1))
+    concurrency = args.concurrency or 2 * max(counts)
+
+    rows = []
+    for workers in counts:
+        with tempfile.TemporaryDirectory(prefix="bench-workers-") as tmp:
+            port = _free_port()
+            proc = _start_server(workers, port, args, Path(tmp))
+            try:
+                row = {"workers": workers, **_run_load(port, cases, args.requests, concurrency)}
+            finally:
+                _stop_server(proc)
+        row["speedup"] = round(row["throughput_per_s"] / rows[0]["throughput_per_s"], 2) if rows else 1.0
+        rows.append(row)
+        if not args.json:
+            print(
+                f"workers={workers:<3d} {row['throughput_per_s']:8.2f} req/s  speedup {row['speedup']:5.2f}x  "
+                f"p50 {row['p50_ms']:8.1f} ms  p95 {row['p95_ms']:8.1f} ms  errors {row['errors']}"
+            )
+
+    if args.json:
+        print(json.dumps({"concurrency": concurrency, "latency": args.latency, "results": rows}, indent=2))
+    return 1 if any(r["errors"] for r in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,444 @@
+# conversion_sandbox.py
+"""
+Überwachte Ausführung des DOCX->PDF-Konverters (LibreOffice headless).
+
+Jeder Aufruf läuft in einer eigenen Prozessgruppe (start_new_session) mit Limits
+für CPU-Zeit und Adressraum und einem Wall-Clock-Timeout. Die Limits setzt ein
+`sh -c 'ulimit …; exec …'` vor dem Konverter (erben auch Kindprozesse); kein
+preexec_fn, das ist in einem Prozess mit Threads nicht sicher. Läuft der Konverter zu lange, wird die ganze Gruppe beendet
+(SIGTERM, nach CONVERT_KILL_GRACE Sekunden SIGKILL): soffice startet soffice.bin
+als Kindprozess, ein Kill nur des direkten Kindes ließe es weiterlaufen.
+
+Ob ein Limit gegriffen hat, zeigt der Exit-Code des Starters nicht (soffice.bin
+ist sein Kind). Während der Konvertierung werden deshalb CPU-Zeit und maximaler
+Adressraum aller Prozesse der Gruppe aus /proc mitgelesen.
+
+LibreOffice-Profile liegen unter CONVERT_PROFILE_ROOT/<pid>-<slot>. Jeder Worker
+hat CONVERT_SLOTS Profile, jedes wird von höchstens einer Konvertierung zugleich
+benutzt (ein Profil verträgt nur eine Instanz, ein frisches kostet beim Start
+1-2 s) – bis zu CONVERT_SLOTS Konvertierungen laufen also parallel.
+
+Der Janitor räumt beim Start und alle CONVERT_JANITOR_INTERVAL Sekunden auf:
+Profile beendeter Worker, liegengebliebene .lock-Dateien freier Profile und
+verwaiste Konverter-Prozesse (z.B. nach einem Absturz des Workers).
+"""
+import os
+import re
+import queue
+import shutil
+import signal
+import logging
+import threading
+import subprocess
+import time
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+
+import pipeline_graph
+from metrics import Counter, Histogram
+from structured_log import get_logger, log_event
+
+# -----------------------------
+# Konfiguration (ENV)
+# -----------------------------
+CONVERT_BINARY = os.getenv("CONVERT_BINARY", "soffice")
+CONVERT_TIMEOUT = float(os.getenv("CONVERT_TIMEOUT", "60"))
+CONVERT_CPU_SECONDS = int(os.getenv("CONVERT_CPU_SECONDS", "60"))
+# Adressraum (ulimit -v, nicht RSS) pro Prozess, 0 = unbegrenzt. soffice reserviert beim Start
+# deutlich mehr virtuellen Speicher, als es belegt: das Limit fängt nur außer Kontrolle geratene Läufe
+CONVERT_MEMORY_MB = int(os.getenv("CONVERT_MEMORY_MB", "8192"))
+CONVERT_KILL_GRACE = float(os.getenv("CONVERT_KILL_GRACE", "2"))
+CONVERT_SLOTS = max(1, int(os.getenv("CONVERT_SLOTS", "2")))
+CONVERT_PROFILE_ROOT = Path(os.getenv("CONVERT_PROFILE_ROOT", "/tmp/lo_profiles"))
+CONVERT_JANITOR_INTERVAL = float(os.getenv("CONVERT_JANITOR_INTERVAL", "300"))
+
+_PROFILE_ARG = "-env:UserInstallation="
+_PROFILE_NAME = re.compile(r"^(\d+)-(\d+)$")
+
+CONVERSIONS = Counter("conversion_runs_total", "Converter runs", ["result"])
+CONVERSION_KILLS = Counter("conversion_kills_total", "Converter processes killed", ["reason", "signal"])
+CONVERSION_LIMITS = Counter("conversion_limit_hits_total", "Converter runs that reached a resource limit", ["limit"])
+CONVERSION_SECONDS = Histogram("conversion_seconds", "Converter wall time")
+CONVERSION_CLEANUPS = Counter("conversion_cleanup_total", "Stale converter state removed by the janitor", ["kind"])
+
+log = get_logger("conversion")
+
+
+class ConversionTimeout(RuntimeError):
+    def __init__(self, what: str, timeout: float):
+        super().__init__(f"Conversion ({what}) timed out after {timeout:.1f}s")
+        self.timeout = timeout
+
+
+class ConversionFailed(RuntimeError):
+    pass
+
+
+@dataclass
+class ConversionResult:
+    returncode: int
+    stdout: str
+    stderr: str
+    seconds: float
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def _group_usage(pgid: int) -> dict[int, tuple[float, int]]:
+    """{pid: (CPU-Sekunden, VmPeak in Bytes)} der lebenden Prozesse der Gruppe; ohne /proc leer."""
+    out = {}
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return out
+    for name in entries:
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                stat = f.read()
+            # nach dem Kommando "(…)": state ppid pgrp … utime(12.) stime(13.)
+            fields = stat[stat.rindex(")") + 2:].split()
+            if int(fields[2]) != pgid or fields[0] == "Z":
+                continue
+            cpu = (int(fields[11]) + int(fields[12])) / _CLK_TCK
+            peak = 0
+            with open(f"/proc/{name}/status") as f:
+                for line in f:
+                    if line.startswith("VmPeak:"):
+                        peak = int(line.split()[1]) * 1024
+                        break
+        except (OSError, ValueError, IndexError):
+            continue
+        out[int(name)] = (cpu, peak)
+    return out
+
+
+def _killpg(pgid: int, sig: int) -> bool:
+    """True, wenn die Gruppe noch Prozesse hatte."""
+    try:
+        os.killpg(pgid, sig)
+        return True
+    except (ProcessLookupError, PermissionError):
+        return False
+
+
+class ConversionSandbox:
+    """
+    Startet Konverter mit Limits in eigener Prozessgruppe. `binary` ist austauschbar
+    (z.B. ein Skript, das hängt), run() nimmt beliebige Kommandos.
+    """
+
+    def __init__(
+        self,
+        binary: str = CONVERT_BINARY,
+        timeout: float = CONVERT_TIMEOUT,
+        cpu_seconds: int = CONVERT_CPU_SECONDS,
+        memory_mb: int = CONVERT_MEMORY_MB,
+        kill_grace: float = CONVERT_KILL_GRACE,
+        slots: int = CONVERT_SLOTS,
+        profile_root: Path = CONVERT_PROFILE_ROOT,
+    ):
+        self.binary = binary
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.kill_grace = kill_grace
+        self.profile_root = Path(profile_root)
+        # LIFO: das zuletzt benutzte (warme) Profil zuerst
+        self._free: queue.LifoQueue[int] = queue.LifoQueue()
+        for slot in reversed(range(slots)):
+            self._free.put(slot)
+        self._busy: set[int] = set()
+        self._lock = threading.Lock()
+
+    # -----------------------------
+    # Prozess mit Limits
+    # -----------------------------
+    def _with_limits(self, cmd: list[str]) -> list[str]:
+        """Kommando hinter `sh -c 'ulimit …; exec "$0" "$@"'`: Limits gelten ab dem exec für die ganze Gruppe."""
+        if os.name != "posix":  # ohne ulimit nur Wall-Clock-Timeout
+            return cmd
+        limits = ["ulimit -c 0"]
+        if self.cpu_seconds > 0:
+            # weiches Limit: SIGXCPU, hartes (5 s später): SIGKILL; weich zuerst, sonst ist weich > hart
+            limits += [f"ulimit -S -t {self.cpu_seconds}", f"ulimit -H -t {self.cpu_seconds + 5}"]
+        if self.memory_mb > 0:
+            limits.append(f"ulimit -v {self.memory_mb * 1024}")
+        # && : lässt sich ein Limit nicht setzen, startet der Konverter gar nicht erst
+        return ["/bin/sh", "-c", " && ".join(limits) + ' && exec "$0" "$@"', *cmd]
+
+    def _record_limits(self, usage: dict[int, tuple[float, int]], returncode: int) -> None:
+        """Limit-Treffer aus der mitgelesenen Nutzung der Gruppe (Stichproben alle 0,25 s) zählen."""
+        cpu = max((c for c, _ in usage.values()), default=0.0)
+        peak = max((p for _, p in usage.values()), default=0)
+        # die letzte Stichprobe liegt bis zu einem Intervall vor dem SIGXCPU
+        if self.cpu_seconds > 0 and (
+            returncode == -signal.SIGXCPU or cpu >= max(self.cpu_seconds * 0.5, self.cpu_seconds - 1)
+        ):
+            CONVERSION_LIMITS.inc(limit="cpu")
+        # RLIMIT_AS beendet nicht, Allokationen schlagen fehl: Adressraum nahe am Limit
+        if self.memory_mb > 0 and peak >= self.memory_mb * 1024 * 1024 * 0.95:
+            CONVERSION_LIMITS.inc(limit="memory")
+
+    def _terminate(self, proc: subprocess.Popen, reason: str) -> None:
+        """Ganze Prozessgruppe beenden: erst SIGTERM, nach kill_grace SIGKILL."""
+        if _killpg(proc.pid, signal.SIGTERM):
+            CONVERSION_KILLS.inc(reason=reason, signal="SIGTERM")
+        try:
+            proc.wait(timeout=self.kill_grace)
+        except subprocess.TimeoutExpired:
+            pass
+        # auch wenn der Leader schon weg ist: Kindprozesse der Gruppe können noch leben
+        if _killpg(proc.pid, signal.SIGKILL):
+            CONVERSION_KILLS.inc(reason=reason, signal="SIGKILL")
+        proc.wait()
+
+    @staticmethod
+    def _wait(proc: subprocess.Popen, deadline: float, usage: dict[int, tuple[float, int]]) -> None:
+        """
+        Auf den Prozess warten; zwischendurch auf Abbruch der Pipeline-Stage prüfen und
+        die Nutzung der Gruppe in `usage` mitschreiben (pro PID der letzte Stand).
+        """
+        while True:
+            usage.update(_group_usage(proc.pid))
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise subprocess.TimeoutExpired(proc.args, 0)
+            try:
+                proc.wait(timeout=min(left, 0.25))
+                return
+            except subprocess.TimeoutExpired:
+                if time.monotonic() < deadline:
+                    pipeline_graph.check_cancelled()
+
+    def run(self, cmd: list[str], timeout: float | None = None, cwd: str | None = None) -> ConversionResult:
+        # nie länger als die aufrufende Pipeline-Stage noch Zeit hat
+        pipeline_graph.check_cancelled()
+        timeout = pipeline_graph.remaining(self.timeout if timeout is None else timeout)
+        started = time.monotonic()
+        # Ausgabe in Dateien statt Pipes: ein Kindprozess, der die Pipe erbt und
+        # weiterläuft, würde communicate() sonst bis zu seinem Ende blockieren
+        with tempfile.TemporaryFile("w+") as out, tempfile.TemporaryFile("w+") as err:
+            proc = subprocess.Popen(
+                self._with_limits(cmd),
+                stdin=subprocess.DEVNULL,
+                stdout=out,
+                stderr=err,
+                text=True,
+                cwd=cwd,
+                start_new_session=True,
+            )
+            usage: dict[int, tuple[float, int]] = {}
+            try:
+                self._wait(proc, started + timeout, usage)
+            except subprocess.TimeoutExpired:
+                self._terminate(proc, reason="timeout")
+                CONVERSIONS.inc(result="timeout")
+                CONVERSION_SECONDS.observe(time.monotonic() - started)
+                log_event(log, "conversion_timeout", logging.WARNING, command=cmd[0], timeout_s=timeout)
+                raise ConversionTimeout(Path(cmd[0]).name, timeout) from None
+            except pipeline_graph.StageCancelled:
+                # Request ist schon beantwortet (504/Fehler einer anderen Stage)
+                self._terminate(proc, reason="cancelled")
+                CONVERSIONS.inc(result="cancelled")
+                raise
+            except BaseException:
+                self._terminate(proc, reason="error")
+                raise
+
+            # Reste der Gruppe (z.B. soffice.bin, wenn der Starter abgestürzt ist) nicht weiterlaufen lassen
+            usage.update(_group_usage(proc.pid))
+            if _killpg(proc.pid, signal.SIGKILL):
+                CONVERSION_KILLS.inc(reason="leftover", signal="SIGKILL")
+            out.seek(0)
+            err.seek(0)
+            stdout, stderr = out.read(), err.read()
+
+        seconds = time.monotonic() - started
+        CONVERSION_SECONDS.observe(seconds)
+        self._record_limits(usage, proc.returncode)
+        CONVERSIONS.inc(result="ok" if proc.returncode == 0 else "failed")
+        return ConversionResult(proc.returncode, stdout, stderr, seconds)
+
+    # -----------------------------
+    # Profile
+    # -----------------------------
+    def profile_dir(self, slot: int) -> Path:
+        return self.profile_root / f"{os.getpid()}-{slot}"
+
+    def _acquire_slot(self, timeout: float) -> int:
+        try:
+            slot = self._free.get(timeout=timeout)
+        except queue.Empty:
+            CONVERSIONS.inc(result="no_slot")
+            raise ConversionTimeout("waiting for a free converter slot", timeout) from None
+        with self._lock:
+            self._busy.add(slot)
+        return slot
+
+    def _release_slot(self, slot: int) -> None:
+        with self._lock:
+            self._busy.discard(slot)
+        self._free.put(slot)
+
+    def convert_docx_to_pdf(self, input_docx: str, output_pdf: str) -> None:
+        outdir = Path(output_pdf).parent
+        outdir.mkdir(parents=True, exist_ok=True)
+
+        budget = pipeline_graph.remaining(self.timeout)
+        deadline = time.monotonic() + budget
+        slot = self._acquire_slot(budget)
+        try:
+            # LibreOffice erzeugt PDF mit gleichem Dateinamen wie DOCX
+            cmd = [
+                self.binary,
+                "--headless",
+                "--nologo",
+                "--nolockcheck",
+                "--nodefault",
+                "--nofirststartwizard",
+                _PROFILE_ARG + self.profile_dir(slot).as_uri(),
+                "--convert-to", "pdf",
+                "--outdir", str(outdir),
+                input_docx,
+            ]
+            # Warten auf den Slot zählt zum Timeout
+            result = self.run(cmd, timeout=max(0.1, deadline - time.monotonic()))
+        finally:
+            self._release_slot(slot)
+            # Dokument-Lock bleibt nach einem Kill neben der Eingabedatei liegen
+            Path(input_docx).with_name(f".~lock.{Path(input_docx).name}#").unlink(missing_ok=True)
+
+        if result.returncode != 0:
+            raise ConversionFailed(
+                f"LibreOffice failed (code {result.returncode}).\nSTDOUT:\n{result.stdout}\nSTDERR:\n{result.stderr}"
+            )
+
+        produced = outdir / (Path(input_docx).stem + ".pdf")
+        if not produced.exists():
+            raise ConversionFailed(f"LibreOffice did not produce PDF at: {produced}")
+
+        # Falls Zielname anders ist, umbenennen
+        target = Path(output_pdf)
+        if produced.resolve() != target.resolve():
+            produced.replace(target)
+
+    # -----------------------------
+    # Aufräumen
+    # -----------------------------
+    def _is_stale(self, owner: int, slot: int) -> bool:
+        """Profil eines beendeten Workers oder freier Slot dieses Workers. Aufrufer hält self._lock."""
+        if owner == os.getpid():
+            return slot not in self._busy
+        return not _pid_alive(owner)
+
+    def _orphans(self) -> list[int]:
+        """PIDs von Konvertern, deren Profil unter profile_root zu keiner laufenden Konvertierung gehört."""
+        proc_dir = Path("/proc")
+        if not proc_dir.is_dir():
+            return []
+        prefix = _PROFILE_ARG + self.profile_root.as_uri() + "/"
+        out = []
+        for entry in proc_dir.iterdir():
+            if not entry.name.isdigit():
+                continue
+            try:
+                args = (entry / "cmdline").read_bytes().split(b"\0")
+            except OSError:
+                continue
+            for arg in args:
+                arg = arg.decode(errors="replace")
+                if not arg.startswith(prefix):
+                    continue
+                m = _PROFILE_NAME.match(arg[len(prefix):].rstrip("/"))
+                if m and self._is_stale(int(m.group(1)), int(m.group(2))):
+                    out.append(int(entry.name))
+                break
+        return out
+
+    def cleanup(self) -> dict[str, int]:
+        """Verwaiste Konverter beenden, Profile beendeter Worker und Locks freier Profile löschen."""
+        counts = {"orphan": 0, "profile": 0, "lock": 0}
+        with self._lock:
+            for pid in self._orphans():
+                try:
+                    pgid = os.getpgid(pid)
+                    if pgid != os.getpgrp():
+                        os.killpg(pgid, signal.SIGKILL)
+                    else:
+                        os.kill(pid, signal.SIGKILL)
+                except (ProcessLookupError, PermissionError):
+                    continue
+                counts["orphan"] += 1
+                CONVERSION_KILLS.inc(reason="orphan", signal="SIGKILL")
+
+            if self.profile_root.is_dir():
+                for path in self.profile_root.iterdir():
+                    m = _PROFILE_NAME.match(path.name)
+                    if not m or not path.is_dir():
+                        continue
+                    owner, slot = int(m.group(1)), int(m.group(2))
+                    if not self._is_stale(owner, slot):
+                        continue
+                    if owner != os.getpid():
+                        shutil.rmtree(path, ignore_errors=True)
+                        counts["profile"] += 1
+                    elif (path / ".lock").exists():
+                        (path / ".lock").unlink(missing_ok=True)
+                        counts["lock"] += 1
+
+        for kind, n in counts.items():
+            if n:
+                CONVERSION_CLEANUPS.inc(n, kind=kind)
+        if any(counts.values()):
+            log_event(log, "conversion_cleanup", **counts)
+        return counts
+
+
+SANDBOX = ConversionSandbox()
+
+_janitor: threading.Thread | None = None
+_janitor_stop = threading.Event()
+
+
+def _janitor_loop(sandbox: ConversionSandbox, interval: float) -> None:
+    while not _janitor_stop.wait(interval):
+        try:
+            sandbox.cleanup()
+        except Exception:
+            log_event(log, "conversion_cleanup_failed", logging.ERROR, exc_info=True)
+
+
+def start_janitor(sandbox: ConversionSandbox = SANDBOX, interval: float = CONVERT_JANITOR_INTERVAL) -> None:
+    """Einmal sofort aufräumen (Reste eines abgestürzten Workers), danach periodisch im Hintergrund."""
+    global _janitor
+    if _janitor is not None and _janitor.is_alive():
+        return
+    sandbox.cleanup()
+    if interval > 0:
+        _janitor_stop.clear()
+        _janitor = threading.Thread(
+            target=_janitor_loop, args=(sandbox, interval), name="conversion-janitor", daemon=True
+        )
+        _janitor.start()
+
+
+def stop_janitor() -> None:
+    global _janitor
+    _janitor_stop.set()
+    if _janitor is not None:
+        _janitor.join(timeout=5)
+        _janitor = None
@@ -0,0 +1,399 @@
+# duplicate_index.py
+"""
+Duplikat-Erkennung pro Tenant, bevor ein Bon durch OCR und LLM läuft.
+
+Pro verarbeitetem Bon werden gespeichert:
+- SHA-256 der Datei (exakt gleiche Datei)
+- dHash (64 Bit) des Bildes; bei PDFs des größten eingebetteten Bildes der ersten
+  Seite (Scan/Foto), reine Text-PDFs haben keinen
+- Inhalts-Schlüssel (bewirtungsdatum, betrag, restaurant) nach der Extraktion
+
+Ähnliche dHashes findet ein Multi-Index-Hashing: der Hash wird in BANDS Teile
+zerlegt, pro Teil gibt es eine Hash-Tabelle. Liegen zwei Hashes höchstens d Bits
+auseinander, stimmt mindestens ein Teil bis auf d // BANDS Bits überein
+(Schubfachprinzip) – es werden nur diese Nachbarn nachgeschlagen statt alle
+Einträge zu vergleichen.
+
+Persistiert in SQLite; jeder Worker hält den Index des Tenants im Speicher und
+lädt bei jeder Abfrage nur neue Zeilen nach (rowid > zuletzt gesehen).
+
+Gleichzeitige Uploads derselben Datei: find_duplicates sucht zuerst nur im Speicher;
+ist die Datei unbekannt, reserviert es (Tenant, SHA-256) atomar (INSERT OR IGNORE in
+receipt_claims) und liest danach die neuen Index-Zeilen nach. Die zweite Anfrage sieht
+die Reservierung der ersten, auch wenn deren Bon noch in der Pipeline steckt. Nur
+dieses INSERT braucht die Schreibsperre, bekannte Dateien und dHash-Suche nicht. register_receipt löst die Reservierung in derselben Transaktion ab,
+release_claim gibt sie nach einem Fehler frei; verwaiste Reservierungen (abgestürzter
+Worker) verfallen nach DUPLICATE_CLAIM_TTL.
+"""
+import os
+import io
+import re
+import time
+import sqlite3
+import threading
+from dataclasses import dataclass, asdict, field
+from datetime import datetime, timezone
+from itertools import combinations
+from pathlib import Path
+
+from PIL import Image, ImageOps
+from PyPDF2 import PdfReader
+from PyPDF2.errors import PdfReadError
+
+import beleg_archive
+from metrics import Counter
+
+# -----------------------------
+# Konfiguration (ENV)
+# -----------------------------
+# off | flag (Header + Log) | reject (exakte Duplikate mit 409 ablehnen, vor der OCR)
+DUPLICATE_MODE = os.getenv("DUPLICATE_MODE", "flag").strip().lower()
+DUPLICATE_DB_PATH = Path(os.getenv("DUPLICATE_DB_PATH", str(beleg_archive.ARCHIVE_DIR / "duplicates.sqlite3")))
+# max. Hamming-Abstand zweier dHashes, die als "gleiches Motiv" gelten
+DUPLICATE_PHASH_DISTANCE = int(os.getenv("DUPLICATE_PHASH_DISTANCE", "6"))
+# Sekunden, nach denen eine nicht eingelöste Reservierung als verwaist gilt (> längste Pipeline)
+DUPLICATE_CLAIM_TTL = float(os.getenv("DUPLICATE_CLAIM_TTL", "900"))
+
+HASH_BITS = 64
+BANDS = 4
+
+DUPLICATES_FOUND = Counter("duplicate_receipts_total", "Possible duplicate receipts", ["kind"])
+
+
+class DuplicateReceipt(Exception):
+    """Exaktes Duplikat im reject-Modus: die Pipeline wird vor der OCR abgebrochen."""
+
+    def __init__(self, hits: list):
+        super().__init__("Receipt was already processed")
+        self.hits = hits
+
+
+# -----------------------------
+# Perceptual Hash
+# -----------------------------
+def dhash(img: Image.Image, size: int = 8) -> int:
+    """Differenz-Hash: Graustufen 9x8, je Zeile 'links heller als rechts' als Bit."""
+    small = ImageOps.exif_transpose(img).convert("L").resize((size + 1, size), Image.Resampling.LANCZOS)
+    px = list(small.getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = px[row * (size + 1) + col]
+            right = px[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def _largest_pdf_image(path: str) -> Image.Image | None:
+    try:
+        page = PdfReader(path).pages[0]
+        images = list(page.images)
+    except (PdfReadError, IndexError, KeyError, ValueError, NotImplementedError):
+        return None
+    best = None
+    for image in images:
+        try:
+            img = Image.open(io.BytesIO(image.data))
+            img.load()
+        except Exception:
+            continue
+        if best is None or img.width * img.height > best.width * best.height:
+            best = img
+    return best
+
+
+def receipt_phash(path: str, kind: str) -> int | None:
+    """dHash für Fotos (jpeg/png) bzw. den eingebetteten Scan einer PDF; None, wenn es kein Bild gibt."""
+    if kind == "pdf":
+        img = _largest_pdf_image(path)
+        return dhash(img) if img is not None else None
+    try:
+        with Image.open(path) as img:
+            return dhash(img)
+    except OSError:  # beschädigtes Bild: die OCR meldet den Fehler
+        return None
+
+
+def content_key(bew_data: dict) -> str | None:
+    """Normalisierter Schlüssel (Datum, Betrag in Cent, Restaurant) oder None, wenn ein Teil fehlt."""
+    datum = beleg_archive.iso_date(bew_data.get("bewirtungsdatum"))
+    # Rechnungsbetrag ist stabiler als der Betrag inkl. (evtl. nur per Mail genanntem) Trinkgeld
+    cents = beleg_archive.to_cents(bew_data.get("betrag_rechnung") or bew_data.get("betrag"))
+    restaurant = re.sub(r"[\W_]+", "", str(bew_data.get("restaurant") or "")).casefold()
+    if not (datum and cents and restaurant):
+        return None
+    return f"{datum}|{cents}|{restaurant}"
+
+
+# -----------------------------
+# Multi-Index-Hashing
+# -----------------------------
+class HammingIndex:
+    """Hashes mit Hamming-Abstand <= max_distance finden, ohne alle Einträge zu vergleichen."""
+
+    def __init__(self, bits: int = HASH_BITS, bands: int = BANDS):
+        self.bands = bands
+        self.band_bits = bits // bands
+        self._mask = (1 << self.band_bits) - 1
+        self._tables: list[dict[int, list[int]]] = [{} for _ in range(bands)]
+        self._hashes: list[int] = []
+        self._items: list = []
+        self._flips: dict[int, list[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def _parts(self, h: int) -> list[int]:
+        return [(h >> (i * self.band_bits)) & self._mask for i in range(self.bands)]
+
+    def _flip_masks(self, radius: int) -> list[int]:
+        """Alle Bitmasken eines Bands mit bis zu `radius` gesetzten Bits (inkl. 0)."""
+        if radius not in self._flips:
+            masks = [0]
+            for r in range(1, radius + 1):
+                for bits in combinations(range(self.band_bits), r):
+                    masks.append(sum(1 << b for b in bits))
+            self._flips[radius] = masks
+        return self._flips[radius]
+
+    def add(self, h: int, item) -> None:
+        idx = len(self._hashes)
+        self._hashes.append(h)
+        self._items.append(item)
+        for table, part in zip(self._tables, self._parts(h)):
+            table.setdefault(part, []).append(idx)
+
+    def search(self, h: int, max_distance: int) -> list[tuple[int, object]]:
+        """[(Abstand, item)] aufsteigend nach Abstand."""
+        masks = self._flip_masks(max_distance // self.bands)
+        seen: set[int] = set()
+        out = []
+        for table, part in zip(self._tables, self._parts(h)):
+            for mask in masks:
+                for idx in table.get(part ^ mask, ()):
+                    if idx in seen:
+                        continue
+                    seen.add(idx)
+                    distance = (self._hashes[idx] ^ h).bit_count()
+                    if distance <= max_distance:
+                        out.append((distance, self._items[idx]))
+        out.sort(key=lambda x: x[0])
+        return out
+
+
+# -----------------------------
+# Persistenz + Index pro Tenant
+# -----------------------------
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipts (
+    id           INTEGER PRIMARY KEY,
+    tenant       TEXT NOT NULL,
+    sha256       TEXT NOT NULL,
+    phash        TEXT,              -- 16 Hex-Zeichen
+    content_key  TEXT,
+    beleg_id     TEXT,
+    request_id   TEXT,
+    created_at   TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS receipts_tenant_id ON receipts (tenant, id);
+-- Bons, die gerade in der Pipeline sind (noch nicht registriert)
+CREATE TABLE IF NOT EXISTS receipt_claims (
+    tenant      TEXT NOT NULL,
+    sha256      TEXT NOT NULL,
+    claim       TEXT NOT NULL,
+    request_id  TEXT,
+    created_at  TEXT NOT NULL,
+    claimed_at  REAL NOT NULL,       -- time.time(), für die TTL
+    PRIMARY KEY (tenant, sha256)
+) WITHOUT ROWID;
+"""
+
+_local = threading.local()
+
+
+def _connection() -> sqlite3.Connection:
+    """Eine Verbindung pro Thread und Prozess: der Nachlade-Check läuft bei jeder Abfrage."""
+    if getattr(_local, "pid", None) != os.getpid() or getattr(_local, "path", None) != DUPLICATE_DB_PATH:
+        DUPLICATE_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(DUPLICATE_DB_PATH, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        _local.conn, _local.pid, _local.path = conn, os.getpid(), DUPLICATE_DB_PATH
+    return _local.conn
+
+
+@dataclass
+class KnownReceipt:
+    sha256: str
+    beleg_id: str | None
+    request_id: str | None
+    created_at: str
+
+
+@dataclass
+class DuplicateHit:
+    kind: str                      # exact | near | content
+    beleg_id: str | None
+    request_id: str | None
+    created_at: str
+    distance: int | None = None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+@dataclass
+class _TenantIndex:
+    phashes: HammingIndex = field(default_factory=HammingIndex)
+    by_sha: dict[str, list[KnownReceipt]] = field(default_factory=dict)
+    by_content: dict[str, list[KnownReceipt]] = field(default_factory=dict)
+    last_id: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+_tenants: dict[str, _TenantIndex] = {}
+_tenants_lock = threading.Lock()
+
+
+def _tenant_index(tenant: str) -> _TenantIndex:
+    with _tenants_lock:
+        index = _tenants.get(tenant)
+        if index is None:
+            index = _tenants[tenant] = _TenantIndex()
+    with index.lock:
+        rows = _connection().execute(
+            "SELECT id, sha256, phash, content_key, beleg_id, request_id, created_at "
+            "FROM receipts WHERE tenant = ? AND id > ? ORDER BY id",
+            (tenant, index.last_id),
+        ).fetchall()
+        for row_id, sha, phash, key, beleg_id, request_id, created_at in rows:
+            known = KnownReceipt(sha, beleg_id, request_id, created_at)
+            index.by_sha.setdefault(sha, []).append(known)
+            if phash:
+                index.phashes.add(int(phash, 16), known)
+            if key:
+                index.by_content.setdefault(key, []).append(known)
+            index.last_id = row_id
+    return index
+
+
+def _hit(kind: str, known: KnownReceipt, distance: int | None = None) -> DuplicateHit:
+    return DuplicateHit(kind, known.beleg_id, known.request_id, known.created_at, distance)
+
+
+def _claim(tenant: str, sha256: str, claim: str, request_id: str | None) -> KnownReceipt | None:
+    """
+    Reserviert (tenant, sha256) für diesen Upload. Returns None, wenn die Reservierung
+    gelungen ist, sonst den Upload, der dieselbe Datei gerade verarbeitet.
+    """
+    conn = _connection()
+    created_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    for _ in range(2):
+        now = time.time()
+        # einzelnes Statement im Autocommit: atomar, Schreibsperre nur für dieses INSERT
+        if conn.execute(
+            "INSERT OR IGNORE INTO receipt_claims (tenant, sha256, claim, request_id, created_at, claimed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (tenant, sha256, claim, request_id, created_at, now),
+        ).rowcount:
+            return None
+        row = conn.execute(
+            "SELECT claim, request_id, created_at, claimed_at FROM receipt_claims WHERE tenant = ? AND sha256 = ?",
+            (tenant, sha256),
+        ).fetchone()
+        if row is None:  # inzwischen freigegeben
+            continue
+        holder, holder_request, holder_created, claimed_at = row
+        if claimed_at >= now - DUPLICATE_CLAIM_TTL:
+            return KnownReceipt(sha256, None, holder_request, holder_created)
+        # verwaiste Reservierung (Worker abgestürzt) übernehmen
+        conn.execute(
+            "DELETE FROM receipt_claims WHERE tenant = ? AND sha256 = ? AND claim = ?", (tenant, sha256, holder)
+        )
+    return None
+
+
+def release_claim(tenant_key: str, sha256: str, claim: str) -> None:
+    """Reservierung freigeben (Pipeline fehlgeschlagen); nach register_receipt ein No-op."""
+    _connection().execute(
+        "DELETE FROM receipt_claims WHERE tenant = ? AND sha256 = ? AND claim = ?",
+        ((tenant_key or "default").strip().lower(), sha256, claim),
+    )
+
+
+def find_duplicates(
+    tenant_key: str,
+    sha256: str,
+    phash: int | None,
+    claim: str | None = None,
+    request_id: str | None = None,
+) -> list[DuplicateHit]:
+    """
+    Exakte (SHA-256) und ähnliche (dHash) Treffer, vor der OCR.
+    Mit `claim` (eindeutiges Token des Uploads) wird eine noch unbekannte Datei atomar
+    reserviert: ein gleichzeitiger Upload derselben Datei ist dann ebenfalls ein exakter Treffer.
+    """
+    tenant = (tenant_key or "default").strip().lower()
+    index = _tenant_index(tenant)
+    in_flight = None
+    if claim and sha256 not in index.by_sha:
+        in_flight = _claim(tenant, sha256, claim, request_id)
+        # zwischen Lesen und Reservieren registriert (register_receipt löst die Reservierung
+        # in derselben Transaktion ab): nach der Reservierung steht es im Index
+        index = _tenant_index(tenant)
+    hits = [_hit("exact", k) for k in index.by_sha.get(sha256, [])]
+    if in_flight is not None and not hits:
+        hits.append(_hit("exact", in_flight))
+    if phash is not None:
+        exact = {k.sha256 for k in index.by_sha.get(sha256, [])}
+        hits += [
+            _hit("near", k, d)
+            for d, k in index.phashes.search(phash, DUPLICATE_PHASH_DISTANCE)
+            if k.sha256 not in exact
+        ]
+    for hit in hits:
+        DUPLICATES_FOUND.inc(kind=hit.kind)
+    return hits
+
+
+def find_content_duplicates(tenant_key: str, sha256: str, key: str | None) -> list[DuplicateHit]:
+    """Gleiches Datum/Betrag/Restaurant aus einer anderen Datei (z.B. Foto und PDF desselben Essens)."""
+    if key is None:
+        return []
+    index = _tenant_index((tenant_key or "default").strip().lower())
+    hits = [_hit("content", k) for k in index.by_content.get(key, []) if k.sha256 != sha256]
+    for hit in hits:
+        DUPLICATES_FOUND.inc(kind=hit.kind)
+    return hits
+
+
+def register_receipt(
+    tenant_key: str,
+    sha256: str,
+    phash: int | None,
+    key: str | None,
+    beleg_id: str | None = None,
+    request_id: str | None = None,
+    claim: str | None = None,
+) -> None:
+    """Bon im Index ablegen; löst die Reservierung `claim` in derselben Transaktion ab."""
+    tenant = (tenant_key or "default").strip().lower()
+    conn = _connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "INSERT INTO receipts (tenant, sha256, phash, content_key, beleg_id, request_id, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                tenant, sha256, f"{phash:016x}" if phash is not None else None, key, beleg_id, request_id,
+                datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            ),
+        )
+        if claim:
+            conn.execute(
+                "DELETE FROM receipt_claims WHERE tenant = ? AND sha256 = ? AND claim = ?", (tenant, sha256, claim)
+            )
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
@@ -0,0 +1,300 @@
+# email_normalizer.py
+import os
+import re
+from html.parser import HTMLParser
+
+# -----------------------------
+# Konfiguration (ENV)
+# -----------------------------
+EMAIL_NORMALIZE = os.getenv("EMAIL_NORMALIZE", "1").strip().lower() not in ("0", "false", "no")
+EMAIL_MAX_CHARS = int(os.getenv("EMAIL_MAX_CHARS", "2000"))
+
+
+# -----------------------------
+# HTML -> Text
+# -----------------------------
+_HTML_HINT = re.compile(r"<(html|body|div|p|br|span|table|blockquote)\b", re.I)
+_HTML_DROP = {"style", "script", "head", "title"}
+_HTML_BLOCK = {
+    "p", "div", "tr", "li", "ul", "ol", "table", "blockquote", "pre",
+    "h1", "h2", "h3", "h4", "h5", "h6", "hr",
+}
+_HTML_VOID = {"br", "hr", "img", "meta", "link", "input", "col", "area", "base", "wbr"}
+
+
+class _HtmlText(HTMLParser):
+    """
+    HTML -> Textzeilen. Zitate (blockquote, Gmails gmail_quote) werden nicht verworfen,
+    sondern wie in Plain-Text-Mails mit "> " markiert: so greift danach dieselbe
+    Zitat-Erkennung, inkl. Rückfall auf den Inhalt bei reinen Weiterleitungen.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.lines: list[str] = []
+        self._line: list[str] = []
+        self._line_depth = 0
+        self._depth = 0
+        self._skip = 0
+        self._pre = 0
+        self._stack: list[tuple[str, bool]] = []
+
+    def _break(self, hard: bool = False) -> None:
+        # Block-Grenzen beginnen nur eine neue Zeile, <br> erzeugt auch Leerzeilen
+        if not self._line and not hard:
+            return
+        text = "".join(self._line)
+        self.lines.append(("> " * self._line_depth + text) if text.strip() else "")
+        self._line = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "br":
+            self._break(hard=True)
+            return
+        classes = (dict(attrs).get("class") or "").split()
+        quote = tag == "blockquote" or "gmail_quote" in classes
+        if tag in _HTML_BLOCK or quote:
+            self._break()
+        if tag in _HTML_VOID:
+            return
+        self._stack.append((tag, quote))
+        if quote:
+            self._depth += 1
+        if tag in _HTML_DROP:
+            self._skip += 1
+        if tag == "pre":
+            self._pre += 1
+
+    def handle_endtag(self, tag):
+        # kaputtes HTML: bis zum passenden offenen Tag schließen, unbekannte End-Tags ignorieren
+        for pos in range(len(self._stack) - 1, -1, -1):
+            if self._stack[pos][0] == tag:
+                break
+        else:
+            return
+        for open_tag, quote in reversed(self._stack[pos:]):
+            if open_tag in _HTML_BLOCK or quote:
+                self._break()
+            if quote:
+                self._depth -= 1
+            if open_tag in _HTML_DROP:
+                self._skip -= 1
+            if open_tag == "pre":
+                self._pre -= 1
+        del self._stack[pos:]
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        if self._pre:
+            for i, part in enumerate(data.split("\n")):
+                if i:
+                    self._break(hard=True)
+                self._add(part)
+            return
+        # Zeilenumbrüche im Quelltext sind in HTML nur Leerraum
+        self._add(data.replace("\n", " "))
+
+    def _add(self, text: str) -> None:
+        if not text:
+            return
+        if not self._line:
+            self._line_depth = self._depth
+        self._line.append(text)
+
+    def text(self) -> str:
+        self.close()
+        self._break()
+        return "\n".join(self.lines)
+
+
+def _html_to_text(s: str) -> str:
+    parser = _HtmlText()
+    parser.feed(s)
+    return parser.text()
+
+
+# -----------------------------
+# Zitat-/Weiterleitungs-Marker
+# -----------------------------
+# Eine Zeile, ab der alles Folgende Zitat ist
+_QUOTE_MARKERS = [
+    # Gmail / Apple Mail / Thunderbird (DE + EN), ggf. über 2 Zeilen umbrochen
+    re.compile(r"^\s*Am\s.{0,160}\sschrieb\s.{0,200}:\s*$", re.I),
+    re.compile(r"^\s*On\s.{0,160}\swrote:\s*$", re.I),
+    re.compile(r"^\s*Le\s.{0,160}\sa\s[ée]crit\s*:\s*$", re.I),
+    # Outlook / Exchange
+    re.compile(r"^\s*-{2,}\s*(Original Message|Ursprüngliche Nachricht|Originalnachricht)\s*-{2,}\s*$", re.I),
+    re.compile(r"^\s*-{2,}\s*(Forwarded message|Weitergeleitete Nachricht|Weitergeleitete E-Mail)\s*-{2,}\s*$", re.I),
+    re.compile(r"^\s*(Begin forwarded message|Anfang der weitergeleiteten (E-Mail|Nachricht)):\s*$", re.I),
+    re.compile(r"^\s*_{8,}\s*$"),
+]
+
+# Outlook-Header-Block: "Von: ..." gefolgt von "Gesendet:/An:/Betreff:"
+_HEADER_START = re.compile(r"^\s*\*?(Von|From)\s*:\*?\s", re.I)
+_HEADER_FIELD = re.compile(r"^\s*\*?(Gesendet|Sent|Datum|Date|An|To|Cc|Betreff|Subject)\s*:\*?\s", re.I)
+
+# -----------------------------
+# Signaturen / Footer
+# -----------------------------
+_SIGNATURE_DELIM = re.compile(r"^\s*--\s*$")
+_CLOSINGS = re.compile(
+    r"^\s*("
+    r"(mit\s+)?(freundlichen|besten|herzlichen|vielen|liebe|viele|beste|sonnige)\s+gr(ü|ue)(ß|ss)(en|e)"
+    r"|mfg|lg|vg|bg|gruß|gruss|grüße|gruesse|ciao|cheers|thanks|thank you|danke(\s+und\s+gr(ü|ue)(ß|ss)e)?"
+    r"|(best|kind|warm)\s+regards|regards|best|all the best|sincerely"
+    r")[\s,.!]*$",
+    re.I,
+)
+# nach einer Grußformel: höchstens so viele Zeilen Name/Kontakt, sonst ist es noch Inhalt
+_SIGNATURE_MAX_LINES = 8
+_AMOUNT = re.compile(r"\d[\d.,]*\s*(€|eur\b|euro\b)|(€|eur\b)\s*\d|\b\d+[.,]\d{2}\b", re.I)
+_CONTENT_HINT = re.compile(
+    r"\b(trinkgeld|tip|betrag|gesamt|summe|essen|bewirtung|anlass|teilnehmer|personen|kunden?"
+    r"|lunch|dinner|mittagessen|abendessen|meeting|besprechung)\b",
+    re.I,
+)
+_DEVICE_FOOTERS = re.compile(
+    r"^\s*((gesendet|sent)\s+(von|from|with|mit|via)|von meinem \S+ gesendet|get outlook for)\b.{0,60}"
+    r"(iphone|ipad|android|outlook|samsung|mobile|handy|mail)\b",
+    re.I,
+)
+_LEGAL_FOOTERS = re.compile(
+    r"^\s*("
+    r"diese\s+(e-?mail|nachricht)\s+(enthält|kann|ist)"
+    r"|this\s+(e-?mail|message)\s+(and\s+any|contains|may\s+contain|is\s+intended)"
+    r"|confidentiality\s+notice|disclaimer\s*:"
+    r"|geschäftsführ(er|ung)\s*:|managing\s+director"
+    r"|(sitz\s+der\s+gesellschaft|registergericht|amtsgericht)\b"
+    r"|hrb\s*\d|ust\.?-?id"
+    r"|please consider the environment|bitte denken sie an die umwelt"
+    r")",
+    re.I,
+)
+
+
+def _find_quote_start(lines: list[str]) -> int | None:
+    for i, line in enumerate(lines):
+        if line.lstrip().startswith(">"):
+            return i
+
+        for pat in _QUOTE_MARKERS:
+            if pat.match(line):
+                return i
+            # "Am ... schrieb" wird gern umbrochen
+            if i + 1 < len(lines) and pat.match(line + " " + lines[i + 1].strip()):
+                return i
+
+        if _HEADER_START.match(line):
+            following = lines[i + 1 : i + 5]
+            if sum(1 for l in following if _HEADER_FIELD.match(l)) >= 2:
+                return i
+    return None
+
+
+def _unquote(line: str) -> str:
+    """Eine Zitat-Ebene ("> ") entfernen; tiefer verschachtelte Zitate bleiben markiert."""
+    stripped = line.lstrip()
+    if not stripped.startswith(">"):
+        return line
+    stripped = stripped[1:]
+    return stripped[1:] if stripped.startswith(" ") else stripped
+
+
+def _strip_quoted_header(lines: list[str]) -> list[str]:
+    """Entfernt die Zitat-Ebene sowie Marker- und Header-Zeilen am Anfang eines zitierten Blocks."""
+    lines = [_unquote(l) for l in lines]
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if (
+            not line.strip()
+            or any(p.match(line) for p in _QUOTE_MARKERS)
+            or _HEADER_START.match(line)
+            or _HEADER_FIELD.match(line)
+        ):
+            i += 1
+            continue
+        break
+    return lines[i:]
+
+
+def _is_footer(line: str) -> bool:
+    return bool(_SIGNATURE_DELIM.match(line) or _DEVICE_FOOTERS.match(line) or _LEGAL_FOOTERS.match(line))
+
+
+def _looks_like_signature(block: list[str]) -> bool:
+    """Kurzer Namens-/Kontaktblock ohne Beträge oder inhaltliche Sätze."""
+    rest = [l.strip() for l in block if l.strip()]
+    if len(rest) > _SIGNATURE_MAX_LINES:
+        return False
+    for l in rest:
+        if len(l) > 60 or _AMOUNT.search(l) or _CONTENT_HINT.search(l):
+            return False
+        if l.endswith((".", "!", "?")) and len(l.split()) > 3:
+            return False
+    return True
+
+
+def _cut_signature(lines: list[str]) -> list[str]:
+    for i, line in enumerate(lines):
+        if _is_footer(line):
+            return lines[:i]
+        # Grußformel ("Danke", "Best", "LG") nur, wenn schon eigener Text davor steht
+        # und danach bis zum Footer nur noch eine Signatur folgt – sonst ist es Inhalt
+        if i > 0 and _CLOSINGS.match(line) and any(l.strip() for l in lines[:i]):
+            end = next((j for j in range(i + 1, len(lines)) if _is_footer(lines[j])), len(lines))
+            if _looks_like_signature(lines[i + 1 : end]):
+                return lines[:i]
+    return lines
+
+
+def _truncate(s: str, max_chars: int) -> str:
+    if max_chars <= 0 or len(s) <= max_chars:
+        return s
+    cut = s[:max_chars]
+    # an Wortgrenze abschneiden, wenn sinnvoll möglich
+    ws = max(cut.rfind(" "), cut.rfind("\n"))
+    if ws > max_chars * 0.8:
+        cut = cut[:ws]
+    return cut.rstrip()
+
+
+# -----------------------------
+# Public API
+# -----------------------------
+def normalize_email_text(email_text: str | None, max_chars: int | None = None) -> str:
+    """
+    Reduziert den Mail-Body auf den neu geschriebenen Text des Absenders:
+    HTML -> Text, zitierte Antworten/Weiterleitungen, Signaturen und
+    Rechts-Footer werden entfernt, danach auf max_chars gekürzt.
+
+    Rein regelbasiert und deterministisch (gleiche Eingabe -> gleiche Ausgabe).
+    Bleibt nach dem Abschneiden kein eigener Text übrig (reine Weiterleitung),
+    wird der Inhalt der ersten zitierten Nachricht ohne Header verwendet.
+    """
+    max_chars = EMAIL_MAX_CHARS if max_chars is None else max_chars
+    s = email_text or ""
+    if not EMAIL_NORMALIZE:
+        return _truncate(s.strip(), max_chars)
+
+    if _HTML_HINT.search(s):
+        s = _html_to_text(s)
+
+    s = s.replace("\r\n", "\n").replace("\r", "\n").replace("\u00a0", " ").replace("\u200b", "")
+    lines = [l.rstrip() for l in s.split("\n")]
+
+    q = _find_quote_start(lines)
+    own = lines if q is None else lines[:q]
+    own = _cut_signature(own)
+
+    if not any(l.strip() for l in own) and q is not None:
+        # reine Weiterleitung: Inhalt der weitergeleiteten Mail nehmen
+        quoted = _strip_quoted_header(lines[q:])
+        q2 = _find_quote_start(quoted)
+        own = _cut_signature(quoted if q2 is None else quoted[:q2])
+
+    text = "\n".join(own).strip()
+    text = re.sub(r"[ \t]+", " ", text)
+    text = re.sub(r"\n\s*\n\s*\n+", "\n\n", text)
+    return _truncate(text, max_chars)
@@ -4,14 +4,18 @@ import json
 import google.generativeai as genai
 import requests
 
+import gemini_cassette
+from llm_usage import apply_prompt_budget, record_usage
+
 # ---------- Konfiguration ----------
 
-# Gemini API Key aus ENV
+# Gemini API Key aus ENV (im Replay-Modus nicht nötig)
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
+if not GEMINI_API_KEY and not gemini_cassette.replaying():
     raise RuntimeError("Bitte setze zuerst GEMINI_API_KEY in der Umgebung.")
 
-genai.configure(api_key=GEMINI_API_KEY)
+if GEMINI_API_KEY:
+    genai.configure(api_key=GEMINI_API_KEY)
 
 MODEL_NAME = "gemini-2.5-flash"
 
@@ -60,19 +64,27 @@ def build_user_prompt(receipt_text: str, email_text: str | None = None) -> str:
 
 # ---------- Hauptfunktion: Extraktion mit Gemini ----------
 
-def extract_bewirtungsdaten_gemini(receipt_text: str, email_text: str | None = None) -> dict:
+def extract_bewirtungsdaten_gemini(
+    receipt_text: str,
+    email_text: str | None = None,
+    tenant_key: str = "default",
+) -> dict:
     """
     Nutzt Gemini, um strukturierte Bewirtungsdaten aus Text zu extrahieren.
+    OCR-/E-Mail-Text werden vorher auf das Prompt-Budget des Tenants gekürzt.
     """
+    receipt_text, email_text = apply_prompt_budget(receipt_text, email_text, tenant_key)
     user_prompt = build_user_prompt(receipt_text, email_text)
 
-    model = genai.GenerativeModel(MODEL_NAME)
-    response = model.generate_content(
+    response = gemini_cassette.generate_content(
+        MODEL_NAME,
         [
             EXTRACTION_SYSTEM_PROMPT,
             user_prompt,
-        ]
+        ],
+        tenant_key=tenant_key,
     )
+    record_usage(response, tenant_key, stage="extract")
 
     raw = response.text.strip()
 
@@ -0,0 +1,308 @@
+# fast_extract.py
+"""
+Regelbasierter Extraktor vor dem LLM: liest Datum, Restaurant, Adresse und Betrag
+aus dem OCR-Text sowie Personen/Anlass aus der (kurzen) E-Mail – im selben
+JSON-Schema wie extract_bewirtungsdaten_gemini, mit Konfidenz pro Feld.
+
+Sind alle Pflichtfelder sicher genug, wird der Gemini-Call komplett übersprungen.
+Sonst wird Gemini gefragt: sichere lokale Felder bleiben, fehlende kommen vom LLM.
+"""
+import os
+import re
+from dataclasses import dataclass
+from datetime import date
+from decimal import Decimal
+from typing import Any
+
+from amounts import parse_eur_amount, format_eur
+from metrics import Counter
+
+# -----------------------------
+# Konfiguration (ENV)
+# -----------------------------
+# "auto" = Fast Path nutzen, "off" = immer LLM
+FAST_EXTRACT_MODE = os.getenv("FAST_EXTRACT_MODE", "auto").strip().lower()
+FAST_EXTRACT_MIN_CONFIDENCE = float(os.getenv("FAST_EXTRACT_MIN_CONFIDENCE", "0.8"))
+
+REQUIRED_FIELDS = ("bewirtungsdatum", "restaurant", "adresse", "anlass", "personen", "betrag")
+
+FAST_EXTRACT = Counter("fast_extract_total", "Extraction requests by fast-path result", ["result"])
+FAST_EXTRACT_FIELDS = Counter(
+    "fast_extract_fields_total", "Locally extracted fields above the confidence threshold", ["field"]
+)
+
+
+@dataclass
+class FieldGuess:
+    value: Any
+    confidence: float
+
+
+# -----------------------------
+# Datum
+# -----------------------------
+_DATE_DE = re.compile(r"\b(\d{1,2})[./-](\d{1,2})[./-](\d{4}|\d{2})\b")
+_DATE_ISO = re.compile(r"\b(\d{4})-(\d{2})-(\d{2})\b")
+_DATE_LABEL = re.compile(r"(datum|date|rechnungsdatum|belegdatum)\s*:?", re.I)
+
+
+def _valid_date(y: int, m: int, d: int) -> date | None:
+    if y < 100:
+        y += 2000
+    try:
+        dt = date(y, m, d)
+    except ValueError:
+        return None
+    if not (2000 <= dt.year <= date.today().year + 1):
+        return None
+    return dt
+
+
+def guess_date(ocr_text: str) -> FieldGuess | None:
+    found: list[tuple[date, bool]] = []
+    for line in ocr_text.splitlines():
+        labelled = bool(_DATE_LABEL.search(line))
+        for m in _DATE_DE.finditer(line):
+            dt = _valid_date(int(m.group(3)), int(m.group(2)), int(m.group(1)))
+            if dt:
+                found.append((dt, labelled))
+        for m in _DATE_ISO.finditer(line):
+            dt = _valid_date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+            if dt:
+                found.append((dt, labelled))
+    if not found:
+        return None
+
+    distinct = {dt for dt, _ in found}
+    labelled = {dt for dt, lab in found if lab}
+    if len(distinct) == 1:
+        dt, conf = next(iter(distinct)), 0.95
+    elif len(labelled) == 1:
+        dt, conf = next(iter(labelled)), 0.85
+    else:
+        dt, conf = found[0][0], 0.4
+    return FieldGuess(dt.strftime("%d.%m.%Y"), conf)
+
+
+# -----------------------------
+# Betrag
+# -----------------------------
+_AMOUNT = r"(\d{1,3}(?:[.\s]\d{3})*[.,]\d{2}|\d+[.,]\d{2})"
+_TOTAL_LINE = re.compile(
+    rf"(GESAMTBETRAG|GESAMTSUMME|ENDBETRAG|ZU\s*ZAHLEN|RECHNUNGSBETRAG|SUMME|GESAMT|TOTAL|AMOUNT\s*DUE)"
+    rf"[^0-9\n]{{0,25}}{_AMOUNT}",
+)
+_ANY_AMOUNT = re.compile(_AMOUNT)
+# Zeilen, deren Beträge nicht der Rechnungsbetrag sind
+_NOT_TOTAL = re.compile(
+    r"\b(ZWISCHENSUMME|SUBTOTAL|GEGEBEN|BAR\s*GEGEBEN|RÜCKGELD|RUECKGELD|WECHSELGELD|TRINKGELD|TIP|NETTO|MWST|UST|VAT|TAX)\b"
+)
+
+
+def _line_amounts(line: str) -> list[Decimal]:
+    """Beträge einer Zeile, außer wenn davor ein Nicht-Summen-Stichwort steht (MwSt, Rückgeld, ...)."""
+    out = []
+    for m in _ANY_AMOUNT.finditer(line):
+        if _NOT_TOTAL.search(line[: m.start()]):
+            continue
+        amt = parse_eur_amount(m.group(1))
+        if amt is not None:
+            out.append(amt)
+    return out
+
+
+def guess_total(ocr_text: str) -> FieldGuess | None:
+    upper = ocr_text.upper()
+    totals: list[Decimal] = []
+    for line in upper.splitlines():
+        m = _TOTAL_LINE.search(line)
+        if m and not _NOT_TOTAL.search(line[: m.start(2)]):
+            amt = parse_eur_amount(m.group(2))
+            if amt is not None:
+                totals.append(amt)
+    if not totals:
+        return None
+
+    others = [a for line in upper.splitlines() for a in _line_amounts(line)]
+    total = max(totals)
+    consistent = len(set(totals)) == 1
+    largest = not others or total >= max(others)
+
+    if consistent and largest:
+        conf = 0.95
+    elif largest:
+        conf = 0.85
+    else:
+        conf = 0.5
+    return FieldGuess(format_eur(total), conf)
+
+
+# -----------------------------
+# Restaurant + Adresse
+# -----------------------------
+_STREET = re.compile(
+    r"^\s*([A-ZÄÖÜ][\wäöüß.\-' ]{1,40}?"
+    r"(str\.|straße|strasse|weg|platz|allee|damm|ring|gasse|ufer|markt|chaussee|promenade|steig|zeile)"
+    r"\s*\d+\s*[a-zA-Z]?(?:\s*[-/]\s*\d+[a-zA-Z]?)?)\s*,?\s*(.*)$",
+    re.I,
+)
+_ZIP_CITY = re.compile(r"\b(\d{5})\s+([A-ZÄÖÜ][\wäöüß.\- ]{1,40})")
+_NOT_NAME = re.compile(
+    r"(\d{3,}|tel|fax|www\.|http|@|ust|steuer|st\.?-?nr|rechnung|beleg|bon\b|quittung|datum|tisch|kasse|"
+    r"willkommen|welcome|gmbh\s*&|^\W*$)",
+    re.I,
+)
+
+
+def guess_address(ocr_text: str) -> tuple[FieldGuess | None, int | None]:
+    lines = [l.strip() for l in ocr_text.splitlines()]
+    for i, line in enumerate(lines[:15]):
+        m = _STREET.match(line)
+        if not m:
+            continue
+        street = m.group(1).strip()
+        rest = m.group(3)
+        zip_m = _ZIP_CITY.search(rest) or next(
+            (z for z in (_ZIP_CITY.search(l) for l in lines[i + 1 : i + 3]) if z), None
+        )
+        if zip_m:
+            return FieldGuess(f"{street}, {zip_m.group(1)} {zip_m.group(2).strip()}", 0.9), i
+        return FieldGuess(street, 0.6), i
+    return None, None
+
+
+def guess_restaurant(ocr_text: str, address_line: int | None) -> FieldGuess | None:
+    lines = [l.strip() for l in ocr_text.splitlines() if l.strip()]
+    raw_lines = [l.strip() for l in ocr_text.splitlines()]
+    head = raw_lines[:address_line] if address_line is not None else raw_lines[:5]
+    candidates = [l for l in head if l and not _NOT_NAME.search(l) and sum(c.isalpha() for c in l) >= 3]
+    if not candidates:
+        return None
+    name = candidates[0]
+    # Name direkt über der Adresse und erste sinnvolle Zeile -> sicher
+    if address_line is not None and lines and lines[0] == name:
+        return FieldGuess(name, 0.9)
+    if address_line is not None:
+        return FieldGuess(name, 0.75)
+    return FieldGuess(name, 0.5)
+
+
+# -----------------------------
+# Personen + Anlass (E-Mail)
+# -----------------------------
+_PERSONS_LABEL = re.compile(
+    r"^\s*(teilnehmer(innen)?|teilnehmende|personen|gäste|gaeste|bewirtete\s+personen|participants|attendees)\s*:\s*(.+)$",
+    re.I | re.M,
+)
+_PERSONS_WITH = re.compile(
+    r"\b(?:mit|with)\s+((?:[A-ZÄÖÜ][\wäöüß\-]+(?:\s+[A-ZÄÖÜ][\wäöüß\-]+)*)"
+    r"(?:\s*(?:,|und|and|&)\s*[A-ZÄÖÜ][\wäöüß\-]+(?:\s+[A-ZÄÖÜ][\wäöüß\-]+)*)*)"
+)
+_ANLASS_LABEL = re.compile(r"^\s*(anlass|grund|occasion|purpose)\s*:\s*(.+)$", re.I | re.M)
+_BUSINESS = re.compile(
+    r"(besprechung|meeting|termin|kunde|projekt|workshop|planung|abstimmung|gespräch|gespraech|"
+    r"kickoff|kick-off|review|verhandlung|strategie|onboarding|pitch|partner|nachbesprechung)",
+    re.I,
+)
+_AMOUNT_SENTENCE = re.compile(r"(trinkgeld|tip|gesamt|insgesamt|total|summe|zu zahlen)", re.I)
+
+
+def _split_names(s: str) -> list[str]:
+    parts = re.split(r"\s*(?:,|;|\bund\b|\band\b|&)\s*", s.strip().rstrip("."))
+    return [p.strip() for p in parts if p.strip()]
+
+
+def guess_persons(email_text: str) -> FieldGuess | None:
+    m = _PERSONS_LABEL.search(email_text)
+    if m:
+        names = _split_names(m.group(3))
+        if names:
+            return FieldGuess(names, 0.9)
+    m = _PERSONS_WITH.search(email_text)
+    if m:
+        names = _split_names(m.group(1))
+        if names:
+            return FieldGuess(names, 0.7)
+    return None
+
+
+def _sentences(text: str) -> list[str]:
+    return [s.strip() for s in re.split(r"(?<=[.!?])\s+|\n+", text) if s.strip()]
+
+
+def guess_occasion(email_text: str) -> FieldGuess | None:
+    m = _ANLASS_LABEL.search(email_text)
+    if m:
+        return FieldGuess(m.group(2).strip(), 0.9)
+    sentences = [
+        s for s in _sentences(email_text)
+        if not _AMOUNT_SENTENCE.search(s) and not _PERSONS_LABEL.match(s)
+    ]
+    if len(sentences) == 1 and _BUSINESS.search(sentences[0]) and len(sentences[0]) <= 200:
+        return FieldGuess(sentences[0], 0.8)
+    if sentences:
+        return FieldGuess(sentences[0], 0.5)
+    return None
+
+
+# -----------------------------
+# Public API
+# -----------------------------
+def extract_local(receipt_text: str, email_text: str | None = None) -> dict[str, FieldGuess]:
+    """Alle lokal erkennbaren Felder mit Konfidenz (0..1)."""
+    receipt_text = receipt_text or ""
+    email_text = email_text or ""
+    out: dict[str, FieldGuess] = {}
+
+    address, address_line = guess_address(receipt_text)
+    for field, guess in (
+        ("bewirtungsdatum", guess_date(receipt_text)),
+        ("betrag", guess_total(receipt_text)),
+        ("adresse", address),
+        ("restaurant", guess_restaurant(receipt_text, address_line)),
+        ("personen", guess_persons(email_text)),
+        ("anlass", guess_occasion(email_text)),
+    ):
+        if guess is not None:
+            out[field] = guess
+    return out
+
+
+def confident_fields(local: dict[str, FieldGuess], threshold: float | None = None) -> dict[str, Any]:
+    threshold = FAST_EXTRACT_MIN_CONFIDENCE if threshold is None else threshold
+    return {k: g.value for k, g in local.items() if g.confidence >= threshold}
+
+
+def extract_bewirtungsdaten(receipt_text: str, email_text: str | None = None, tenant_key: str = "default") -> dict:
+    """
+    Fast Path vor extract_bewirtungsdaten_gemini:
+    - alle Pflichtfelder sicher -> lokales Ergebnis, kein Gemini-Call
+    - sonst Gemini; sichere lokale Felder gewinnen, fehlende kommen vom LLM
+    """
+    # erst hier importieren: extract_local() soll ohne Gemini-Konfiguration nutzbar sein (Eval-Skript)
+    from extract_agent_gemini import extract_bewirtungsdaten_gemini
+
+    if FAST_EXTRACT_MODE == "off":
+        return extract_bewirtungsdaten_gemini(receipt_text, email_text, tenant_key=tenant_key)
+
+    local = extract_local(receipt_text, email_text)
+    confident = confident_fields(local)
+    for field in confident:
+        FAST_EXTRACT_FIELDS.inc(field=field)
+
+    if all(f in confident for f in REQUIRED_FIELDS):
+        FAST_EXTRACT.inc(result="hit")
+        return {
+            "bewirtungsdatum": confident["bewirtungsdatum"],
+            "unterschriftsdatum": date.today().strftime("%d.%m.%Y"),
+            "ort": "",
+            "restaurant": confident["restaurant"],
+            "adresse": confident["adresse"],
+            "anlass": confident["anlass"],
+            "personen": confident["personen"],
+            "betrag": confident["betrag"],
+        }
+
+    FAST_EXTRACT.inc(result="miss")
+    data = extract_bewirtungsdaten_gemini(receipt_text, email_text, tenant_key=tenant_key) or {}
+    return {**data, **confident}
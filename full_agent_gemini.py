@@ -10,7 +10,9 @@ from fastapi import UploadFile
 
 from tenant_store import get_tenant
 from ocr_bon import ocr_bon
-from extract_agent_gemini import extract_bewirtungsdaten_gemini
+from fast_extract import extract_bewirtungsdaten
+from upload_ingest import ingest_upload
+from email_normalizer import normalize_email_text
 
 
 # -----------------------------
@@ -53,16 +55,15 @@ def _safe_filename(name: str) -> str:
 async def save_upload_to_tmp(upload: UploadFile) -> str:
     """
     Saves UploadFile to /tmp and returns file path.
+    Streams via ingest_upload (size limit + magic-byte sniffing); the extension
+    is taken from the detected type, not from the client filename.
     """
-    data = await upload.read()
-    if not data:
-        raise ValueError("Uploaded receipt is empty")
-
-    fn = _safe_filename(upload.filename or "receipt")
-    # Ensure we keep extension if provided
-    tmp_path = Path("/tmp") / fn
-    tmp_path.write_bytes(data)
-    return str(tmp_path)
+    ingested = await ingest_upload(upload)
+    try:
+        stem = Path(_safe_filename(upload.filename or "receipt")).stem or "receipt"
+        return ingested.save_to(Path("/tmp") / f"{stem}{ingested.suffix}")
+    finally:
+        ingested.close()
 
 
 # -----------------------------
@@ -83,9 +84,10 @@ async def build_bew_data_from_upload(
     """
     1) Saves receipt to /tmp
     2) OCR using ocr_bon(path)
-    3) LLM extraction using extract_bewirtungsdaten_gemini(ocr_text, email_text)
-    4) Applies tenant defaults (ort + signature)
-    5) Applies pragmatic tip defaults
+    3) Normalizes email_text (normalize_email_text)
+    4) Extraction: rule-based fast path, Gemini (extract_bewirtungsdaten_gemini) as fallback
+    5) Applies tenant defaults (ort + signature)
+    6) Applies pragmatic tip defaults
     """
     tenant_key = (tenant_key or "default").strip().lower()
     tenant = get_tenant(tenant_key)
@@ -93,12 +95,15 @@ async def build_bew_data_from_upload(
     receipt_path = await save_upload_to_tmp(receipt)
 
     # OCR expects a file path in your project
-    ocr_text = ocr_bon(receipt_path)
+    ocr_text = ocr_bon(receipt_path, tenant_key=tenant.tenant_key)
+
+    # Only the author's new text (no quoted thread / signature / HTML)
+    email_text = normalize_email_text(email_text)
 
     # Extract structured data
-    bew_data = extract_bewirtungsdaten_gemini(ocr_text, email_text) or {}
+    bew_data = extract_bewirtungsdaten(ocr_text, email_text, tenant_key=tenant.tenant_key) or {}
     if not isinstance(bew_data, dict):
-        raise RuntimeError("extract_bewirtungsdaten_gemini did not return a dict")
+        raise RuntimeError("extract_bewirtungsdaten did not return a dict")
 
     # ---- Tenant defaults ----
     if not bew_data.get("ort"):
@@ -0,0 +1,242 @@
+# gemini_cassette.py
+"""
+Record/Replay für Gemini-Calls (generate_content + upload_file).
+
+GEMINI_CASSETTE_MODE=off     -> normale API-Calls (Default)
+GEMINI_CASSETTE_MODE=record  -> API-Calls + Antwort als Cassette speichern
+GEMINI_CASSETTE_MODE=replay  -> nur aus Cassettes antworten, kein API-Zugriff
+
+Cassettes liegen als JSON unter GEMINI_CASSETTE_DIR, Schlüssel ist ein Hash
+über Modell + Prompt-Teile (Texte, Bildpixel, Inhalt hochgeladener Dateien).
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+
+import google.generativeai as genai
+
+import pipeline_graph
+from llm_scheduler import run_llm_call
+from llm_usage import estimate_tokens
+
+# -----------------------------
+# Konfiguration (ENV)
+# -----------------------------
+GEMINI_CASSETTE_MODE = os.getenv("GEMINI_CASSETTE_MODE", "off").strip().lower()
+GEMINI_CASSETTE_DIR = Path(os.getenv("GEMINI_CASSETTE_DIR", "cassettes"))
+# "original" = aufgezeichnete Latenz nachspielen, "zero" = sofort antworten
+GEMINI_REPLAY_LATENCY = os.getenv("GEMINI_REPLAY_LATENCY", "original").strip().lower()
+
+if GEMINI_CASSETTE_MODE not in ("off", "record", "replay"):
+    raise RuntimeError(f"Invalid GEMINI_CASSETTE_MODE: {GEMINI_CASSETTE_MODE}")
+
+
+def replaying() -> bool:
+    return GEMINI_CASSETTE_MODE == "replay"
+
+
+def recording() -> bool:
+    return GEMINI_CASSETTE_MODE == "record"
+
+
+class CassetteMiss(RuntimeError):
+    pass
+
+
+# hochgeladene Datei (File.name) -> SHA-256 des lokalen Inhalts
+_uploaded: dict[str, str] = {}
+_uploaded_lock = threading.Lock()
+
+
+class ReplayFile(SimpleNamespace):
+    """Platzhalter für genai File im Replay-Modus."""
+
+
+# -----------------------------
+# Hashing der Prompt-Teile
+# -----------------------------
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _part_fingerprint(part) -> str:
+    if isinstance(part, str):
+        return "text:" + hashlib.sha256(part.encode("utf-8")).hexdigest()
+    if isinstance(part, (bytes, bytearray)):
+        return "bytes:" + hashlib.sha256(part).hexdigest()
+
+    # PIL.Image: über Modus, Größe und Pixeldaten
+    if hasattr(part, "tobytes") and hasattr(part, "size") and hasattr(part, "mode"):
+        h = hashlib.sha256(f"{part.mode}:{part.size}".encode())
+        h.update(part.tobytes())
+        return "image:" + h.hexdigest()
+
+    # hochgeladene Datei: über den lokalen Inhalt, nicht über den (zufälligen) Remote-Namen
+    name = getattr(part, "name", None)
+    sha = getattr(part, "sha256", None)
+    if sha is None and name is not None:
+        with _uploaded_lock:
+            sha = _uploaded.get(name)
+    if sha is not None:
+        return "file:" + sha
+
+    # Inline-Blob, z.B. {"mime_type": "application/pdf", "data": b"..."}
+    if isinstance(part, dict) and isinstance(part.get("data"), (bytes, bytearray)):
+        return f"blob:{part.get('mime_type', '')}:" + hashlib.sha256(part["data"]).hexdigest()
+
+    if isinstance(part, dict):
+        return "dict:" + hashlib.sha256(json.dumps(part, sort_keys=True, default=str).encode()).hexdigest()
+    raise TypeError(f"Cannot fingerprint prompt part of type {type(part).__name__}")
+
+
+def cassette_key(model_name: str, parts: list) -> str:
+    h = hashlib.sha256(model_name.encode())
+    for part in parts:
+        h.update(b"\x00")
+        h.update(_part_fingerprint(part).encode())
+    return h.hexdigest()
+
+
+# -----------------------------
+# Cassette I/O
+# -----------------------------
+def _cassette_path(kind: str, key: str) -> Path:
+    return GEMINI_CASSETTE_DIR / kind / key[:2] / f"{key}.json"
+
+
+def _write(kind: str, key: str, entry: dict) -> None:
+    path = _cassette_path(kind, key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(json.dumps(entry, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp.replace(path)
+
+
+def _read(kind: str, key: str) -> dict:
+    path = _cassette_path(kind, key)
+    if not path.exists():
+        raise CassetteMiss(f"No {kind} cassette for key {key[:16]} in {GEMINI_CASSETTE_DIR}")
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+# Schätzung für den Scheduler: Bild/PDF-Seite ~258 Tokens, Antwort ~512 Tokens
+_TOKENS_PER_MEDIA_PART = 258
+_EXPECTED_OUTPUT_TOKENS = 512
+
+
+def _estimate_call_tokens(parts: list) -> int:
+    return _EXPECTED_OUTPUT_TOKENS + sum(
+        estimate_tokens(p) if isinstance(p, str) else _TOKENS_PER_MEDIA_PART for p in parts
+    )
+
+
+def _actual_call_tokens(response) -> int | None:
+    usage = _usage_dict(response)
+    total = usage["total_token_count"] or usage["prompt_token_count"] + usage["candidates_token_count"]
+    return total or None
+
+
+def _replay_delay(entry: dict) -> None:
+    if GEMINI_REPLAY_LATENCY == "original":
+        time.sleep(float(entry.get("latency_s", 0.0)))
+
+
+def _usage_dict(response) -> dict:
+    usage = getattr(response, "usage_metadata", None)
+    return {
+        "prompt_token_count": int(getattr(usage, "prompt_token_count", 0) or 0),
+        "candidates_token_count": int(getattr(usage, "candidates_token_count", 0) or 0),
+        "total_token_count": int(getattr(usage, "total_token_count", 0) or 0),
+    }
+
+
+# -----------------------------
+# Public API (ersetzt genai.upload_file / model.generate_content)
+# -----------------------------
+def upload_file(path: str, tenant_key: str | None = None):
+    """Wie genai.upload_file(path=...); läuft über den LLM-Scheduler (zählt als Request, 0 Tokens)."""
+    return run_llm_call(lambda: _upload_file(path), tenant_key, est_tokens=0)
+
+
+def _upload_file(path: str):
+    # nach Timeout/Abbruch der Stage keinen Upload mehr starten
+    pipeline_graph.check_cancelled()
+    sha = _sha256_file(path)
+
+    if replaying():
+        entry = _read("upload", sha)
+        _replay_delay(entry)
+        return ReplayFile(name=f"replay/{sha[:16]}", sha256=sha, mime_type=entry.get("mime_type"))
+
+    started = time.perf_counter()
+    file = genai.upload_file(path=path)
+    latency = time.perf_counter() - started
+
+    with _uploaded_lock:
+        _uploaded[file.name] = sha
+    if recording():
+        _write("upload", sha, {
+            "kind": "upload_file",
+            "sha256": sha,
+            "mime_type": getattr(file, "mime_type", None),
+            "latency_s": round(latency, 4),
+        })
+    return file
+
+
+def generate_content(model_name: str, parts: list, tenant_key: str | None = None):
+    """
+    Wie genai.GenerativeModel(model_name).generate_content(parts).
+    Die Replay-Response hat .text und .usage_metadata (für llm_usage.record_usage).
+    Alle Calls laufen über den LLM-Scheduler (Fairness pro tenant_key, Rate-Limits).
+    """
+    return run_llm_call(
+        lambda: _generate_content(model_name, parts),
+        tenant_key,
+        est_tokens=_estimate_call_tokens(parts),
+        usage_tokens=_actual_call_tokens,
+    )
+
+
+def _request_options() -> dict:
+    # HTTP-Timeout des Clients = Restzeit der Pipeline-Stage, damit der Call nicht weiterläuft
+    left = pipeline_graph.remaining()
+    return {"timeout": max(1.0, left)} if left is not None else {}
+
+
+def _generate_content(model_name: str, parts: list):
+    pipeline_graph.check_cancelled()
+    if not recording() and not replaying():
+        return genai.GenerativeModel(model_name).generate_content(parts, request_options=_request_options())
+
+    key = cassette_key(model_name, parts)
+
+    if replaying():
+        entry = _read("generate", key)
+        _replay_delay(entry)
+        return SimpleNamespace(
+            text=entry["text"],
+            usage_metadata=SimpleNamespace(**entry.get("usage", {})),
+        )
+
+    started = time.perf_counter()
+    response = genai.GenerativeModel(model_name).generate_content(parts, request_options=_request_options())
+    latency = time.perf_counter() - started
+
+    _write("generate", key, {
+        "kind": "generate_content",
+        "model": model_name,
+        "parts": [_part_fingerprint(p) for p in parts],
+        "text": response.text,
+        "usage": _usage_dict(response),
+        "latency_s": round(latency, 4),
+    })
+    return response
@@ -0,0 +1,417 @@
+# llm_scheduler.py
+"""
+Zentraler Scheduler für alle Gemini-Calls (ein gemeinsamer GEMINI_API_KEY für alle Tenants).
+
+- Token-Buckets für Requests/Minute und Tokens/Minute
+- Weighted Fair Queuing pro Tenant (Gewichte per ENV)
+- interaktive Einzel-Requests vor Batch-Arbeit
+- 429 / ResourceExhausted: Buckets leeren, mit Backoff erneut einreihen
+- Wartezeit begrenzt: Stage-Deadline (pipeline_graph.remaining) bzw. LLM_MAX_WAIT_SECONDS;
+  abgebrochene Stages verlassen die Queue, statt nach dem 504 doch noch zu laufen
+- pro Tenant höchstens LLM_MAX_QUEUED_PER_TENANT wartende Requests, damit ein Bulk-Tenant
+  nicht alle LLM-Stage-Threads mit Warten belegt (weitere: QueueFull -> 429). Gezählt wird
+  pro Request (begin_request), nicht pro Call: ein mehrseitiges PDF reiht bis zu
+  OCR_PAGE_CONCURRENCY Calls gleichzeitig ein und zählt trotzdem einmal
+- Queue-Tiefe und Wartezeit als Metriken
+
+Uhr und Modell sind injizierbar (ManualClock + beliebiges Callable), damit sich
+das Verhalten deterministisch testen lässt.
+"""
+import os
+import json
+import time
+import itertools
+import threading
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+import pipeline_graph
+from metrics import Counter, Gauge, Histogram
+from llm_usage import tenant_label
+
+# -----------------------------
+# Konfiguration (ENV)
+# -----------------------------
+LLM_SCHEDULER = os.getenv("LLM_SCHEDULER", "on").strip().lower() not in ("0", "off", "false", "no")
+# Limits gelten für den ganzen API-Key; bei mehreren Worker-Prozessen (serve.py setzt
+# WEB_CONCURRENCY) bekommt jeder Prozess seinen Anteil
+_WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "1") or "1"))
+LLM_RPM = float(os.getenv("LLM_RPM", "1000")) / _WORKERS
+LLM_TPM = float(os.getenv("LLM_TPM", "1000000")) / _WORKERS
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+# ab so vielen offenen Calls eines Tenants gilt neue Arbeit als Batch
+LLM_BATCH_THRESHOLD = int(os.getenv("LLM_BATCH_THRESHOLD", "3"))
+LLM_RATE_LIMIT_RETRIES = int(os.getenv("LLM_RATE_LIMIT_RETRIES", "3"))
+# max. Wartezeit in der Queue, wenn der Call nicht aus einer Stage mit Timeout kommt
+LLM_MAX_WAIT_SECONDS = float(os.getenv("LLM_MAX_WAIT_SECONDS", "60"))
+# Requests pro Tenant mit wartenden (noch nicht freigegebenen) Calls; 0 = unbegrenzt
+LLM_MAX_QUEUED_PER_TENANT = int(os.getenv("LLM_MAX_QUEUED_PER_TENANT", "8"))
+# z.B. '{"enpal": 2, "default": 1}'
+LLM_TENANT_WEIGHTS: dict[str, float] = {
+    k.strip().lower(): float(v) for k, v in json.loads(os.getenv("LLM_TENANT_WEIGHTS", "{}") or "{}").items()
+}
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+_PRIORITY_ORDER = {INTERACTIVE: 0, BATCH: 1}
+
+LLM_QUEUE_DEPTH = Gauge("llm_queue_depth", "Gemini calls waiting in the scheduler", ["priority"])
+LLM_INFLIGHT = Gauge("llm_inflight", "Gemini calls currently running")
+LLM_QUEUE_WAIT = Histogram("llm_queue_wait_seconds", "Time spent waiting in the scheduler", ["priority"])
+LLM_RATE_LIMITED = Counter("llm_rate_limited_total", "Gemini calls answered with a rate-limit error", ["tenant"])
+LLM_QUEUE_REJECTED = Counter(
+    "llm_queue_rejected_total", "Gemini calls that left the scheduler without running", ["reason"]
+)
+
+# Priorität des aktuellen Requests ("interactive" | "batch" | "auto")
+_priority: ContextVar[str] = ContextVar("llm_priority", default="auto")
+# Calls desselben Requests (auch aus dessen Stage-/Seiten-Threads) teilen sich einen Platz im Cap
+_request: ContextVar[object | None] = ContextVar("llm_request", default=None)
+
+
+def set_priority(priority: str | None) -> None:
+    priority = (priority or "auto").strip().lower()
+    _priority.set(priority if priority in (INTERACTIVE, BATCH) else "auto")
+
+
+def begin_request() -> None:
+    """Neuer Request: seine Calls zählen für LLM_MAX_QUEUED_PER_TENANT zusammen (nicht die Client-Request-ID)."""
+    _request.set(object())
+
+
+# Wartende Threads prüfen so oft Deadline / Abbruch der Stage (nur RealClock)
+_POLL_SECONDS = 0.25
+
+
+# -----------------------------
+# Uhren
+# -----------------------------
+class RealClock:
+    real = True
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def subscribe(self, fn: Callable[[], None]) -> None:
+        pass
+
+
+class ManualClock:
+    """Uhr für Tests: Zeit läuft nur über advance(); wartende Threads werden dabei geweckt."""
+
+    real = False
+
+    def __init__(self, start: float = 0.0):
+        self._now = start
+        self._subscribers: list[Callable[[], None]] = []
+
+    def monotonic(self) -> float:
+        return self._now
+
+    def advance(self, seconds: float) -> None:
+        self._now += seconds
+        for fn in self._subscribers:
+            fn()
+
+    def subscribe(self, fn: Callable[[], None]) -> None:
+        self._subscribers.append(fn)
+
+
+# -----------------------------
+# Token-Bucket
+# -----------------------------
+class TokenBucket:
+    def __init__(self, per_minute: float, clock, burst: float | None = None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst if burst is not None else per_minute
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock.monotonic()
+
+    def _refill(self) -> None:
+        now = self.clock.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Sekunden bis `amount` verfügbar ist (0 = sofort)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, delta: float) -> None:
+        """Nachträgliche Korrektur (tatsächliche statt geschätzter Tokens); darf ins Minus gehen."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+    def drain(self, penalty_seconds: float = 0.0) -> None:
+        """Bucket leeren und zusätzlich `penalty_seconds` Nachschub sperren (Backoff nach 429)."""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0) - penalty_seconds * self.rate
+
+
+# -----------------------------
+# Scheduler
+# -----------------------------
+@dataclass(order=True)
+class _Ticket:
+    sort_key: tuple
+    tenant: str = field(compare=False)
+    priority: str = field(compare=False)
+    cost: float = field(compare=False)
+    enqueued: float = field(compare=False)
+    # virtuelle Startzeit (WFQ), um sie beim Verlassen der Queue zurückzugeben
+    start: float = field(default=0.0, compare=False)
+    granted: bool = field(default=False, compare=False)
+    # Request (begin_request); ohne: jeder Call zählt einzeln
+    request: object | None = field(default=None, compare=False)
+
+
+class RateLimited(Exception):
+    """Vom Modell-Callable zu werfen (oder zu mappen), wenn die API 429 meldet."""
+
+
+class QueueFull(RuntimeError):
+    """Der Tenant hat schon LLM_MAX_QUEUED_PER_TENANT Requests mit wartenden Calls."""
+
+    def __init__(self, tenant: str, limit: int):
+        super().__init__(f"Too many queued Gemini requests for tenant '{tenant}' (limit {limit})")
+        self.tenant = tenant
+        self.limit = limit
+
+
+class QueueTimeout(TimeoutError):
+    """Call kam vor Ablauf der Wartezeit (oder vor Abbruch der Stage) nicht dran."""
+
+
+def _is_rate_limit_error(exc: BaseException) -> bool:
+    if isinstance(exc, RateLimited):
+        return True
+    # google.api_core.exceptions.ResourceExhausted / TooManyRequests, ohne harte Abhängigkeit
+    return type(exc).__name__ in ("ResourceExhausted", "TooManyRequests") or getattr(exc, "code", None) == 429
+
+
+class LLMScheduler:
+    def __init__(
+        self,
+        rpm: float = LLM_RPM,
+        tpm: float = LLM_TPM,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        weights: dict[str, float] | None = None,
+        batch_threshold: int = LLM_BATCH_THRESHOLD,
+        rate_limit_retries: int = LLM_RATE_LIMIT_RETRIES,
+        max_wait: float | None = LLM_MAX_WAIT_SECONDS,
+        max_queued_per_tenant: int = LLM_MAX_QUEUED_PER_TENANT,
+        clock=None,
+    ):
+        self.clock = clock or RealClock()
+        self.requests = TokenBucket(rpm, self.clock)
+        self.tokens = TokenBucket(tpm, self.clock)
+        self.max_concurrency = max_concurrency
+        self.weights = dict(LLM_TENANT_WEIGHTS if weights is None else weights)
+        self.batch_threshold = batch_threshold
+        self.rate_limit_retries = rate_limit_retries
+        self.max_wait = max_wait
+        self.max_queued_per_tenant = max_queued_per_tenant
+
+        self._cond = threading.Condition()
+        self._queue: list[_Ticket] = []
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._last_finish: dict[str, float] = {}
+        self._open: dict[str, int] = {}
+        self.inflight = 0
+        self.clock.subscribe(self._wake)
+
+    # ---- Hilfen ----
+    def _wake(self) -> None:
+        with self._cond:
+            self._cond.notify_all()
+
+    def _weight(self, tenant: str) -> float:
+        return max(0.01, self.weights.get(tenant, 1.0))
+
+    def classify(self, tenant: str, priority: str = "auto") -> str:
+        if priority in (INTERACTIVE, BATCH):
+            return priority
+        return BATCH if self._open.get(tenant, 0) >= self.batch_threshold else INTERACTIVE
+
+    def queue_depth(self, priority: str | None = None) -> int:
+        with self._cond:
+            return sum(1 for t in self._queue if priority is None or t.priority == priority)
+
+    def _update_gauges(self) -> None:
+        for prio in _PRIORITY_ORDER:
+            LLM_QUEUE_DEPTH.set(sum(1 for t in self._queue if t.priority == prio), priority=prio)
+        LLM_INFLIGHT.set(self.inflight)
+
+    # ---- Kern: Einreihen / Auswählen / Freigeben (unter self._cond) ----
+    def _enqueue(self, tenant: str, priority: str, cost: float, request: object | None = None) -> _Ticket:
+        if self.max_queued_per_tenant > 0:
+            queued = {t.request if t.request is not None else id(t) for t in self._queue if t.tenant == tenant}
+            # weitere Calls eines schon wartenden Requests belegen keinen neuen Platz
+            if (request is None or request not in queued) and len(queued) >= self.max_queued_per_tenant:
+                LLM_QUEUE_REJECTED.inc(reason="queue_full")
+                raise QueueFull(tenant, self.max_queued_per_tenant)
+        # WFQ: virtuelle Endzeit = max(virtuelle Zeit, letzte Endzeit des Tenants) + Kosten / Gewicht
+        start = max(self._virtual_time, self._last_finish.get(tenant, 0.0))
+        finish = start + cost / self._weight(tenant)
+        self._last_finish[tenant] = finish
+        ticket = _Ticket(
+            sort_key=(_PRIORITY_ORDER[priority], finish, next(self._seq)),
+            tenant=tenant, priority=priority, cost=cost, enqueued=self.clock.monotonic(), start=start,
+            request=request,
+        )
+        self._queue.append(ticket)
+        self._queue.sort()
+        self._open[tenant] = self._open.get(tenant, 0) + 1
+        self._update_gauges()
+        return ticket
+
+    def _try_grant(self) -> float | None:
+        """
+        Gibt den vordersten Ticket frei, wenn Limits es erlauben.
+        Returns None wenn etwas freigegeben wurde / nichts zu tun ist, sonst Wartezeit in Sekunden.
+        """
+        if not self._queue or self.inflight >= self.max_concurrency:
+            return None
+        head = self._queue[0]
+        wait = max(self.requests.wait_time(1), self.tokens.wait_time(head.cost))
+        if wait > 0:
+            return wait
+        self.requests.take(1)
+        self.tokens.take(head.cost)
+        self._queue.pop(0)
+        self._virtual_time = max(self._virtual_time, head.sort_key[1] - head.cost / self._weight(head.tenant))
+        head.granted = True
+        self.inflight += 1
+        LLM_QUEUE_WAIT.observe(self.clock.monotonic() - head.enqueued, priority=head.priority)
+        self._update_gauges()
+        self._cond.notify_all()
+        return None
+
+    def _close(self, tenant: str) -> None:
+        self._open[tenant] -= 1
+        if self._open[tenant] > 0:
+            return
+        del self._open[tenant]
+        if not self._open:
+            # Scheduler leer (Ende der Busy-Periode): virtuelle Zeit nachziehen, alle Endzeiten vergessen
+            self._virtual_time = max(self._virtual_time, *self._last_finish.values())
+            self._last_finish.clear()
+            return
+        # Tenants ohne offene Calls, deren Endzeit die virtuelle Zeit nicht mehr übersteigt, haben
+        # keinen Vorsprung mehr (Start wäre ohnehin die virtuelle Zeit) -> vergessen
+        for t in [t for t, finish in self._last_finish.items() if t not in self._open and finish <= self._virtual_time]:
+            del self._last_finish[t]
+
+    def _release(self, ticket: _Ticket, actual_tokens: float | None) -> None:
+        self.inflight -= 1
+        self._close(ticket.tenant)
+        if actual_tokens is not None:
+            self.tokens.adjust(actual_tokens - ticket.cost)
+        self._update_gauges()
+        self._cond.notify_all()
+
+    def _abandon(self, ticket: _Ticket, reason: str) -> None:
+        """Wartenden Ticket aus der Queue nehmen; seine virtuelle Zeit geht an den Tenant zurück."""
+        self._queue.remove(ticket)
+        if self._last_finish.get(ticket.tenant) == ticket.sort_key[1]:
+            self._last_finish[ticket.tenant] = ticket.start
+        self._close(ticket.tenant)
+        LLM_QUEUE_REJECTED.inc(reason=reason)
+        self._update_gauges()
+        # der nächste Ticket kann jetzt vorne stehen
+        self._cond.notify_all()
+
+    def _acquire(self, tenant: str, priority: str, cost: float, max_wait: float | None = None) -> _Ticket:
+        """
+        Wartet auf Freigabe, höchstens `max_wait` Sekunden (Uhr des Schedulers).
+        QueueTimeout bei Ablauf oder wenn die aufrufende Stage abgebrochen wurde.
+        """
+        with self._cond:
+            ticket = self._enqueue(tenant, priority, cost, _request.get())
+            deadline = ticket.enqueued + max_wait if max_wait is not None else None
+            while not ticket.granted:
+                wait = self._try_grant()
+                if ticket.granted:
+                    break
+                if pipeline_graph.cancelled():
+                    self._abandon(ticket, "cancelled")
+                    raise QueueTimeout("Stage cancelled while waiting for the LLM scheduler")
+                left = deadline - self.clock.monotonic() if deadline is not None else None
+                if left is not None and left <= 0:
+                    self._abandon(ticket, "timeout")
+                    raise QueueTimeout(f"Waited {max_wait:g}s for the LLM scheduler")
+                if not self.clock.real:
+                    # ManualClock: advance() weckt alle Wartenden
+                    self._cond.wait()
+                    continue
+                timeout = min(x for x in (wait, left, _POLL_SECONDS) if x is not None)
+                self._cond.wait(timeout=timeout)
+            return ticket
+
+    # ---- Public API ----
+    def call(
+        self,
+        fn: Callable[[], Any],
+        tenant_key: str | None = None,
+        est_tokens: float = 0.0,
+        priority: str | None = None,
+        usage_tokens: Callable[[Any], float | None] | None = None,
+    ) -> Any:
+        """
+        Führt fn() aus, sobald Tenant-Fairness und Rate-Limits es erlauben.
+        usage_tokens(result) liefert die tatsächlich verbrauchten Tokens zur Bucket-Korrektur.
+        """
+        tenant = (tenant_key or "default").strip().lower()
+        with self._cond:
+            prio = self.classify(tenant, priority or _priority.get())
+        attempt = 0
+        while True:
+            # in einer Stage: nicht länger warten, als die Stage noch Zeit hat
+            ticket = self._acquire(tenant, prio, est_tokens, pipeline_graph.remaining(self.max_wait))
+            actual = None
+            try:
+                result = fn()
+                actual = usage_tokens(result) if usage_tokens else None
+                return result
+            except Exception as exc:
+                if not _is_rate_limit_error(exc) or attempt >= self.rate_limit_retries:
+                    raise
+                LLM_RATE_LIMITED.inc(tenant=tenant_label(tenant))
+                attempt += 1
+                with self._cond:
+                    # API sagt "zu viel": Buckets leeren, damit alle Tenants gemeinsam zurückfahren
+                    backoff = float(2 ** attempt)
+                    self.requests.drain(backoff)
+                    self.tokens.drain(backoff)
+            finally:
+                with self._cond:
+                    self._release(ticket, actual)
+
+
+_scheduler: LLMScheduler | None = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> LLMScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = LLMScheduler()
+        return _scheduler
+
+
+def run_llm_call(fn: Callable[[], Any], tenant_key: str | None, est_tokens: float, usage_tokens=None) -> Any:
+    """Einstiegspunkt für gemini_cassette; ohne Scheduler (LLM_SCHEDULER=off) direkter Aufruf."""
+    if not LLM_SCHEDULER:
+        return fn()
+    return get_scheduler().call(fn, tenant_key=tenant_key, est_tokens=est_tokens, usage_tokens=usage_tokens)
@@ -0,0 +1,170 @@
+# llm_usage.py
+"""
+Token-Accounting für alle Gemini-Calls (pro Tenant + Pipeline-Stage)
+und Prompt-Budgets, die OCR-/E-Mail-Text vor dem Call kürzen.
+
+Das Budget gilt nur für die Extraktion: der OCR-Call bekommt den Bon als Bild/PDF,
+dessen Token-Kosten von Auflösung und Seitenzahl abhängen. Kürzen ließe sich dort
+nur der Bon selbst – und damit genau die Summe am Ende.
+"""
+import os
+import json
+import threading
+
+from metrics import Counter
+
+# -----------------------------
+# Konfiguration (ENV)
+# -----------------------------
+# Budget für den Extraktions-Prompt (OCR-Text + E-Mail-Text), in Tokens. 0 = kein Limit.
+LLM_PROMPT_BUDGET_TOKENS = int(os.getenv("LLM_PROMPT_BUDGET_TOKENS", "6000"))
+# Maximaler Anteil, den der E-Mail-Text davon bekommen darf (Tokens)
+LLM_EMAIL_BUDGET_TOKENS = int(os.getenv("LLM_EMAIL_BUDGET_TOKENS", "800"))
+# Tenant-spezifische Prompt-Budgets, z.B. '{"enpal": 4000}'
+LLM_TENANT_BUDGETS: dict[str, int] = {
+    k.strip().lower(): int(v) for k, v in json.loads(os.getenv("LLM_TENANT_BUDGETS", "{}") or "{}").items()
+}
+
+# Obergrenze verschiedener Tenant-Labels in den Metriken, weitere landen unter "other"
+LLM_USAGE_MAX_TENANTS = int(os.getenv("LLM_USAGE_MAX_TENANTS", "200"))
+
+# grobe Heuristik für Gemini: ~4 Zeichen pro Token (deutsch/englisch)
+CHARS_PER_TOKEN = 4
+
+
+# -----------------------------
+# Metriken
+# -----------------------------
+LLM_CALLS = Counter("llm_calls_total", "Gemini calls", ["tenant", "stage", "kind"])
+LLM_INPUT_TOKENS = Counter("llm_input_tokens_total", "Gemini prompt tokens", ["tenant", "stage", "kind"])
+LLM_OUTPUT_TOKENS = Counter("llm_output_tokens_total", "Gemini output tokens", ["tenant", "stage", "kind"])
+LLM_PROMPT_TRUNCATIONS = Counter(
+    "llm_prompt_truncations_total", "Prompts truncated to fit the budget", ["tenant", "field"]
+)
+
+
+_label_tenants: set[str] = set()
+_label_lock = threading.Lock()
+
+
+def _tenant(tenant_key: str | None) -> str:
+    return (tenant_key or "default").strip().lower()
+
+
+def tenant_label(tenant_key: str | None) -> str:
+    """
+    Tenant als Metrik-Label. Aufrufer übergeben den aufgelösten Tenant (tenant_store),
+    die Obergrenze schützt zusätzlich vor beliebig vielen Label-Sets.
+    """
+    tenant = _tenant(tenant_key)
+    with _label_lock:
+        if tenant in _label_tenants:
+            return tenant
+        if len(_label_tenants) >= LLM_USAGE_MAX_TENANTS:
+            return "other"
+        _label_tenants.add(tenant)
+    return tenant
+
+
+def record_usage(response, tenant_key: str | None, stage: str, kind: str = "") -> tuple[int, int]:
+    """
+    Liest usage_metadata aus einer Gemini-Response und verbucht Input-/Output-Tokens.
+    Returns (input_tokens, output_tokens).
+    """
+    usage = getattr(response, "usage_metadata", None)
+    input_tokens = int(getattr(usage, "prompt_token_count", 0) or 0)
+    output_tokens = int(getattr(usage, "candidates_token_count", 0) or 0)
+
+    labels = dict(tenant=tenant_label(tenant_key), stage=stage, kind=kind)
+    LLM_CALLS.inc(**labels)
+    LLM_INPUT_TOKENS.inc(input_tokens, **labels)
+    LLM_OUTPUT_TOKENS.inc(output_tokens, **labels)
+    return input_tokens, output_tokens
+
+
+def usage_summary(tenant_key: str | None = None) -> dict:
+    """
+    Aggregiert die Zähler pro Tenant und Stage:
+    {tenant: {stage: {"calls", "input_tokens", "output_tokens", "by_kind": {...}}}}
+    """
+    wanted = _tenant(tenant_key) if tenant_key else None
+    out: dict = {}
+    for field, metric in (
+        ("calls", LLM_CALLS),
+        ("input_tokens", LLM_INPUT_TOKENS),
+        ("output_tokens", LLM_OUTPUT_TOKENS),
+    ):
+        for labels, value in metric.items():
+            if wanted and labels["tenant"] != wanted:
+                continue
+            stage = out.setdefault(labels["tenant"], {}).setdefault(
+                labels["stage"], {"calls": 0, "input_tokens": 0, "output_tokens": 0, "by_kind": {}}
+            )
+            stage[field] += int(value)
+            if labels["kind"]:
+                by_kind = stage["by_kind"].setdefault(labels["kind"], {"calls": 0, "input_tokens": 0, "output_tokens": 0})
+                by_kind[field] += int(value)
+    return out
+
+
+# -----------------------------
+# Prompt-Budgets
+# -----------------------------
+def estimate_tokens(text: str | None) -> int:
+    return (len(text or "") + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def prompt_budget_for(tenant_key: str | None) -> int:
+    return LLM_TENANT_BUDGETS.get(_tenant(tenant_key), LLM_PROMPT_BUDGET_TOKENS)
+
+
+def _cut(text: str, max_tokens: int) -> str:
+    max_chars = max(0, max_tokens * CHARS_PER_TOKEN)
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rstrip()
+
+
+def _cut_middle(text: str, max_tokens: int) -> str:
+    max_chars = max(0, max_tokens * CHARS_PER_TOKEN)
+    if len(text) <= max_chars:
+        return text
+    marker = "\n[...]\n"
+    keep = max(0, max_chars - len(marker))
+    head = keep * 2 // 5
+    tail = keep - head
+    return text[:head].rstrip() + marker + (text[-tail:].lstrip() if tail else "")
+
+
+def apply_prompt_budget(
+    receipt_text: str,
+    email_text: str | None,
+    tenant_key: str | None = None,
+) -> tuple[str, str | None]:
+    """
+    Kürzt E-Mail- und OCR-Text so, dass beide zusammen ins Prompt-Budget passen.
+    Die E-Mail bekommt höchstens LLM_EMAIL_BUDGET_TOKENS, der OCR-Text den Rest.
+    Beim OCR-Text bleiben Kopf (Restaurant, Datum) und Ende (Summe, Zahlung) erhalten,
+    gekürzt wird in der Mitte (Positionen).
+    """
+    budget = prompt_budget_for(tenant_key)
+    if budget <= 0:
+        return receipt_text, email_text
+
+    tenant = tenant_label(tenant_key)
+    receipt_text = receipt_text or ""
+
+    if email_text:
+        email_budget = min(LLM_EMAIL_BUDGET_TOKENS, budget)
+        cut = _cut(email_text, email_budget)
+        if cut != email_text:
+            LLM_PROMPT_TRUNCATIONS.inc(tenant=tenant, field="email_text")
+            email_text = cut
+
+    ocr_budget = max(0, budget - estimate_tokens(email_text))
+    cut = _cut_middle(receipt_text, ocr_budget)
+    if cut != receipt_text:
+        LLM_PROMPT_TRUNCATIONS.inc(tenant=tenant, field="ocr_text")
+        receipt_text = cut
+
+    return receipt_text, email_text
@@ -0,0 +1,370 @@
+# metrics.py
+"""
+Minimal in-process metrics (Counter / Gauge / Histogram) with Prometheus text output.
+Bewusst ohne externe Abhängigkeit; wird unter /metrics ausgeliefert.
+
+Mehrere Worker-Prozesse (serve.py setzt METRICS_MULTIPROC_DIR): jeder Prozess schreibt
+seinen Stand alle METRICS_FLUSH_INTERVAL Sekunden nach <dir>/<pid>-<startzeit>.json
+(Startzeit aus /proc: eine wiederverwendete PID bekommt eine eigene Datei); render() und
+items() summieren über alle Dateien. Gauges zählen nur von laufenden Workern (livesum).
+Counter/Histogramme beendeter Worker werden in <dir>/aggregate.json übernommen und ihre
+Datei gelöscht – beim Beenden (stop_flusher) vom Worker selbst, nach einem Absturz beim
+nächsten flush() eines anderen Workers. Lesen und Übernehmen laufen unter einem flock.
+"""
+import os
+import re
+import json
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable
+
+try:
+    import fcntl
+except ImportError:  # nicht-POSIX: ohne Dateisperre
+    fcntl = None
+
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR", "").strip()
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+_lock = threading.Lock()
+_registry: dict[str, "_Metric"] = {}
+
+
+def _label_key(labelnames: tuple[str, ...], labels: dict) -> tuple[str, ...]:
+    unknown = set(labels) - set(labelnames)
+    if unknown:
+        raise ValueError(f"Unknown labels: {sorted(unknown)}")
+    return tuple(str(labels.get(n, "")) for n in labelnames)
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(labelnames: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+        with _lock:
+            if name in _registry:
+                raise ValueError(f"Metric already registered: {name}")
+            _registry[name] = self
+
+    def get(self, **labels) -> float:
+        """Wert dieses Prozesses."""
+        with _lock:
+            return self._values.get(_label_key(self.labelnames, labels), 0.0)
+
+    def items(self) -> list[tuple[dict, float]]:
+        """(Labels, Wert) über alle Worker-Prozesse."""
+        if METRICS_MULTIPROC_DIR:
+            values = _merged()[self.name].get("values", {})
+        else:
+            with _lock:
+                values = dict(self._values)
+        return [(dict(zip(self.labelnames, k)), v) for k, v in values.items()]
+
+    def _snapshot(self) -> dict:
+        return {"values": dict(self._values)}
+
+    def _merge(self, into: dict, snap: dict) -> None:
+        values = into.setdefault("values", {})
+        for k, v in snap.get("values", {}).items():
+            values[k] = values.get(k, 0.0) + v
+
+    def _render(self, snap: dict) -> list[str]:
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {v:g}" for k, v in snap.get("values", {}).items()]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        if amount < 0:
+            raise ValueError("Counter can only increase")
+        key = _label_key(self.labelnames, labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = _label_key(self.labelnames, labels)
+        with _lock:
+            self._values[key] = float(value)
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = _label_key(self.labelnames, labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._hist: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(self.labelnames, labels)
+        with _lock:
+            h = self._hist.setdefault(key, [[0] * len(self.buckets), 0, 0.0])
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    h[0][i] += 1
+            h[1] += 1
+            h[2] += value
+
+    def count(self, **labels) -> int:
+        with _lock:
+            h = self._hist.get(_label_key(self.labelnames, labels))
+            return h[1] if h else 0
+
+    def _snapshot(self) -> dict:
+        return {"hist": {k: [list(counts), n, total] for k, (counts, n, total) in self._hist.items()}}
+
+    def _merge(self, into: dict, snap: dict) -> None:
+        hist = into.setdefault("hist", {})
+        for k, (counts, n, total) in snap.get("hist", {}).items():
+            h = hist.setdefault(k, [[0] * len(self.buckets), 0, 0.0])
+            if len(counts) != len(self.buckets):
+                continue
+            h[0] = [a + b for a, b in zip(h[0], counts)]
+            h[1] += n
+            h[2] += total
+
+    def _render(self, snap: dict) -> list[str]:
+        out = []
+        for k, (counts, n, total) in snap.get("hist", {}).items():
+            for b, c in zip(self.buckets, counts):
+                le = 'le="%g"' % b
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, k, le)} {c}")
+            le = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, k, le)} {n}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labelnames, k)} {n}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labelnames, k)} {total:g}")
+        return out
+
+
+# -----------------------------
+# Mehrere Worker-Prozesse
+# -----------------------------
+def _snapshot_all() -> dict[str, dict]:
+    with _lock:
+        return {name: m._snapshot() for name, m in _registry.items()}
+
+
+def _encode(snaps: dict[str, dict]) -> dict:
+    # Label-Tupel als Listen (JSON)
+    return {
+        name: {kind: [[list(k), v] for k, v in entries.items()] for kind, entries in snap.items()}
+        for name, snap in snaps.items()
+    }
+
+
+def _decode(data: dict) -> dict[str, dict]:
+    return {
+        name: {kind: {tuple(k): v for k, v in entries} for kind, entries in snap.items()}
+        for name, snap in data.items()
+    }
+
+
+_WORKER_FILE = re.compile(r"^(\d+)-(\d+)$")
+_AGGREGATE = "aggregate.json"
+# eigene Datei schon in aggregate.json übernommen (stop_flusher): nicht mehr selbst mitzählen
+_retired = False
+
+
+def _start_time(pid: int) -> int | None:
+    """Startzeit des Prozesses (Ticks seit Boot, /proc/<pid>/stat); None, wenn er nicht läuft; 0 ohne /proc."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+        return int(stat[stat.rindex(")") + 2:].split()[19])
+    except FileNotFoundError:
+        if os.path.isdir("/proc"):
+            return None
+    except (OSError, ValueError, IndexError):
+        return None
+    # ohne /proc: nur die PID prüfen
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        pass
+    return 0
+
+
+def _own_file(directory: Path) -> Path:
+    return directory / f"{os.getpid()}-{_start_time(os.getpid()) or 0}.json"
+
+
+@contextmanager
+def _dir_lock(directory: Path, exclusive: bool):
+    """flock auf <dir>/.lock: Lesen geteilt, Übernehmen in aggregate.json exklusiv."""
+    if fcntl is None:
+        yield
+        return
+    with open(directory / ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read(path: Path) -> dict[str, dict] | None:
+    try:
+        return _decode(json.loads(path.read_text(encoding="utf-8")))
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def _write(path: Path, snaps: dict[str, dict]) -> None:
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(_encode(snaps)), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def _merge_into(merged: dict[str, dict], snap: dict[str, dict], gauges: bool) -> None:
+    with _lock:
+        metrics = dict(_registry)
+    for name, data in snap.items():
+        m = metrics.get(name)
+        if m is None or (m.kind == "gauge" and not gauges):
+            continue
+        m._merge(merged.setdefault(name, {}), data)
+
+
+def _worker_files(directory: Path) -> list[tuple[Path, bool]]:
+    """(Datei, läuft der Worker noch) für alle Worker-Dateien außer der eigenen."""
+    own = _own_file(directory).name
+    out = []
+    for path in directory.glob("*.json"):
+        m = _WORKER_FILE.match(path.stem)
+        if not m or path.name == own:
+            continue
+        pid, started = int(m.group(1)), int(m.group(2))
+        current = _start_time(pid)
+        # PID wiederverwendet: anderer Prozess, die Datei gehört einem beendeten Worker
+        out.append((path, current is not None and (current == started or current == 0 or started == 0)))
+    return out
+
+
+def _fold(directory: Path, paths: list[Path]) -> None:
+    """Counter/Histogramme beendeter Worker in aggregate.json übernehmen, ihre Dateien löschen."""
+    if not paths:
+        return
+    with _dir_lock(directory, exclusive=True):
+        aggregate = _read(directory / _AGGREGATE) or {}
+        folded = []
+        for path in paths:
+            snap = _read(path)
+            if snap is None:  # schon von einem anderen Worker übernommen
+                continue
+            _merge_into(aggregate, snap, gauges=False)
+            folded.append(path)
+        if folded:
+            _write(directory / _AGGREGATE, aggregate)
+            for path in folded:
+                path.unlink(missing_ok=True)
+
+
+def flush() -> None:
+    """Stand dieses Prozesses nach METRICS_MULTIPROC_DIR schreiben (atomar), Dateien beendeter Worker übernehmen."""
+    if not METRICS_MULTIPROC_DIR or _retired:
+        return
+    directory = Path(METRICS_MULTIPROC_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    _write(_own_file(directory), _snapshot_all())
+    _fold(directory, [path for path, alive in _worker_files(directory) if not alive])
+
+
+def _merged() -> dict[str, dict]:
+    """Summe über alle Worker-Dateien und aggregate.json; der eigene Prozess mit dem aktuellen Stand."""
+    directory = Path(METRICS_MULTIPROC_DIR)
+    with _lock:
+        merged: dict[str, dict] = {name: {} for name in _registry}
+    if not _retired:
+        _merge_into(merged, _snapshot_all(), gauges=True)
+    if not directory.is_dir():
+        return merged
+    with _dir_lock(directory, exclusive=False):
+        for path, alive in _worker_files(directory):
+            snap = _read(path)
+            if snap is not None:
+                _merge_into(merged, snap, gauges=alive)
+        aggregate = _read(directory / _AGGREGATE)
+        if aggregate is not None:
+            _merge_into(merged, aggregate, gauges=False)
+    return merged
+
+
+_flusher: threading.Thread | None = None
+_flusher_stop = threading.Event()
+
+
+def start_flusher() -> None:
+    """Periodisches flush() im Hintergrund (nur mit METRICS_MULTIPROC_DIR)."""
+    global _flusher
+    if not METRICS_MULTIPROC_DIR or _flusher is not None:
+        return
+    _flusher_stop.clear()
+
+    def loop():
+        while not _flusher_stop.wait(METRICS_FLUSH_INTERVAL):
+            flush()
+
+    flush()
+    _flusher = threading.Thread(target=loop, name="metrics-flush", daemon=True)
+    _flusher.start()
+
+
+def stop_flusher() -> None:
+    """Beim Beenden des Workers: letzter Stand nach aggregate.json, eigene Datei löschen."""
+    global _flusher, _retired
+    if _flusher is None:
+        return
+    _flusher_stop.set()
+    _flusher.join(timeout=5)
+    _flusher = None
+    flush()
+    directory = Path(METRICS_MULTIPROC_DIR)
+    _fold(directory, [_own_file(directory)])
+    _retired = True
+
+
+def render() -> str:
+    """Prometheus text exposition format (text/plain; version=0.0.4), über alle Worker summiert."""
+    snaps = _merged() if METRICS_MULTIPROC_DIR else _snapshot_all()
+    lines: list[str] = []
+    with _lock:
+        metrics = list(_registry.values())
+    for m in metrics:
+        lines.append(f"# HELP {m.name} {m.help}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        lines.extend(m._render(snaps.get(m.name, {})))
+    return "\n".join(lines) + "\n"
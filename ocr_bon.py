@@ -1,47 +1,201 @@
 import os
+import io
+import re
+import hashlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from typing import Literal
 
 import google.generativeai as genai
 from PIL import Image
+from PyPDF2 import PdfReader, PdfWriter
 
-# Gemini API Key aus ENV
+import gemini_cassette
+from llm_usage import record_usage
+from metrics import Counter
+from shared_cache import SharedCache
+
+# Gemini API Key aus ENV (im Replay-Modus nicht nötig)
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
+if not GEMINI_API_KEY and not gemini_cassette.replaying():
     raise RuntimeError("Missing GEMINI_API_KEY or GOOGLE_API_KEY environment variable")
 
-genai.configure(api_key=GEMINI_API_KEY)
+if GEMINI_API_KEY:
+    genai.configure(api_key=GEMINI_API_KEY)
 
 MODEL_NAME = "gemini-2.5-flash"
 
+# Mehrseitige PDFs seitenweise und parallel OCRen ("auto") oder als Ganzes ("off")
+OCR_PDF_PAGE_MODE = os.getenv("OCR_PDF_PAGE_MODE", "auto").strip().lower()
+# ab wie vielen Seiten gesplittet wird: normale 2-3-seitige Bons bleiben ein einziger Call
+OCR_PDF_SPLIT_MIN_PAGES = int(os.getenv("OCR_PDF_SPLIT_MIN_PAGES", "4"))
+# max. gleichzeitige Gemini-Calls pro PDF
+OCR_PAGE_CONCURRENCY = int(os.getenv("OCR_PAGE_CONCURRENCY", "4"))
 
-def ocr_bon(path: str) -> str:
-    """
-    Macht OCR auf einem Bon – egal ob JPG/PNG oder PDF.
-    Gibt reinen Text zurück (kein JSON, keine Interpretation).
-    """
-    model = genai.GenerativeModel(MODEL_NAME)
+OCR_PDF_PAGES = Counter("ocr_pdf_pages_total", "PDF pages seen by page-level OCR", ["result"])
 
-    prompt = """
+PROMPT = """
     Lies den Text dieses Restaurantbelegs so gut wie möglich aus.
     Gib NUR den erkannten Text zurück, ohne zusätzliche Kommentare,
     Erklärungen oder JSON. Zeilenumbrüche bitte beibehalten.
     """
 
+
+# -----------------------------
+# Seiten-Klassifikation (ohne OCR, nur Text-Layer / Ressourcen)
+# -----------------------------
+_BOILERPLATE = re.compile(
+    r"(allgemeine\s+gesch(ä|ae)ftsbedingungen|\bagb\b|terms\s+(and|&)\s+conditions|"
+    r"datenschutz|privacy\s+policy|widerruf|stornobedingungen|cancellation\s+policy|haftung)",
+    re.I,
+)
+_AMOUNT = re.compile(r"(summe|gesamt|total|zu\s+zahlen|betrag|saldo|balance|mwst|vat)|\d+[.,]\d{2}\s*(€|eur)", re.I)
+
+
+def _resolve(obj):
+    return obj.get_object() if hasattr(obj, "get_object") else obj
+
+
+def _has_xobjects(page) -> bool:
+    resources = _resolve(page.get("/Resources")) or {}
+    xobjects = _resolve(resources.get("/XObject")) if hasattr(resources, "get") else None
+    return bool(xobjects)
+
+
+def classify_pdf_page(page, page_no: int) -> str:
+    """
+    "ocr" | "blank" | "boilerplate". Seite 1 wird immer geOCRt.
+    Blank = kein Text-Layer, keine Bilder/Formulare, (fast) leerer Content-Stream.
+    Boilerplate = langer Text-Layer mit AGB-/Datenschutz-Stichworten und ohne Beträge.
+    """
+    if page_no == 0:
+        return "ocr"
+    try:
+        text = (page.extract_text() or "").strip()
+        if not text and not _has_xobjects(page):
+            contents = page.get_contents()
+            data = contents.get_data() if contents is not None else b""
+            if len(data.strip()) < 64:
+                return "blank"
+    except Exception:
+        # kaputte Ressourcen/Streams: lieber lesen als still verwerfen
+        return "ocr"
+
+    if len(text) > 800 and _BOILERPLATE.search(text) and not _AMOUNT.search(text):
+        return "boilerplate"
+    return "ocr"
+
+
+def _ocr_pdf_page(page_pdf: bytes, tenant_key: str) -> str:
+    response = gemini_cassette.generate_content(
+        MODEL_NAME, [PROMPT, {"mime_type": "application/pdf", "data": page_pdf}], tenant_key=tenant_key
+    )
+    record_usage(response, tenant_key, stage="ocr", kind="pdf_page")
+    return response.text
+
+
+def ocr_pdf_pages(path: str, tenant_key: str = "default", concurrency: int | None = None) -> str | None:
+    """
+    Splittet ein mehrseitiges PDF in Einzelseiten, überspringt leere / reine AGB-Seiten
+    und OCRt die übrigen parallel (max. `concurrency` gleichzeitig).
+    Text wird in Seitenreihenfolge wieder zusammengesetzt, im selben Format wie beim
+    Ein-Call-Pfad (Absätze, keine Seiten-Header).
+    Returns None, wenn das PDF zu wenige Seiten hat oder sich nicht sauber splitten
+    lässt (dann normaler Ein-Call-Pfad).
+    """
+    try:
+        reader = PdfReader(path)
+        n_pages = len(reader.pages)
+        if n_pages < max(2, OCR_PDF_SPLIT_MIN_PAGES):
+            return None
+
+        results: list[str] = []
+        jobs: list[tuple[int, bytes]] = []
+        for i, page in enumerate(reader.pages):
+            result = classify_pdf_page(page, i)
+            results.append(result)
+            if result != "ocr":
+                continue
+            writer = PdfWriter()
+            writer.add_page(page)
+            buf = io.BytesIO()
+            writer.write(buf)
+            jobs.append((i, buf.getvalue()))
+    except Exception:
+        # beschädigtes PDF: Gemini bekommt es als Ganzes
+        OCR_PDF_PAGES.inc(result="split_failed")
+        return None
+    for result in results:
+        OCR_PDF_PAGES.inc(result=result)
+
+    workers = max(1, min(concurrency or OCR_PAGE_CONCURRENCY, len(jobs)))
+    # Kontext (Request-ID, LLM-Priorität) in die Worker-Threads mitnehmen
+    contexts = [contextvars.copy_context() for _ in jobs]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr-page") as pool:
+        texts = list(pool.map(
+            lambda job, ctx: ctx.run(_ocr_pdf_page, job[1], tenant_key), jobs, contexts
+        ))
+
+    return "\n\n".join(text.strip() for text in texts)
+
+
+# OCR-Ergebnisse pro Datei-Inhalt, über alle Worker geteilt (0 = aus)
+OCR_CACHE_TTL = float(os.getenv("OCR_CACHE_TTL", str(7 * 24 * 3600)))
+_ocr_cache = SharedCache("ocr", ttl=OCR_CACHE_TTL, l1_ttl=600, l1_size=64)
+
+
+def _ocr_cache_key(path: str, sha256: str | None) -> str:
+    if sha256 is None:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(64 * 1024):
+                digest.update(chunk)
+        sha256 = digest.hexdigest()
+    variant = hashlib.sha256(
+        f"{MODEL_NAME}|{OCR_PDF_PAGE_MODE}|{OCR_PDF_SPLIT_MIN_PAGES}|{PROMPT}".encode()
+    ).hexdigest()[:12]
+    return f"{sha256}:{variant}"
+
+
+def ocr_bon(path: str, tenant_key: str = "default", sha256: str | None = None) -> str:
+    """
+    Macht OCR auf einem Bon – egal ob JPG/PNG oder PDF.
+    Gibt reinen Text zurück (kein JSON, keine Interpretation).
+    Token-Verbrauch wird dem tenant_key (Stage "ocr") zugerechnet.
+    Mehrseitige PDFs werden (OCR_PDF_PAGE_MODE=auto) seitenweise parallel gelesen.
+    Gleicher Datei-Inhalt (sha256, falls schon bekannt) kommt aus dem geteilten OCR-Cache.
+    """
+    # beim Aufnehmen von Cassettes immer die API fragen
+    if not _ocr_cache.enabled or gemini_cassette.recording():
+        return _ocr_bon_uncached(path, tenant_key)
+    key = _ocr_cache_key(path, sha256)
+    return _ocr_cache.get_or_compute(key, lambda: _ocr_bon_uncached(path, tenant_key))
+
+
+def _ocr_bon_uncached(path: str, tenant_key: str) -> str:
+    prompt = PROMPT
+
     ext = os.path.splitext(path)[1].lower()
 
+    if ext == ".pdf" and OCR_PDF_PAGE_MODE == "auto":
+        text = ocr_pdf_pages(path, tenant_key=tenant_key)
+        if text is not None:
+            return text
+
     if ext in [".jpg", ".jpeg", ".png"]:
         # Bild direkt laden
         img = Image.open(path).convert("RGB")
-        response = model.generate_content([prompt, img])
+        response = gemini_cassette.generate_content(MODEL_NAME, [prompt, img], tenant_key=tenant_key)
 
     elif ext == ".pdf":
         # PDF als Datei an Gemini schicken
-        file = genai.upload_file(path=path)
-        response = model.generate_content([prompt, file])
+        file = gemini_cassette.upload_file(path, tenant_key=tenant_key)
+        response = gemini_cassette.generate_content(MODEL_NAME, [prompt, file], tenant_key=tenant_key)
 
     else:
         raise ValueError(f"Ungültiger Dateityp für OCR: {ext}")
 
+    record_usage(response, tenant_key, stage="ocr", kind=ext.lstrip("."))
     return response.text
 
 
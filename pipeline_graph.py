@@ -0,0 +1,285 @@
+# pipeline_graph.py
+"""
+Kleiner Abhängigkeitsgraph für Pipeline-Stages: unabhängige Stages laufen
+gleichzeitig (sync-Funktionen im Thread-Pool), jede Stage hat ein eigenes
+Timeout, pro Lauf werden Stage-Zeiten und der kritische Pfad ermittelt.
+
+Ein Thread lässt sich nicht von außen stoppen: nach einem Timeout läuft eine
+sync-Stage weiter, bis sie selbst aufhört. Deshalb bekommt jede Stage ihre
+Deadline und das Abbruch-Signal des Laufs als ContextVar mit; lange Aufrufe
+(Gemini, LibreOffice) begrenzen sich über remaining() / check_cancelled().
+Aufräumen, das Dateien laufender Stages löscht, läuft über
+PipelineRun.call_when_idle() erst, wenn alle Stage-Threads beendet sind.
+"""
+import os
+import time
+import asyncio
+import inspect
+import functools
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from metrics import Histogram
+
+# Threads für sync-Stages: eigener Pool statt des kleinen asyncio-Default-Executors
+PIPELINE_STAGE_THREADS = int(os.getenv("PIPELINE_STAGE_THREADS", "64"))
+# Stages mit pool="llm" (warten im LLM-Scheduler): eigener, begrenzter Pool, damit
+# wartende Gemini-Calls nie die Threads der übrigen Stages belegen
+PIPELINE_LLM_THREADS = int(os.getenv("PIPELINE_LLM_THREADS", "32"))
+
+STAGE_SECONDS = Histogram("pipeline_stage_seconds", "Duration of pipeline stages", ["stage"])
+
+_stage_pool = ThreadPoolExecutor(max_workers=PIPELINE_STAGE_THREADS, thread_name_prefix="stage")
+_llm_pool = ThreadPoolExecutor(max_workers=PIPELINE_LLM_THREADS, thread_name_prefix="stage-llm")
+_POOLS = {"stage": _stage_pool, "llm": _llm_pool}
+
+
+@dataclass
+class Stage:
+    name: str
+    fn: Callable[..., Any]
+    # Namen der Stages (oder Inputs), deren Ergebnisse fn als Keyword-Argumente bekommt
+    deps: tuple[str, ...] = ()
+    timeout: float | None = None
+    # Thread-Pool für sync-fn: "stage" oder "llm"
+    pool: str = "stage"
+    # optionale Stage: bei Fehler/Timeout liefert on_error(exc) das Ergebnis, statt den Lauf abzubrechen
+    on_error: Callable[[Exception], Any] | None = None
+
+
+class StageTimeout(RuntimeError):
+    def __init__(self, stage: str, timeout: float):
+        super().__init__(f"Stage '{stage}' timed out after {timeout:g}s")
+        self.stage = stage
+        self.timeout = timeout
+
+
+class StageCancelled(RuntimeError):
+    """Eine Stage hat bemerkt, dass ihre Deadline abgelaufen oder der Lauf abgebrochen ist."""
+
+
+# -----------------------------
+# Deadline / Abbruch für Stage-Code
+# -----------------------------
+@dataclass
+class _Deadline:
+    expires: float | None                 # time.monotonic()
+    cancelled: threading.Event
+
+
+_deadline: ContextVar[_Deadline | None] = ContextVar("stage_deadline", default=None)
+
+
+def remaining(cap: float | None = None) -> float | None:
+    """
+    Restzeit der aktuellen Stage in Sekunden, höchstens `cap` (0 nach Abbruch).
+    Außerhalb einer Stage oder ohne Stage-Timeout: `cap`.
+    """
+    d = _deadline.get()
+    if d is None:
+        return cap
+    if d.cancelled.is_set():
+        return 0.0
+    if d.expires is None:
+        return cap
+    left = max(0.0, d.expires - time.monotonic())
+    return left if cap is None else min(left, cap)
+
+
+def cancelled() -> bool:
+    d = _deadline.get()
+    if d is None:
+        return False
+    return d.cancelled.is_set() or (d.expires is not None and time.monotonic() >= d.expires)
+
+
+def check_cancelled() -> None:
+    if cancelled():
+        raise StageCancelled("Stage deadline exceeded or pipeline aborted")
+
+
+class PipelineRun:
+    """Abbruch-Signal und laufende Stage-Threads eines Graph-Laufs."""
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self._threads: set[Future] = set()
+        self._on_idle: list[tuple[Callable, tuple]] = []
+        self._lock = threading.Lock()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def _track(self, fut: Future) -> None:
+        with self._lock:
+            self._threads.add(fut)
+        fut.add_done_callback(self._untrack)
+
+    def _untrack(self, fut: Future) -> None:
+        with self._lock:
+            self._threads.discard(fut)
+            if self._threads:
+                return
+            callbacks, self._on_idle = self._on_idle, []
+        for fn, args in callbacks:
+            fn(*args)
+
+    def call_when_idle(self, fn: Callable, *args) -> None:
+        """fn(*args) sofort, oder sobald der letzte noch laufende Stage-Thread fertig ist."""
+        with self._lock:
+            if self._threads:
+                self._on_idle.append((fn, args))
+                return
+        fn(*args)
+
+
+@dataclass
+class StageTiming:
+    start: float
+    end: float
+    deps: tuple[str, ...] = ()
+
+    @property
+    def seconds(self) -> float:
+        return self.end - self.start
+
+
+@dataclass
+class GraphResult:
+    results: dict[str, Any]
+    timings: dict[str, StageTiming]
+    critical_path: list[str] = field(default_factory=list)
+    total_seconds: float = 0.0
+
+    def server_timing(self) -> str:
+        """Wert für den Server-Timing-Header (ms pro Stage)."""
+        return ", ".join(f"{name};dur={t.seconds * 1000:.1f}" for name, t in self.timings.items())
+
+
+def _validate(stages: list[Stage], inputs: dict) -> None:
+    names = [s.name for s in stages]
+    if len(set(names)) != len(names):
+        raise ValueError("Duplicate stage names")
+    for s in stages:
+        if s.pool not in _POOLS:
+            raise ValueError(f"Stage '{s.name}' has unknown pool '{s.pool}'")
+    known = set(names) | set(inputs)
+    for s in stages:
+        missing = [d for d in s.deps if d not in known]
+        if missing:
+            raise ValueError(f"Stage '{s.name}' depends on unknown {missing}")
+
+    # Zyklen erkennen (Kahn)
+    indeg = {s.name: sum(1 for d in s.deps if d not in inputs) for s in stages}
+    children: dict[str, list[str]] = {n: [] for n in names}
+    for s in stages:
+        for d in s.deps:
+            if d not in inputs:
+                children[d].append(s.name)
+    ready = [n for n, k in indeg.items() if k == 0]
+    seen = 0
+    while ready:
+        n = ready.pop()
+        seen += 1
+        for c in children[n]:
+            indeg[c] -= 1
+            if indeg[c] == 0:
+                ready.append(c)
+    if seen != len(names):
+        raise ValueError("Stage graph has a cycle")
+
+
+def critical_path(timings: dict[str, StageTiming]) -> list[str]:
+    """Von der zuletzt fertigen Stage rückwärts jeweils die zuletzt fertige Abhängigkeit."""
+    if not timings:
+        return []
+    current = max(timings, key=lambda n: timings[n].end)
+    path = [current]
+    while True:
+        deps = [d for d in timings[current].deps if d in timings]
+        if not deps:
+            break
+        current = max(deps, key=lambda d: timings[d].end)
+        path.append(current)
+    return list(reversed(path))
+
+
+async def run_graph(
+    stages: list[Stage],
+    inputs: dict | None = None,
+    run: PipelineRun | None = None,
+) -> GraphResult:
+    """
+    Führt alle Stages aus, sobald ihre Abhängigkeiten fertig sind.
+    Schlägt eine Stage fehl (oder läuft in ihr Timeout), werden die übrigen
+    abgebrochen (run.cancel() für schon laufende Threads) und der Fehler weitergereicht.
+    """
+    run = run or PipelineRun()
+    inputs = dict(inputs or {})
+    _validate(stages, inputs)
+
+    loop = asyncio.get_running_loop()
+    futures: dict[str, asyncio.Future] = {}
+    for name, value in inputs.items():
+        fut = loop.create_future()
+        fut.set_result(value)
+        futures[name] = fut
+    for s in stages:
+        futures[s.name] = loop.create_future()
+
+    timings: dict[str, StageTiming] = {}
+    t0 = time.perf_counter()
+
+    async def run_stage(s: Stage) -> None:
+        kwargs = {d: await futures[d] for d in s.deps}
+        start = time.perf_counter()
+        if inspect.iscoroutinefunction(s.fn):
+            coro = s.fn(**kwargs)
+        else:
+            # ContextVars (Request-ID fürs Logging, Deadline) in den Thread mitnehmen
+            ctx = contextvars.copy_context()
+            expires = time.monotonic() + s.timeout if s.timeout else None
+            ctx.run(_deadline.set, _Deadline(expires, run.cancelled))
+            cf = _POOLS[s.pool].submit(ctx.run, functools.partial(s.fn, **kwargs))
+            run._track(cf)
+            # Abbruch des asyncio-Futures storniert noch nicht gestartete Stages im Pool
+            coro = asyncio.wrap_future(cf)
+        try:
+            try:
+                result = await asyncio.wait_for(coro, s.timeout) if s.timeout else await coro
+            except asyncio.TimeoutError:
+                raise StageTimeout(s.name, s.timeout) from None
+        except Exception as exc:
+            if s.on_error is None:
+                raise
+            # der Stage-Thread läuft ggf. weiter (bis zu seiner Deadline); call_when_idle wartet auf ihn
+            result = s.on_error(exc)
+        end = time.perf_counter()
+        timings[s.name] = StageTiming(start=start - t0, end=end - t0, deps=s.deps)
+        STAGE_SECONDS.observe(end - start, stage=s.name)
+        futures[s.name].set_result(result)
+
+    tasks = [asyncio.create_task(run_stage(s), name=f"stage:{s.name}") for s in stages]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        run.cancel()
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for fut in futures.values():
+            if not fut.done():
+                fut.cancel()
+        raise
+
+    ordered = dict(sorted(timings.items(), key=lambda kv: kv[1].start))
+    return GraphResult(
+        results={s.name: futures[s.name].result() for s in stages},
+        timings=ordered,
+        critical_path=critical_path(ordered),
+        total_seconds=time.perf_counter() - t0,
+    )
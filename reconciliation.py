@@ -0,0 +1,397 @@
+# reconciliation.py
+"""
+Abgleich archivierter Belege mit Bank-/Kartenumsätzen.
+
+- CSV-Import (DKB, Sparkasse, Kreditkarten-Exporte, ...): Trennzeichen, Encoding,
+  Vorspann-Zeilen und Spaltennamen werden erkannt; erneuter Import desselben
+  Exports legt keine Duplikate an
+- Umsätze liegen in SQLite, indiziert nach (Tenant, Betrag, Datum); der Import liest
+  die (hochgeladene) Datei zeilenweise
+- Matching: pro Beleg werden betrag (inkl. Trinkgeld), betrag_rechnung und
+  betrag_rechnung + trinkgeld gegen die nach Betrag sortierten Umsätze gesucht
+  (bisect auf das Betragsintervall, dann Datumsfenster); jeder Umsatz wird
+  höchstens einem Beleg zugeordnet
+- Metrik: nur Statuswechsel eines Belegs (nicht jeder Abruf des Berichts)
+"""
+import os
+import csv
+import codecs
+import hashlib
+import sqlite3
+import threading
+from bisect import bisect_left, bisect_right
+from collections import Counter as TupleCounter
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict, field
+from datetime import date, datetime, timedelta, timezone
+from itertools import chain, islice
+from pathlib import Path
+from typing import Iterable
+
+import beleg_archive
+from amounts import parse_eur_amount
+from metrics import Counter
+
+# -----------------------------
+# Konfiguration (ENV)
+# -----------------------------
+RECON_DB_PATH = Path(os.getenv("RECON_DB_PATH", str(beleg_archive.ARCHIVE_DIR / "transactions.sqlite3")))
+# Karten-Umsätze werden oft erst Tage später gebucht
+RECON_DATE_WINDOW_DAYS = int(os.getenv("RECON_DATE_WINDOW_DAYS", "5"))
+RECON_AMOUNT_TOLERANCE_CENTS = int(os.getenv("RECON_AMOUNT_TOLERANCE_CENTS", "1"))
+
+RECON_RESULTS = Counter(
+    "reconciliation_belege_total", "Belege whose reconciliation status changed, by new status", ["result"]
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    tx_id         TEXT PRIMARY KEY,
+    tenant        TEXT NOT NULL,
+    booking_date  TEXT NOT NULL,       -- ISO YYYY-MM-DD
+    amount_cents  INTEGER NOT NULL,    -- Betrag der Zahlung, positiv
+    description   TEXT,
+    imported_at   TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_tenant_amount_date ON transactions (tenant, amount_cents, booking_date);
+-- letzter Abgleich-Status pro Beleg (für die Metrik: nur Wechsel zählen)
+CREATE TABLE IF NOT EXISTS beleg_status (
+    beleg_id    TEXT PRIMARY KEY,
+    tenant      TEXT NOT NULL,
+    status      TEXT NOT NULL,
+    updated_at  TEXT NOT NULL
+);
+"""
+
+_DATE_COLUMNS = ("buchungstag", "buchungsdatum", "belegdatum", "transaktionsdatum", "umsatzdatum",
+                 "datum", "date", "booking date", "wertstellung", "valutadatum", "valuta")
+_AMOUNT_COLUMNS = ("betrag", "betrag (eur)", "betrag (€)", "umsatz", "umsatz in eur", "amount", "betrag eur")
+_TEXT_COLUMNS = ("verwendungszweck", "buchungstext", "beschreibung", "beguenstigter/zahlungspflichtiger",
+                 "begünstigter/zahlungspflichtiger", "zahlungsempfänger*in", "empfänger", "name", "description",
+                 "händler", "payee")
+
+_init_lock = threading.Lock()
+_initialized: set[Path] = set()
+
+
+@contextmanager
+def _connect():
+    path = RECON_DB_PATH
+    with _init_lock:
+        if path not in _initialized:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(path)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_SCHEMA)
+            finally:
+                conn.close()
+            _initialized.add(path)
+
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# -----------------------------
+# CSV-Import
+# -----------------------------
+class BankCsvError(ValueError):
+    pass
+
+
+@dataclass
+class ImportResult:
+    imported: int = 0
+    duplicates: int = 0
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def _decode(raw: bytes) -> str:
+    for encoding in ("utf-8-sig", "cp1252"):
+        try:
+            return raw.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return raw.decode("latin-1")
+
+
+def _file_encoding(path: Path) -> str:
+    """Wie _decode, aber chunkweise geprüft (die Datei wird nicht als Ganzes geladen)."""
+    for encoding in ("utf-8-sig", "cp1252"):
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            with open(path, "rb") as f:
+                while chunk := f.read(64 * 1024):
+                    decoder.decode(chunk)
+            decoder.decode(b"", final=True)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return "latin-1"
+
+
+def _find_column(header: list[str], names: tuple[str, ...]) -> int | None:
+    normalized = [h.strip().strip('"').lower() for h in header]
+    for name in names:
+        if name in normalized:
+            return normalized.index(name)
+    return None
+
+
+def _parse_date(value: str) -> date | None:
+    value = value.strip()
+    for fmt in ("%d.%m.%Y", "%d.%m.%y", "%Y-%m-%d", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_signed_cents(value: str) -> int | None:
+    amount = parse_eur_amount(value)
+    if amount is None:
+        return None
+    cents = int(amount * 100)
+    return -cents if value.strip().startswith("-") else cents
+
+
+def parse_bank_csv(source: bytes | str | Path) -> list[tuple[date, int, str]]:
+    """
+    Returns [(Buchungsdatum, Betrag in Cent > 0, Text)] der Zahlungen (Belastungen).
+    source: Inhalt (bytes) oder Pfad der CSV-Datei (wird zeilenweise gelesen).
+    """
+    if isinstance(source, bytes):
+        return _parse_lines(_decode(source).splitlines())
+    path = Path(source)
+    with open(path, encoding=_file_encoding(path), newline="") as f:
+        return _parse_lines(line.rstrip("\r\n") for line in f)
+
+
+def _parse_lines(lines: Iterable[str]) -> list[tuple[date, int, str]]:
+    lines = iter(lines)
+    head = list(islice(lines, 50))
+    sample = "\n".join(head)
+    delimiter = ";" if sample.count(";") >= sample.count(",") else ","
+
+    rows = csv.reader(chain(head, lines), delimiter=delimiter)
+    for header in rows:
+        date_col = _find_column(header, _DATE_COLUMNS)
+        amount_col = _find_column(header, _AMOUNT_COLUMNS)
+        if date_col is not None and amount_col is not None:
+            break
+    else:
+        raise BankCsvError("No header with a date and an amount column found")
+    text_cols = [i for i, h in enumerate(header) if h.strip().strip('"').lower() in _TEXT_COLUMNS]
+
+    parsed = []
+    for row in rows:
+        if len(row) <= max(date_col, amount_col):
+            continue
+        booked = _parse_date(row[date_col])
+        cents = _parse_signed_cents(row[amount_col])
+        if booked is None or cents is None or cents == 0:
+            continue
+        parsed.append((booked, cents, " | ".join(row[i].strip() for i in text_cols if i < len(row) and row[i].strip())))
+
+    # Girokonto-Exporte: Zahlungen negativ, Gutschriften ignorieren; Kreditkarten-Exporte ohne Vorzeichen
+    if any(cents < 0 for _, cents, _ in parsed):
+        return [(d, -c, t) for d, c, t in parsed if c < 0]
+    return parsed
+
+
+def import_transactions(tenant_key: str, source: bytes | str | Path) -> ImportResult:
+    tenant = (tenant_key or "default").strip().lower()
+    result = ImportResult()
+    now = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    seen: TupleCounter = TupleCounter()
+    records = []
+    for booked, cents, text in parse_bank_csv(source):
+        # gleiche Buchung mehrfach am selben Tag bleibt erhalten, derselbe Export doppelt nicht
+        key = (booked, cents, text)
+        seen[key] += 1
+        tx_id = hashlib.sha256(f"{tenant}|{booked}|{cents}|{text}|{seen[key]}".encode()).hexdigest()[:32]
+        records.append((tx_id, tenant, booked.isoformat(), cents, text, now))
+
+    with _connect() as conn:
+        before = conn.total_changes
+        conn.executemany("INSERT OR IGNORE INTO transactions VALUES (?, ?, ?, ?, ?, ?)", records)
+        result.imported = conn.total_changes - before
+    result.duplicates = len(records) - result.imported
+    return result
+
+
+# -----------------------------
+# Matching
+# -----------------------------
+@dataclass
+class TransactionIndex:
+    """Umsätze sortiert nach (Betrag, Datum); Suche per bisect auf das Betragsintervall."""
+    amounts: list[int] = field(default_factory=list)
+    dates: list[int] = field(default_factory=list)          # date.toordinal()
+    tx_ids: list[str] = field(default_factory=list)
+    descriptions: list[str] = field(default_factory=list)
+
+    def candidates(self, cents: int, day: int, tolerance: int, window: int) -> list[int]:
+        lo = bisect_left(self.amounts, cents - tolerance)
+        hi = bisect_right(self.amounts, cents + tolerance)
+        return [i for i in range(lo, hi) if abs(self.dates[i] - day) <= window]
+
+
+def load_index(tenant_key: str, date_from: date, date_to: date) -> TransactionIndex:
+    index = TransactionIndex()
+    with _connect() as conn:
+        rows = conn.execute(
+            "SELECT amount_cents, booking_date, tx_id, description FROM transactions "
+            "WHERE tenant = ? AND booking_date BETWEEN ? AND ? ORDER BY amount_cents, booking_date",
+            ((tenant_key or "default").strip().lower(), date_from.isoformat(), date_to.isoformat()),
+        )
+        for cents, booked, tx_id, text in rows:
+            index.amounts.append(cents)
+            index.dates.append(date.fromisoformat(booked).toordinal())
+            index.tx_ids.append(tx_id)
+            index.descriptions.append(text or "")
+    return index
+
+
+# Reihenfolge = Priorität, wenn mehrere Beträge eines Belegs denselben Umsatz treffen
+_AMOUNT_FIELDS = ("betrag", "betrag_rechnung", "betrag_rechnung_plus_trinkgeld")
+
+
+def _beleg_amounts(b: beleg_archive.ArchivedBeleg) -> dict[str, int]:
+    amounts = {}
+    if b.betrag_cents:
+        amounts["betrag"] = b.betrag_cents
+    if b.betrag_rechnung_cents:
+        amounts["betrag_rechnung"] = b.betrag_rechnung_cents
+        if b.trinkgeld_cents:
+            amounts["betrag_rechnung_plus_trinkgeld"] = b.betrag_rechnung_cents + b.trinkgeld_cents
+    return amounts
+
+
+@dataclass
+class BelegMatch:
+    beleg_id: str
+    bewirtungsdatum: str | None
+    restaurant: str | None
+    betrag: str | None
+    status: str                                   # matched | ambiguous | unmatched
+    matched_field: str | None = None
+    tx_id: str | None = None
+    booking_date: str | None = None
+    transaction_text: str | None = None
+    amount_diff_cents: int | None = None
+    day_diff: int | None = None
+    candidate_tx_ids: list[str] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def match_belege(
+    belege: list[beleg_archive.ArchivedBeleg],
+    index: TransactionIndex,
+    tolerance_cents: int = RECON_AMOUNT_TOLERANCE_CENTS,
+    window_days: int = RECON_DATE_WINDOW_DAYS,
+) -> list[BelegMatch]:
+    """
+    Pro Beleg die Kandidaten (Umsatz, Betragsfeld) mit Score (Betragsabweichung, Tage, Feld-Priorität).
+    Belege mit den wenigsten Kandidaten werden zuerst zugeordnet; ein Umsatz gehört höchstens einem Beleg.
+    Gleich gute Kandidaten (verschiedene Umsätze) -> ambiguous.
+    """
+    scored: list[tuple[beleg_archive.ArchivedBeleg, list[tuple[tuple, int, str]]]] = []
+    for b in belege:
+        cands = []
+        if b.bewirtungsdatum:
+            day = date.fromisoformat(b.bewirtungsdatum).toordinal()
+            for fname, cents in _beleg_amounts(b).items():
+                for i in index.candidates(cents, day, tolerance_cents, window_days):
+                    score = (abs(index.amounts[i] - cents), abs(index.dates[i] - day), _AMOUNT_FIELDS.index(fname))
+                    cands.append((score, i, fname))
+        cands.sort()
+        scored.append((b, cands))
+
+    claimed: set[int] = set()
+    results: dict[str, BelegMatch] = {}
+    for b, cands in sorted(scored, key=lambda bc: len({i for _, i, _ in bc[1]})):
+        match = BelegMatch(
+            beleg_id=b.beleg_id, bewirtungsdatum=b.bewirtungsdatum, restaurant=b.restaurant,
+            betrag=b.betrag, status="unmatched",
+        )
+        free = [c for c in cands if c[1] not in claimed]
+        if cands and not free:
+            # alle passenden Umsätze sind schon anderen Belegen zugeordnet
+            match.status = "ambiguous"
+            match.candidate_tx_ids = sorted({index.tx_ids[i] for _, i, _ in cands})
+        elif free:
+            best_score = free[0][0][:2]
+            best = {i for score, i, _ in free if score[:2] == best_score}
+            if len(best) > 1:
+                match.status = "ambiguous"
+                match.candidate_tx_ids = sorted(index.tx_ids[i] for i in best)
+            else:
+                score, i, fname = free[0]
+                claimed.add(i)
+                match.status = "matched"
+                match.matched_field = fname
+                match.tx_id = index.tx_ids[i]
+                match.booking_date = date.fromordinal(index.dates[i]).isoformat()
+                match.transaction_text = index.descriptions[i]
+                match.amount_diff_cents = score[0]
+                match.day_diff = index.dates[i] - date.fromisoformat(b.bewirtungsdatum).toordinal()
+        results[b.beleg_id] = match
+
+    return [results[b.beleg_id] for b in belege]
+
+
+def _record_status(tenant_key: str, matches: list[BelegMatch]) -> None:
+    """Status pro Beleg speichern; die Metrik zählt nur neue Belege und Statuswechsel."""
+    tenant = (tenant_key or "default").strip().lower()
+    now = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    with _connect() as conn:
+        for m in matches:
+            cur = conn.execute(
+                "INSERT INTO beleg_status (beleg_id, tenant, status, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (beleg_id) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at "
+                "WHERE beleg_status.status != excluded.status",
+                (m.beleg_id, tenant, m.status, now),
+            )
+            if cur.rowcount:
+                RECON_RESULTS.inc(result=m.status)
+
+
+def reconcile(
+    tenant_key: str,
+    date_from: date,
+    date_to: date,
+    tolerance_cents: int = RECON_AMOUNT_TOLERANCE_CENTS,
+    window_days: int = RECON_DATE_WINDOW_DAYS,
+    record: bool = False,
+) -> dict:
+    """
+    Abgleich aller archivierten Belege eines Zeitraums (nach bewirtungsdatum).
+    Nur mit record=True wird der Status pro Beleg gespeichert (beleg_status + Metrik);
+    ohne ist der Abgleich ein reiner Lesezugriff.
+    """
+    belege = list(beleg_archive.iter_belege(tenant_key, date_from, date_to))
+    index = load_index(tenant_key, date_from - timedelta(days=window_days), date_to + timedelta(days=window_days))
+    matches = match_belege(belege, index, tolerance_cents=tolerance_cents, window_days=window_days)
+    if record:
+        _record_status(tenant_key, matches)
+    by_status = {"matched": [], "ambiguous": [], "unmatched": []}
+    for m in matches:
+        by_status[m.status].append(m.to_dict())
+    return {
+        "tenant": (tenant_key or "default").strip().lower(),
+        "date_from": date_from.isoformat(),
+        "date_to": date_to.isoformat(),
+        "transactions": len(index.amounts),
+        "summary": {status: len(items) for status, items in by_status.items()},
+        **by_status,
+    }
@@ -0,0 +1,174 @@
+# replay_corpus.py
+"""
+Schickt einen Korpus echter Belege durch die komplette /full-agent-Pipeline –
+offline über Gemini-Cassettes (siehe gemini_cassette.py).
+
+Korpus-Layout:
+  corpus/<fall>/receipt.pdf|.jpg|.png
+  corpus/<fall>/email.txt
+  corpus/<fall>/tenant.txt        (optional, default "default")
+  corpus/<fall>/expected.json     (optional, Soll-Werte der Felder)
+
+Einmal aufnehmen (echte API, schreibt Cassettes + expected.json):
+  python replay_corpus.py corpus --mode record --update
+
+Danach offline als Regressionstest / Benchmark:
+  python replay_corpus.py corpus                       # Original-Latenz
+  python replay_corpus.py corpus --latency zero        # reiner Durchsatz ohne API-Wartezeit
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+from pathlib import Path
+
+# Felder, die sich pro Lauf ändern dürfen
+IGNORED_FIELDS = {"unterschriftsdatum", "signature_path"}
+
+
+def offline_tenant(key: str):
+    from tenant_store import Tenant
+
+    return Tenant(
+        tenant_key=(key or "default").strip().lower(),
+        display_name=None,
+        default_city="Berlin",
+        signature_png_b64=None,
+        reply_from_email=None,
+        template_key="default",
+    )
+
+
+def _parse_args(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("corpus", help="Korpus-Verzeichnis")
+    ap.add_argument("--mode", choices=["replay", "record"], default="replay")
+    ap.add_argument("--latency", choices=["original", "zero"], default="original")
+    ap.add_argument("--cassettes", default=os.getenv("GEMINI_CASSETTE_DIR", "cassettes"))
+    ap.add_argument("--update", action="store_true", help="expected.json aus dem aktuellen Ergebnis schreiben")
+    ap.add_argument("--json", action="store_true", help="Zusammenfassung als JSON ausgeben")
+    return ap.parse_args(argv)
+
+
+def iter_cases(corpus: Path):
+    for case in sorted(p for p in corpus.iterdir() if p.is_dir()):
+        receipts = [p for p in case.iterdir() if p.stem == "receipt"]
+        if not receipts:
+            continue
+        email = case / "email.txt"
+        tenant = case / "tenant.txt"
+        yield (
+            case,
+            receipts[0],
+            email.read_text(encoding="utf-8") if email.exists() else "",
+            tenant.read_text(encoding="utf-8").strip() if tenant.exists() else "default",
+        )
+
+
+def _diff(expected: dict, actual: dict) -> dict:
+    out = {}
+    for key, want in expected.items():
+        if key in IGNORED_FIELDS:
+            continue
+        got = actual.get(key)
+        if got != want:
+            out[key] = {"expected": want, "actual": got}
+    return out
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, round(q * (len(values) - 1))))
+    return values[idx]
+
+
+def main(argv=None) -> int:
+    args = _parse_args(argv)
+
+    # vor dem Import von service setzen: die Module lesen die Konfiguration beim Import
+    os.environ["GEMINI_CASSETTE_MODE"] = args.mode
+    os.environ["GEMINI_REPLAY_LATENCY"] = args.latency
+    os.environ["GEMINI_CASSETTE_DIR"] = args.cassettes
+    # jeder Lauf soll die Cassettes lesen, nicht den OCR-Cache eines früheren Laufs
+    os.environ.setdefault("OCR_CACHE_TTL", "0")
+
+    from fastapi.testclient import TestClient
+    import service
+
+    # Ohne Tenant-DB: lokaler Default-Tenant, damit der Lauf komplett offline bleibt
+    if not os.getenv("TENANT_DATABASE_URL"):
+        service.get_tenant = offline_tenant
+
+    # Endgültige bew_data abgreifen (Eingabe für das Formular)
+    captured: dict = {}
+    generate_form_pdf = service.generate_form_pdf
+
+    def _capture(bew_data: dict, *a, **kw):
+        captured["bew_data"] = dict(bew_data)
+        return generate_form_pdf(bew_data, *a, **kw)
+
+    service.generate_form_pdf = _capture
+
+    client = TestClient(service.app)
+    results = []
+    started_all = time.perf_counter()
+
+    for case, receipt, email_text, tenant_key in iter_cases(Path(args.corpus)):
+        captured.clear()
+        started = time.perf_counter()
+        with open(receipt, "rb") as f:
+            resp = client.post(
+                "/full-agent",
+                data={"email_text": email_text, "tenant_key": tenant_key},
+                files={"receipt": (receipt.name, f)},
+            )
+        elapsed = time.perf_counter() - started
+
+        result = {"case": case.name, "status": resp.status_code, "seconds": round(elapsed, 4)}
+        actual = {k: v for k, v in captured.get("bew_data", {}).items() if k not in IGNORED_FIELDS}
+        expected_path = case / "expected.json"
+
+        if resp.status_code != 200:
+            result["error"] = resp.text[:500]
+        elif args.update:
+            expected_path.write_text(json.dumps(actual, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+        elif expected_path.exists():
+            diff = _diff(json.loads(expected_path.read_text(encoding="utf-8")), actual)
+            if diff:
+                result["diff"] = diff
+        results.append(result)
+
+        if not args.json:
+            state = "ERR " if "error" in result else ("DIFF" if "diff" in result else "OK  ")
+            print(f"{state} {case.name:40s} {elapsed * 1000:8.1f} ms")
+            for key, d in result.get("diff", {}).items():
+                print(f"       {key}: {d['expected']!r} -> {d['actual']!r}")
+
+    wall = time.perf_counter() - started_all
+    seconds = [r["seconds"] for r in results]
+    summary = {
+        "cases": len(results),
+        "errors": sum(1 for r in results if "error" in r),
+        "diffs": sum(1 for r in results if "diff" in r),
+        "wall_seconds": round(wall, 3),
+        "throughput_per_s": round(len(results) / wall, 3) if wall > 0 else 0.0,
+        "p50_ms": round(statistics.median(seconds) * 1000, 1) if seconds else 0.0,
+        "p95_ms": round(percentile(seconds, 0.95) * 1000, 1),
+        "mode": args.mode,
+        "latency": args.latency,
+    }
+
+    if args.json:
+        print(json.dumps({"summary": summary, "results": results}, indent=2, ensure_ascii=False))
+    else:
+        print(json.dumps(summary, indent=2))
+
+    return 1 if summary["errors"] or summary["diffs"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
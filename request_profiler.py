@@ -0,0 +1,243 @@
+# request_profiler.py
+"""
+Opt-in-Profiling einzelner /full-agent-Requests.
+
+Aktiv, wenn
+- der Request `X-Profile: 1` und `X-Admin-Token: <PROFILE_ADMIN_TOKEN>` mitschickt, oder
+- der Tenant in PROFILE_TENANTS steht.
+
+Dann läuft cProfile mit und tracemalloc misst Peak und größte Allokationen:
+- bis Python 3.11 ein Profiler pro sync-Stage (Thread-lokal, Stats werden zusammengeführt)
+- ab Python 3.12 (cProfile über sys.monitoring, prozessweit) ein Profiler für den ganzen
+  Request; parallele Requests landen mit im Profil
+Pro Prozess läuft höchstens ein Profil: der tracemalloc-Peak ist prozessweit, ein zweites
+Profil würde ihn beim Start zurücksetzen. Trifft ein Trigger auf ein laufendes Profil,
+wird der Request nicht profiliert (request_profiles_skipped_total).
+Ergebnis:
+<PROFILE_DIR>/<profile_id>.prof (pstats, z.B. für snakeviz) und .json (Zusammenfassung).
+Ohne Trigger kostet das Modul nur den Header-/Tenant-Check.
+"""
+import os
+import io
+import json
+import sys
+import hmac
+import uuid
+import inspect
+import time
+import pstats
+import cProfile
+import functools
+import threading
+import tracemalloc
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+
+from metrics import Counter
+
+# -----------------------------
+# Konfiguration (ENV)
+# -----------------------------
+# ohne Token sind Header-Trigger und Admin-Endpoints abgeschaltet
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "").strip()
+PROFILE_TENANTS = {t.strip().lower() for t in os.getenv("PROFILE_TENANTS", "").split(",") if t.strip()}
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR", "profiles"))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "30"))
+
+PROFILES_WRITTEN = Counter("request_profiles_total", "Profiled requests", ["trigger"])
+PROFILES_SKIPPED = Counter("request_profiles_skipped_total", "Profile triggers skipped while another profile ran")
+
+_PROCESS_WIDE_CPROFILE = sys.version_info >= (3, 12)
+# gehalten von start_profile() bis RequestProfile.finish() (auch über Threads hinweg)
+_active = threading.Lock()
+
+
+def check_admin_token(token: str | None) -> bool:
+    return bool(PROFILE_ADMIN_TOKEN) and hmac.compare_digest((token or "").strip(), PROFILE_ADMIN_TOKEN)
+
+
+def profile_trigger(headers, tenant_key: str | None) -> str | None:
+    """'header' | 'tenant' | None (kein Profiling)."""
+    if headers.get("x-profile", "").strip() in ("1", "true", "on") and check_admin_token(headers.get("x-admin-token")):
+        return "header"
+    if PROFILE_TENANTS and (tenant_key or "default").strip().lower() in PROFILE_TENANTS:
+        return "tenant"
+    return None
+
+
+def _start_tracemalloc() -> bool:
+    """True, wenn tracemalloc für dieses Profil gestartet wurde (sonst lief es schon, z.B. PYTHONTRACEMALLOC)."""
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    return started
+
+
+def _stop_tracemalloc(started: bool) -> tuple[int, list[dict]]:
+    """Returns (Peak-Bytes, Top-Allokationen). Peak ist prozessweit (parallele Requests zählen mit)."""
+    _, peak = tracemalloc.get_traced_memory()
+    stats = tracemalloc.take_snapshot().statistics("lineno")[:PROFILE_TOP_N]
+    if started:
+        tracemalloc.stop()
+    top = [{"where": str(s.traceback), "size": s.size, "count": s.count} for s in stats]
+    return peak, top
+
+
+def start_profile(tenant: str, trigger: str, request_id: str = "-") -> "RequestProfile | None":
+    """Neues Profil, oder None, wenn in diesem Prozess schon eines läuft."""
+    if not _active.acquire(blocking=False):
+        PROFILES_SKIPPED.inc()
+        return None
+    try:
+        return RequestProfile(tenant=tenant, trigger=trigger, request_id=request_id)
+    except BaseException:
+        _active.release()
+        raise
+
+
+@dataclass
+class RequestProfile:
+    """Über start_profile() anlegen; finish() gibt das Profil wieder frei."""
+    tenant: str
+    trigger: str
+    request_id: str = "-"
+    profile_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    started: float = field(default_factory=time.perf_counter)
+    _stats: pstats.Stats | None = None
+    cprofile_scope: str = "stages"
+    _profiler: cProfile.Profile | None = None
+    _stage_seconds: dict[str, float] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+    _tracemalloc_started: bool = False
+
+    def __post_init__(self):
+        self._tracemalloc_started = _start_tracemalloc()
+        if not _PROCESS_WIDE_CPROFILE:
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # anderes Tool belegt sys.monitoring
+            self.cprofile_scope = "busy"
+            return
+        self._profiler = profiler
+        self.cprofile_scope = "process"
+
+    def _add(self, stage: str | None, profiler: cProfile.Profile | None, seconds: float = 0.0) -> None:
+        with self._lock:
+            if profiler is not None:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profiler)
+                else:
+                    self._stats.add(profiler)
+            if stage:
+                self._stage_seconds[stage] = seconds
+
+    def wrap_stages(self, stages: list) -> list:
+        """Sync-Stages bekommen Zeitmessung (+ eigenen cProfile bis 3.11); async-Stages bleiben unverändert."""
+        out = []
+        for stage in stages:
+            if inspect.iscoroutinefunction(stage.fn):
+                out.append(stage)
+                continue
+            out.append(replace(stage, fn=self._profiled(stage.name, stage.fn)))
+        return out
+
+    def _profiled(self, stage: str, fn):
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            profiler = None if _PROCESS_WIDE_CPROFILE else cProfile.Profile()
+            start = time.perf_counter()
+            try:
+                return profiler.runcall(fn, *args, **kwargs) if profiler else fn(*args, **kwargs)
+            finally:
+                self._add(stage, profiler, time.perf_counter() - start)
+        return run
+
+    def finish(self, status: str = "ok") -> dict:
+        """
+        Schreibt .prof/.json nach PROFILE_DIR und gibt die Zusammenfassung zurück.
+        Snapshot und Dateien kosten Zeit: aus async-Code über run_in_threadpool aufrufen.
+        """
+        try:
+            return self._finish(status)
+        finally:
+            _active.release()
+
+    def _finish(self, status: str) -> dict:
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._add(None, self._profiler)
+            self._profiler = None
+        peak, top_alloc = _stop_tracemalloc(self._tracemalloc_started)
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+
+        top_functions = ""
+        with self._lock:
+            if self._stats is not None:
+                self._stats.dump_stats(PROFILE_DIR / f"{self.profile_id}.prof")
+                buf = io.StringIO()
+                pstats.Stats(str(PROFILE_DIR / f"{self.profile_id}.prof"), stream=buf).sort_stats(
+                    "cumulative"
+                ).print_stats(PROFILE_TOP_N)
+                top_functions = buf.getvalue()
+
+        summary = {
+            "profile_id": self.profile_id,
+            "request_id": self.request_id,
+            "tenant": self.tenant,
+            "trigger": self.trigger,
+            "status": status,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "total_seconds": round(time.perf_counter() - self.started, 4),
+            "cprofile_scope": self.cprofile_scope,
+            "stage_seconds": {k: round(v, 4) for k, v in self._stage_seconds.items()},
+            "tracemalloc_peak_bytes": peak,
+            "top_allocations": top_alloc,
+            "top_functions": top_functions,
+        }
+        (PROFILE_DIR / f"{self.profile_id}.json").write_text(
+            json.dumps(summary, indent=2, ensure_ascii=False), encoding="utf-8"
+        )
+        PROFILES_WRITTEN.inc(trigger=self.trigger)
+        _prune()
+        return summary
+
+
+def _prune() -> None:
+    summaries = sorted(PROFILE_DIR.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True)
+    for old in summaries[PROFILE_MAX_FILES:]:
+        old.unlink(missing_ok=True)
+        old.with_suffix(".prof").unlink(missing_ok=True)
+
+
+# -----------------------------
+# Admin-Zugriff
+# -----------------------------
+def _safe_id(profile_id: str) -> str | None:
+    return profile_id if profile_id.isalnum() else None
+
+
+def list_profiles() -> list[dict]:
+    out = []
+    for path in sorted(PROFILE_DIR.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True):
+        data = json.loads(path.read_text(encoding="utf-8"))
+        out.append({k: data.get(k) for k in ("profile_id", "request_id", "tenant", "trigger", "status", "created_at",
+                                              "total_seconds", "tracemalloc_peak_bytes")})
+    return out
+
+
+def profile_summary(profile_id: str) -> dict | None:
+    pid = _safe_id(profile_id)
+    path = PROFILE_DIR / f"{pid}.json" if pid else None
+    if not path or not path.exists():
+        return None
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def profile_stats_path(profile_id: str) -> Path | None:
+    pid = _safe_id(profile_id)
+    path = PROFILE_DIR / f"{pid}.prof" if pid else None
+    return path if path and path.exists() else None
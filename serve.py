@@ -0,0 +1,82 @@
+# serve.py
+"""
+Startet service:app mit mehreren uvicorn-Worker-Prozessen.
+
+Anzahl Worker: WEB_CONCURRENCY, sonst die für den Container verfügbaren CPUs
+(CPU-Affinität und cgroup-Quota, z.B. docker --cpus=2). Geteilt zwischen den
+Workern werden Tenant-Daten und OCR-Ergebnisse (shared_cache.py, SQLite WAL),
+Unterschriften (/tmp/signatures, Dateiname mit Inhalts-Hash) und das Beleg-Archiv.
+Metriken (/metrics, /usage) summiert jeder Worker über METRICS_MULTIPROC_DIR (metrics.py).
+
+  python serve.py                 # PORT, WEB_CONCURRENCY aus ENV
+  WEB_CONCURRENCY=1 python serve.py
+"""
+import os
+import math
+from pathlib import Path
+
+import uvicorn
+
+from shared_cache import APP_STATE_DIR
+
+
+def _cgroup_cpu_limit() -> float | None:
+    """CPU-Quota aus cgroup v2 (cpu.max) bzw. v1 (cfs_quota/period), None = unbegrenzt."""
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        return None if quota == "max" else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        quota = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text())
+        period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+        return quota / period if quota > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus() -> int:
+    if hasattr(os, "process_cpu_count"):
+        cpus = os.process_cpu_count() or 1
+    elif hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, max(1, math.ceil(limit)))
+    return max(1, cpus)
+
+
+def worker_count() -> int:
+    configured = os.getenv("WEB_CONCURRENCY", "").strip()
+    return max(1, int(configured)) if configured else available_cpus()
+
+
+def prepare_metrics_dir(workers: int) -> None:
+    """Gemeinsames Verzeichnis für die Worker-Metriken; Stände früherer Läufe verwerfen."""
+    if workers <= 1:
+        return
+    directory = Path(os.getenv("METRICS_MULTIPROC_DIR", "").strip() or APP_STATE_DIR / "metrics")
+    directory.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    directory.mkdir(mode=0o700, exist_ok=True)
+    for old in directory.glob("*.json"):
+        old.unlink(missing_ok=True)
+    os.environ["METRICS_MULTIPROC_DIR"] = str(directory)
+
+
+def main() -> None:
+    workers = worker_count()
+    # von llm_scheduler gelesen (Rate-Limits pro Prozess anteilig)
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    prepare_metrics_dir(workers)
+    uvicorn.run(
+        os.getenv("APP_MODULE", "service:app"),
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=workers,
+    )
+
+
+if __name__ == "__main__":
+    main()
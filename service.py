@@ -1,74 +1,106 @@
-from fastapi import FastAPI, UploadFile, File, Form
-from fastapi.responses import FileResponse
+from fastapi import Depends, FastAPI, UploadFile, File, Form, Header, Request, HTTPException
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 import os
+import io
 import json
+import hashlib
+import hmac
+import time
+import uuid
+import asyncio
+import logging
+import functools
+from contextlib import asynccontextmanager
 
 from docx import Document
+from PIL import Image, ImageOps
 from PyPDF2 import PdfReader, PdfWriter
 
 from ocr_bon import ocr_bon
 from extract_agent_gemini import extract_bewirtungsdaten_gemini
 
 from pathlib import Path
-import subprocess
 import base64
 from pathlib import Path
 
 from full_agent_gemini import build_bew_data_from_upload
+from upload_ingest import BodySizeLimitMiddleware, IngestedUpload, ingest_upload, sniff_csv
+from email_normalizer import normalize_email_text
+import metrics
+from llm_usage import usage_summary
+from structured_log import get_request_id, log_event, set_request_id, set_tenant, setup_logging
+from llm_scheduler import QueueFull, QueueTimeout, begin_request, set_priority
+from pipeline_graph import PipelineRun, Stage, StageTimeout, check_cancelled, run_graph
+from fast_extract import extract_bewirtungsdaten
+import beleg_archive
+import request_profiler
+import reconciliation
+import duplicate_index
+import conversion_sandbox
 
 def write_signature_tmp(signature_b64: str, tenant_key: str) -> str:
     # Erwartet reines Base64 (kein data:image/png;base64,)
     sig_dir = Path("/tmp/signatures")
     sig_dir.mkdir(parents=True, exist_ok=True)
 
-    sig_path = sig_dir / f"{tenant_key}.png"
+    # Dateiname enthält den Inhalts-Hash: alle Worker teilen sich die Datei,
+    # eine geänderte Unterschrift bekommt automatisch eine neue
+    digest = hashlib.sha256(signature_b64.encode()).hexdigest()[:16]
+    sig_path = sig_dir / f"{tenant_key}_{digest}.png"
     if not sig_path.exists():
-        sig_path.write_bytes(base64.b64decode(signature_b64))
+        tmp = sig_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_bytes(base64.b64decode(signature_b64))
+        tmp.replace(sig_path)
     return str(sig_path)
 
 
 def docx_to_pdf_libreoffice(input_docx: str, output_pdf: str) -> None:
-    outdir = str(Path(output_pdf).parent)
-    Path(outdir).mkdir(parents=True, exist_ok=True)
-
-    # LibreOffice erzeugt PDF mit gleichem Dateinamen wie DOCX
-    cmd = [
-        "soffice",
-        "--headless",
-        "--nologo",
-        "--nolockcheck",
-        "--nodefault",
-        "--nofirststartwizard",
-        "--convert-to", "pdf",
-        "--outdir", outdir,
-        input_docx,
-    ]
-
-    proc = subprocess.run(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-    )
-
-    if proc.returncode != 0:
-        raise RuntimeError(
-            f"LibreOffice failed (code {proc.returncode}).\nSTDOUT:\n{proc.stdout}\nSTDERR:\n{proc.stderr}"
-        )
+    # eigene Prozessgruppe mit CPU-/Speicher-/Zeitlimit, Profil-Pool pro Worker (siehe conversion_sandbox.py)
+    conversion_sandbox.SANDBOX.convert_docx_to_pdf(input_docx, output_pdf)
 
-    produced = Path(outdir) / (Path(input_docx).stem + ".pdf")
-    if not produced.exists():
-        raise RuntimeError(f"LibreOffice did not produce PDF at: {produced}")
 
-    # Falls Zielname anders ist, umbenennen
-    target = Path(output_pdf)
-    if produced.resolve() != target.resolve():
-        produced.replace(target)
 # --------------------------------------------------
 # FastAPI App
 # --------------------------------------------------
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Reste abgestürzter Worker (soffice-Prozesse, Profil-Locks) wegräumen, danach periodisch
+    conversion_sandbox.start_janitor()
+    # mehrere Worker: eigenen Metrik-Stand für /metrics und /usage der anderen veröffentlichen
+    metrics.start_flusher()
+    yield
+    metrics.stop_flusher()
+    conversion_sandbox.stop_janitor()
+
+
+app = FastAPI(lifespan=lifespan)
+# zu große Bodies ablehnen, bevor Starlette sie für Form/File einliest (innerhalb von request_context)
+app.add_middleware(BodySizeLimitMiddleware)
+
+log = setup_logging()
+
+
+@app.middleware("http")
+async def request_context(request: Request, call_next):
+    """Request-ID (aus X-Request-ID oder neu) für alle Log-Zeilen dieses Requests."""
+    request_id = set_request_id(request.headers.get("x-request-id"))
+    set_tenant(None)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    except Exception:
+        log_event(log, "request_failed", logging.ERROR, exc_info=True, method=request.method, path=request.url.path)
+        raise
+    response.headers["X-Request-ID"] = request_id
+    log_event(
+        log, "request_done",
+        method=request.method, path=request.url.path, status=response.status_code,
+        duration_ms=round((time.perf_counter() - started) * 1000, 1),
+    )
+    return response
 
 # --------------------------------------------------
 # Pfade / Konstanten
@@ -104,8 +136,19 @@ def _get_default_signature_path() -> str | None:
     return None
 
 
-def fill_template(bew_data: dict):
-    os.makedirs(os.path.dirname(OUTPUT_DOCX), exist_ok=True)
+_template_bytes: bytes | None = None
+
+
+def load_template():
+    """Template-Datei wird einmal gelesen, pro Beleg nur noch aus dem Speicher geparst."""
+    global _template_bytes
+    if _template_bytes is None:
+        _template_bytes = Path(TEMPLATE_PATH).read_bytes()
+    return Document(io.BytesIO(_template_bytes))
+
+
+def fill_template(bew_data: dict, output_docx: str = OUTPUT_DOCX, doc=None):
+    os.makedirs(os.path.dirname(output_docx) or ".", exist_ok=True)
 
     # Unterschriftsdatum immer = heutiges Datum (Erstellungsdatum des Belegs)
     bew_data = bew_data.copy()
@@ -117,7 +160,8 @@ def fill_template(bew_data: dict):
         bew_data = bew_data.copy()
         bew_data["personen"] = ", ".join(bew_data["personen"])
 
-    doc = Document(TEMPLATE_PATH)
+    if doc is None:
+        doc = load_template()
     signature_path = bew_data.get("signature_path") or _get_default_signature_path()
 
 
@@ -163,7 +207,7 @@ def fill_template(bew_data: dict):
                     if "{{signature}}" in "".join(r.text for r in p.runs):
                         replace_signature(p)
 
-    doc.save(OUTPUT_DOCX)
+    doc.save(output_docx)
 
 
 # --------------------------------------------------
@@ -172,56 +216,24 @@ def fill_template(bew_data: dict):
 # DOCX -> PDF konvertieren (immer LibreOffice)
 # --------------------------------------------------
 
-def generate_form_pdf(bew_data: dict) -> None:
-    fill_template(bew_data)
+def generate_form_pdf(
+    bew_data: dict,
+    output_docx: str = OUTPUT_DOCX,
+    output_pdf: str = OUTPUT_PDF_FORM,
+    doc=None,
+) -> None:
+    fill_template(bew_data, output_docx=output_docx, doc=doc)
 
     # In Docker / Railway immer LibreOffice verwenden
-    docx_to_pdf_libreoffice(OUTPUT_DOCX, OUTPUT_PDF_FORM)
+    docx_to_pdf_libreoffice(output_docx, output_pdf)
 
 
 
 import re
 from decimal import Decimal, InvalidOperation
 
-def _parse_eur_amount(s: str) -> Decimal | None:
-    """
-    Parses amounts like '34,00 EUR', '34.00', 'EUR 34,00' into Decimal(34.00).
-    Returns None if not parseable.
-    """
-    if not s:
-        return None
-    s = str(s).strip()
-
-    m = re.search(r'(\d{1,3}(?:[.\s]\d{3})*(?:[.,]\d{1,2})?|\d+(?:[.,]\d{1,2})?)', s)
-    if not m:
-        return None
-
-    num = m.group(1).replace(" ", "")
-
-    # normalize thousand/decimal separators
-    if "," in num and "." in num:
-        if num.rfind(",") > num.rfind("."):
-            num = num.replace(".", "").replace(",", ".")
-        else:
-            num = num.replace(",", "")
-    else:
-        if "," in num:
-            num = num.replace(".", "").replace(",", ".")
-
-    # if user wrote "5" (no decimals), treat as "5.00"
-    if re.fullmatch(r"\d+", num):
-        num = num + ".00"
-    elif re.fullmatch(r"\d+\.\d", num):
-        num = num + "0"
-
-    try:
-        return Decimal(num).quantize(Decimal("0.01"))
-    except InvalidOperation:
-        return None
-
+from amounts import parse_eur_amount as _parse_eur_amount, format_eur as _format_eur, parse_strict_amount
 
-def _format_eur(d: Decimal) -> str:
-    return f"{d:.2f}".replace(".", ",") + " EUR"
 
 def _extract_amount_after_keyword(text: str, keywords: list[str]) -> Decimal | None:
     """
@@ -329,10 +341,14 @@ def apply_tip_logic(bew_data: dict, ocr_text: str, email_text: str | None = None
 # PDFs mergen: Bon + Formular
 # --------------------------------------------------
 
-def merge_pdfs(receipt_path: str) -> None:
+def merge_pdfs(
+    receipt_path: str,
+    form_pdf: str = OUTPUT_PDF_FORM,
+    output_pdf: str = OUTPUT_FINAL_PDF,
+) -> None:
     """
-    Merged den Bon (receipt_path) und das ausgefüllte Formular (OUTPUT_PDF_FORM)
-    zu einer finalen PDF (OUTPUT_FINAL_PDF).
+    Merged den Bon (receipt_path) und das ausgefüllte Formular (form_pdf)
+    zu einer finalen PDF (output_pdf).
     """
 
     writer = PdfWriter()
@@ -343,11 +359,11 @@ def merge_pdfs(receipt_path: str) -> None:
         writer.add_page(page)
 
     # 2) Formular-Seiten
-    form_pdf = PdfReader(OUTPUT_PDF_FORM)
-    for page in form_pdf.pages:
+    form_reader = PdfReader(form_pdf)
+    for page in form_reader.pages:
         writer.add_page(page)
 
-    with open(OUTPUT_FINAL_PDF, "wb") as f:
+    with open(output_pdf, "wb") as f:
         writer.write(f)
 
 
@@ -372,17 +388,16 @@ async def build_bewirtungsbeleg(
 
     bew_data = json.loads(data)
 
-    # Bon speichern
-    os.makedirs("input", exist_ok=True)
-    receipt_path = os.path.join("input", receipt.filename)
-    with open(receipt_path, "wb") as f:
-        f.write(await receipt.read())
-
-    # Formular erzeugen (DOCX -> PDF)
-    generate_form_pdf(bew_data)
+    # Bon einlesen (gestreamt, größenbegrenzt, Typ per Magic Bytes)
+    ingested = await ingest_upload(receipt)
+    try:
+        # Formular erzeugen (DOCX -> PDF)
+        generate_form_pdf(bew_data)
 
-    # PDFs mergen
-    merge_pdfs(receipt_path)
+        # PDFs mergen
+        merge_pdfs(ingested.path())
+    finally:
+        ingested.close()
 
     return FileResponse(
         OUTPUT_FINAL_PDF,
@@ -398,67 +413,60 @@ async def build_bewirtungsbeleg(
 
 from fastapi import Form, File, UploadFile
 from tenant_store import get_tenant
-# write_signature_tmp importieren/definieren
-# (und in fill_template: signature_path = bew_data.get("signature_path") or _get_default_signature_path())
-
-@app.post("/full-agent")
-async def full_agent(
-    email_text: str = Form(...),
-    receipt: UploadFile = File(...),
-    tenant_key: str = Form("default"),
-):
-    """
-    Nimmt:
-    - tenant_key: z.B. "enpal" (aus n8n), default="default"
-    - email_text: Text aus der E-Mail
-    - receipt: Bon (PDF/JPG/PNG)
-    """
-
-    tenant = get_tenant(tenant_key)
-
-    # 1) Bon speichern (Railway-sicher: /tmp)
-    receipt_bytes = await receipt.read()
-    if not receipt_bytes:
-        raise ValueError("Uploaded receipt is empty")
-
-    os.makedirs("/tmp/input", exist_ok=True)
-    filename = receipt.filename or "receipt"
-    receipt_path = os.path.join("/tmp/input", filename)
-    with open(receipt_path, "wb") as f:
-        f.write(receipt_bytes)
-
-    # 2) OCR
-    ocr_text = ocr_bon(receipt_path)
-    print("----- OCR TEXT -----")
-    print(ocr_text)
-    print("----- END OCR -----")
-
-    # 3) Strukturierte Daten (LLM)
-    bew_data = extract_bewirtungsdaten_gemini(ocr_text, email_text) or {}
-    print("----- EMAIL TEXT START -----")
-    print(repr(email_text[:500] if email_text else ""))
-    print("----- EMAIL TEXT END -----")
 
+# Timeouts pro Stage (Sekunden), per ENV überschreibbar: PIPELINE_STAGE_TIMEOUTS='{"ocr": 180}'
+STAGE_TIMEOUTS = {
+    "upload": 60,
+    "tenant": 10,
+    "email": 5,
+    "template": 10,
+    "signature": 10,
+    "receipt_pdf": 30,
+    "ocr": 180,
+    "extract": 90,
+    "bew_data": 10,
+    "form": 120,
+    "merge": 30,
+    "archive": 30,
+    "duplicate": 10,
+    "dedup": 10,
+}
+STAGE_TIMEOUTS.update({k: float(v) for k, v in json.loads(os.getenv("PIPELINE_STAGE_TIMEOUTS", "{}") or "{}").items()})
+
+
+def receipt_as_pdf(ingested: IngestedUpload) -> str:
+    """Bon für den Merge als PDF: PDFs unverändert, Fotos (JPG/PNG) werden zu einer PDF-Seite."""
+    if ingested.kind == "pdf":
+        return ingested.path()
+    out = ingested.workdir / "receipt_merge.pdf"
+    with Image.open(ingested.path()) as img:
+        ImageOps.exif_transpose(img).convert("RGB").save(out, "PDF", resolution=150)
+    return str(out)
+
+
+def build_bew_data(bew_data: dict, ocr_text: str, email_text: str, tenant, signature_path: str | None) -> dict:
+    """Trinkgeld-Logik + Tenant-Defaults auf die LLM-Daten anwenden."""
+    bew_data = dict(bew_data or {})
     bew_data_before = bew_data.copy()
 
     # Trinkgeld-Logik (dein bestehender Code)
     bew_data = apply_tip_logic(bew_data, ocr_text=ocr_text, email_text=email_text)
 
-    print("----- TIP LOGIC RESULT -----")
-    print("betrag vorher:", bew_data_before.get("betrag"))
-    print("betrag nachher:", bew_data.get("betrag"), "quelle:", bew_data.get("betrag_quelle"))
-    print("trinkgeld:", bew_data.get("trinkgeld"), "betrag_rechnung:", bew_data.get("betrag_rechnung"))
-    print("----- END TIP LOGIC RESULT -----")
+    log_event(
+        log, "tip_logic",
+        betrag_vorher=bew_data_before.get("betrag"),
+        betrag_nachher=bew_data.get("betrag"),
+        betrag_quelle=bew_data.get("betrag_quelle"),
+        trinkgeld=bew_data.get("trinkgeld"),
+        betrag_rechnung=bew_data.get("betrag_rechnung"),
+    )
 
-    # 3.5) Tenant Defaults anwenden (NEU)
+    # Tenant Defaults anwenden
     if not bew_data.get("ort"):
         bew_data["ort"] = tenant.default_city
 
-    if tenant.signature_png_b64:
-        bew_data["signature_path"] = write_signature_tmp(
-            tenant.signature_png_b64,
-            tenant.tenant_key
-        )
+    if signature_path:
+        bew_data["signature_path"] = signature_path
 
     # Wenn du "Trinkgeld immer 0,00 EUR wenn leer" willst (pragmatisch):
     if not bew_data.get("trinkgeld"):
@@ -466,17 +474,272 @@ async def full_agent(
         if not bew_data.get("betrag_rechnung"):
             bew_data["betrag_rechnung"] = bew_data.get("betrag", "")
 
-    print("----- EXTRACTED DATA -----")
-    print(json.dumps(bew_data, indent=2, ensure_ascii=False))
-    print("----- END DATA -----")
+    log_event(log, "extracted_data", keys=sorted(bew_data), payload={"bew_data": bew_data})
+    return bew_data
+
+
+def full_agent_stages(receipt: UploadFile, email_text: str, tenant_key: str, cleanup: list) -> list[Stage]:
+    """
+    Stages der /full-agent-Pipeline (Name <- Abhängigkeiten):
+
+      upload, tenant, email, template          (keine)
+      signature   <- tenant
+      duplicate   <- upload, tenant
+      receipt_pdf <- upload
+      ocr         <- upload, tenant (+ duplicate bei DUPLICATE_MODE=reject)
+      extract     <- ocr, email, tenant
+      bew_data    <- extract, ocr, email, tenant, signature
+      form        <- bew_data, template, upload
+      merge       <- form, receipt_pdf, upload
+      archive     <- merge, bew_data, tenant
+      dedup       <- duplicate, bew_data, archive, tenant
+
+    Tenant-Lookup, Signatur, Template und Bon-Normalisierung laufen parallel zur OCR.
+    Im flag-Modus ist der Duplikat-Check optional: Fehler/Timeout werden geloggt, der Bon läuft weiter.
+    Aufräum-Funktionen (Temp-Verzeichnis des Uploads) landen in `cleanup`.
+    """
+    requested_tenant = (tenant_key or "default").strip().lower()
+
+    def tenant_stage():
+        return get_tenant(requested_tenant)
+
+    async def upload_stage():
+        ingested = await ingest_upload(receipt)
+        cleanup.append(ingested.close)
+        log_event(
+            log, "upload_ingested",
+            kind=ingested.kind, size=ingested.size,
+            sha256=ingested.sha256[:12], peak_buffer=ingested.peak_buffered_bytes,
+        )
+        return ingested
+
+    def email_stage():
+        # Nur den neu geschriebenen Mail-Text verwenden (ohne Zitate, Signaturen, HTML)
+        return normalize_email_text(email_text)
+
+    def signature_stage(tenant):
+        if not tenant.signature_png_b64:
+            return None
+        return write_signature_tmp(tenant.signature_png_b64, tenant.tenant_key)
+
+    def duplicate_stage(upload, tenant):
+        # vor/parallel zur OCR: gleiche Datei (SHA-256) oder gleiches Motiv (dHash)
+        if duplicate_index.DUPLICATE_MODE == "off":
+            return None
+        phash = duplicate_index.receipt_phash(upload.path(), upload.kind)
+        check_cancelled()
+        # Reservierung der Datei: bei Fehler/Abbruch beim Aufräumen freigeben (nach register_receipt ein No-op)
+        claim = uuid.uuid4().hex
+        cleanup.append(functools.partial(duplicate_index.release_claim, tenant.tenant_key, upload.sha256, claim))
+        hits = duplicate_index.find_duplicates(
+            tenant.tenant_key, upload.sha256, phash, claim=claim, request_id=get_request_id()
+        )
+        if hits:
+            log_event(log, "duplicate_receipt", hits=[h.to_dict() for h in hits[:5]])
+        exact = [h for h in hits if h.kind == "exact"]
+        if exact and duplicate_index.DUPLICATE_MODE == "reject":
+            raise duplicate_index.DuplicateReceipt(exact)
+        return {"sha256": upload.sha256, "phash": phash, "hits": hits, "claim": claim}
+
+    def skip_duplicate_check(exc: Exception):
+        log_event(log, "duplicate_check_skipped", logging.WARNING, error=f"{type(exc).__name__}: {exc}")
+        return None
+
+    def ocr_stage(upload, tenant, duplicate=None):
+        # Token-Accounting und Scheduler-Fairness auf den aufgelösten Tenant (unbekannte Keys -> "default");
+        # der Lookup ist gecacht und läuft parallel zum Upload
+        ocr_text = ocr_bon(upload.path(), tenant_key=tenant.tenant_key, sha256=upload.sha256)
+        log_event(log, "ocr_done", ocr_chars=len(ocr_text or ""), payload={"ocr_text": ocr_text})
+        return ocr_text
+
+    def extract_stage(ocr, email, tenant):
+        # regelbasierter Fast Path, Gemini nur wenn lokal nicht alle Felder sicher sind
+        bew_data = extract_bewirtungsdaten(ocr, email, tenant_key=tenant.tenant_key) or {}
+        log_event(log, "extraction_done", email_chars=len(email or ""), payload={"email_text": email})
+        return bew_data
+
+    def bew_data_stage(extract, ocr, email, tenant, signature):
+        return build_bew_data(extract, ocr_text=ocr, email_text=email, tenant=tenant, signature_path=signature)
+
+    def receipt_pdf_stage(upload):
+        return receipt_as_pdf(upload)
+
+    def form_stage(bew_data, template, upload):
+        docx_path = str(upload.workdir / "bewirtung_fertig.docx")
+        pdf_path = str(upload.workdir / "bewirtung_fertig.pdf")
+        generate_form_pdf(bew_data, output_docx=docx_path, output_pdf=pdf_path, doc=template)
+        return pdf_path
+
+    def merge_stage(form, receipt_pdf, upload):
+        final_path = str(upload.workdir / "bewirtungs_beleg_final.pdf")
+        merge_pdfs(receipt_pdf, form_pdf=form, output_pdf=final_path)
+        return final_path
+
+    def archive_stage(merge, bew_data, tenant):
+        # Archiv darf die Auslieferung nicht verhindern: Fehler nur loggen
+        if not beleg_archive.ARCHIVE_ENABLED:
+            return None
+        try:
+            archived = beleg_archive.archive_beleg(
+                merge, bew_data, tenant.tenant_key, download_filename(bew_data), request_id=get_request_id()
+            )
+        except Exception:
+            log_event(log, "archive_failed", logging.ERROR, exc_info=True)
+            return None
+        log_event(log, "archived", beleg_id=archived.beleg_id, sha256=archived.sha256[:12], size=archived.size)
+        return archived
+
+    def dedup_stage(duplicate, bew_data, archive, tenant):
+        # gleicher Inhalt aus anderer Datei erkennen, dann diesen Bon im Index registrieren
+        if duplicate is None:
+            return []
+        key = duplicate_index.content_key(bew_data)
+        content_hits = duplicate_index.find_content_duplicates(tenant.tenant_key, duplicate["sha256"], key)
+        if content_hits:
+            log_event(log, "duplicate_content", hits=[h.to_dict() for h in content_hits[:5]])
+        duplicate_index.register_receipt(
+            tenant.tenant_key, duplicate["sha256"], duplicate["phash"], key,
+            beleg_id=archive.beleg_id if archive is not None else None, request_id=get_request_id(),
+            claim=duplicate["claim"],
+        )
+        return duplicate["hits"] + content_hits
+
+    ocr_deps = ("upload", "tenant", "duplicate") if duplicate_index.DUPLICATE_MODE == "reject" else ("upload", "tenant")
+    stages = [
+        Stage("upload", upload_stage),
+        Stage("tenant", tenant_stage),
+        Stage("email", email_stage),
+        Stage("template", load_template),
+        Stage("signature", signature_stage, deps=("tenant",)),
+        Stage(
+            "duplicate", duplicate_stage, deps=("upload", "tenant"),
+            on_error=skip_duplicate_check if duplicate_index.DUPLICATE_MODE == "flag" else None,
+        ),
+        Stage("receipt_pdf", receipt_pdf_stage, deps=("upload",)),
+        Stage("ocr", ocr_stage, deps=ocr_deps, pool="llm"),
+        Stage("extract", extract_stage, deps=("ocr", "email", "tenant"), pool="llm"),
+        Stage("bew_data", bew_data_stage, deps=("extract", "ocr", "email", "tenant", "signature")),
+        Stage("form", form_stage, deps=("bew_data", "template", "upload")),
+        Stage("merge", merge_stage, deps=("form", "receipt_pdf", "upload")),
+        Stage("archive", archive_stage, deps=("merge", "bew_data", "tenant")),
+        Stage("dedup", dedup_stage, deps=("duplicate", "bew_data", "archive", "tenant")),
+    ]
+    for stage in stages:
+        stage.timeout = STAGE_TIMEOUTS.get(stage.name)
+    return stages
+
+
+@app.post("/full-agent")
+async def full_agent(
+    request: Request,
+    email_text: str = Form(...),
+    receipt: UploadFile = File(...),
+    tenant_key: str = Form("default"),
+    priority: str = Form("auto"),
+):
+    """
+    Nimmt:
+    - tenant_key: z.B. "enpal" (aus n8n), default="default"
+    - email_text: Text aus der E-Mail
+    - receipt: Bon (PDF/JPG/PNG)
+    - priority: "interactive" | "batch" | "auto" (Reihenfolge im LLM-Scheduler);
+      nur mit gültigem X-Admin-Token, sonst klassifiziert der Scheduler selbst ("auto")
+
+    Die Stages laufen als Abhängigkeitsgraph (pipeline_graph); Stage-Zeiten kommen
+    als Server-Timing-Header zurück, der kritische Pfad wird pro Request geloggt.
+    """
+    # vor dem Start der Stage-Tasks setzen, damit alle Log-Zeilen den Tenant tragen
+    set_tenant(tenant_key or "default")
+    # Priorität ist ein Eingriff in die Fairness zwischen Tenants: nicht vom Client ohne Token
+    admin = request_profiler.check_admin_token(request.headers.get("x-admin-token"))
+    set_priority(priority if admin else "auto")
+    begin_request()
+
+    cleanup: list = []
+    stages = full_agent_stages(receipt, email_text, tenant_key, cleanup)
+
+    # Opt-in-Profiling (X-Profile + Admin-Token oder PROFILE_TENANTS); sonst nur dieser Check
+    trigger = request_profiler.profile_trigger(request.headers, tenant_key)
+    profile = None
+    if trigger:
+        # None, wenn in diesem Worker schon ein Request profiliert wird
+        profile = request_profiler.start_profile(
+            tenant=(tenant_key or "default").strip().lower(), trigger=trigger, request_id=get_request_id()
+        )
+    if profile:
+        stages = profile.wrap_stages(stages)
+
+    # Stage-Threads laufen nach Timeout/Fehler weiter, bis sie ihre Deadline bemerken:
+    # das Upload-Verzeichnis erst löschen, wenn keiner mehr darauf zugreift
+    run = PipelineRun()
+    try:
+        graph = await run_graph(stages, run=run)
+    except (StageTimeout, conversion_sandbox.ConversionTimeout, QueueTimeout) as e:
+        run.call_when_idle(_run_cleanup, cleanup)
+        if profile:
+            _finish_profile_later(profile, "timeout")
+        raise HTTPException(status_code=504, detail=str(e))
+    except QueueFull as e:
+        run.call_when_idle(_run_cleanup, cleanup)
+        if profile:
+            _finish_profile_later(profile, "rejected")
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+    except duplicate_index.DuplicateReceipt as e:
+        run.call_when_idle(_run_cleanup, cleanup)
+        if profile:
+            _finish_profile_later(profile, "duplicate")
+        raise HTTPException(
+            status_code=409,
+            detail={"message": str(e), "duplicates": [h.to_dict() for h in e.hits[:5]]},
+        )
+    except BaseException:
+        run.call_when_idle(_run_cleanup, cleanup)
+        if profile:
+            _finish_profile_later(profile, "error")
+        raise
+
+    bew_data = graph.results["bew_data"]
+    log_event(
+        log, "pipeline_done",
+        total_ms=round(graph.total_seconds * 1000, 1),
+        critical_path=graph.critical_path,
+        stages_ms={name: round(t.seconds * 1000, 1) for name, t in graph.timings.items()},
+    )
+
+    headers = {
+        "Server-Timing": graph.server_timing(),
+        "X-Critical-Path": ",".join(graph.critical_path),
+    }
+    archived = graph.results["archive"]
+    if archived is not None:
+        headers["X-Beleg-ID"] = archived.beleg_id
+    duplicates = graph.results["dedup"]
+    if duplicates:
+        headers["X-Duplicate"] = ",".join(sorted({h.kind for h in duplicates}))
+        headers["X-Duplicate-Of"] = ",".join(list(dict.fromkeys(h.beleg_id for h in duplicates if h.beleg_id))[:5])
+    if profile:
+        # Snapshot + Dateien nicht auf dem Event-Loop
+        summary = await run_in_threadpool(profile.finish)
+        headers["X-Profile-ID"] = profile.profile_id
+        log_event(
+            log, "request_profiled",
+            profile_id=profile.profile_id, trigger=trigger,
+            tracemalloc_peak_bytes=summary["tracemalloc_peak_bytes"],
+        )
 
-    # 4) Formular erzeugen
-    generate_form_pdf(bew_data)
+    # Temp-Verzeichnis erst nach dem Senden der Antwort löschen (und nach einem
+    # übersprungenen, evtl. noch laufenden Duplikat-Check)
+    return FileResponse(
+        graph.results["merge"],
+        filename=download_filename(bew_data),
+        media_type="application/pdf",
+        headers=headers,
+        background=BackgroundTask(run.call_when_idle, _run_cleanup, cleanup),
+    )
 
-    # 5) Bon + Formular mergen
-    merge_pdfs(receipt_path)
 
-    # 6) PDF mit sauberem Dateinamen zurückgeben
+def download_filename(bew_data: dict) -> str:
+    """PDF mit sauberem Dateinamen zurückgeben."""
     def safe(s: str) -> str:
         return (
             (s or "")
@@ -490,10 +753,259 @@ async def full_agent(
     betrag = safe(bew_data.get("betrag", ""))
     datum = date.today().strftime("%Y-%m-%d")
 
-    filename = f"Bewirtungsbeleg_{datum}_{restaurant}_{betrag}.pdf"
+    return f"Bewirtungsbeleg_{datum}_{restaurant}_{betrag}.pdf"
+
+
+def _finish_profile_later(profile: request_profiler.RequestProfile, status: str) -> None:
+    """Fehlerpfade: Profil im Thread abschließen, ohne zu warten (läuft auch, wenn der Request abgebrochen wird)."""
+    def finish():
+        try:
+            profile.finish(status)
+        except Exception:
+            log_event(log, "profile_failed", logging.ERROR, profile_id=profile.profile_id, exc_info=True)
+
+    asyncio.get_running_loop().run_in_executor(None, finish)
+
+
+def _run_cleanup(cleanup: list) -> None:
+    for fn in cleanup:
+        fn()
+
+
+# --------------------------------------------------
+# Endpoints: Metriken (Token-Verbrauch siehe unten, hinter tenant_access)
+# --------------------------------------------------
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# --------------------------------------------------
+# Zugriff auf Tenant-Daten (Archiv, Abgleich)
+# --------------------------------------------------
+# Token pro Tenant, z.B. '{"enpal": "<token>"}'; das Admin-Token darf auf alle Tenants zugreifen
+TENANT_API_TOKENS: dict[str, str] = {
+    k.strip().lower(): str(v) for k, v in json.loads(os.getenv("TENANT_API_TOKENS", "{}") or "{}").items()
+}
+
+
+def tenant_access(
+    tenant_key: str,
+    x_tenant_token: str | None = Header(None),
+    x_admin_token: str | None = Header(None),
+) -> str:
+    """Dependency: normalisierter tenant_key, wenn X-Tenant-Token (des Tenants) oder X-Admin-Token passt."""
+    tenant = (tenant_key or "default").strip().lower()
+    if request_profiler.check_admin_token(x_admin_token):
+        return tenant
+    expected = TENANT_API_TOKENS.get(tenant)
+    if expected and hmac.compare_digest((x_tenant_token or "").strip(), expected):
+        return tenant
+    raise HTTPException(status_code=403, detail="Tenant token required")
+
+
+@app.get("/usage")
+def get_usage(x_admin_token: str | None = Header(None)):
+    """Token-Verbrauch aller Tenants, pro Stage (ocr/extract) und Belegtyp; nur mit X-Admin-Token."""
+    if not request_profiler.check_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+    return usage_summary()
+
+
+@app.get("/usage/{tenant_key}")
+def get_tenant_usage(tenant: str = Depends(tenant_access)):
+    return usage_summary(tenant).get(tenant, {})
+
+
+# --------------------------------------------------
+# Endpoints: Beleg-Archiv
+# (Re-Downloads kommen aus dem Blob-Store, ohne die Pipeline neu zu starten)
+# --------------------------------------------------
+
+def _query_amount(value: str | None, name: str):
+    # kein parse_eur_amount: der liest '1.000' als 1,00 EUR
+    if value is None or value == "":
+        return None
+    amount = parse_strict_amount(value)
+    if amount is None:
+        raise HTTPException(status_code=400, detail=f"Invalid amount for {name}: {value!r}")
+    return amount
+
+
+@app.get("/archive/{tenant_key}/belege")
+def list_archived_belege(
+    tenant: str = Depends(tenant_access),
+    date_from: date | None = None,
+    date_to: date | None = None,
+    min_betrag: str | None = None,
+    max_betrag: str | None = None,
+    limit: int = 100,
+    offset: int = 0,
+):
+    """
+    Belege eines Tenants, optional gefiltert nach Bewirtungsdatum (von/bis) und Betrag (min/max).
+    Beträge als Dezimalzahl ('1000.50', '1000,50') oder mit Tausenderpunkt ('1.000,50').
+    """
+    belege = beleg_archive.query_belege(
+        tenant,
+        date_from=date_from,
+        date_to=date_to,
+        min_betrag=_query_amount(min_betrag, "min_betrag"),
+        max_betrag=_query_amount(max_betrag, "max_betrag"),
+        limit=max(1, min(limit, 1000)),
+        offset=max(0, offset),
+    )
+    return [b.to_dict() for b in belege]
+
+
+def _archived_or_404(tenant: str, beleg_id: str):
+    beleg = beleg_archive.get_beleg(beleg_id)
+    if beleg is None or beleg.tenant != tenant:
+        raise HTTPException(status_code=404, detail="Beleg not found")
+    return beleg
+
 
+@app.get("/archive/{tenant_key}/belege/{beleg_id}")
+def get_archived_beleg(beleg_id: str, tenant: str = Depends(tenant_access)):
+    return _archived_or_404(tenant, beleg_id).to_dict()
+
+
+@app.get("/archive/{tenant_key}/belege/{beleg_id}/pdf")
+def download_archived_beleg(beleg_id: str, tenant: str = Depends(tenant_access)):
+    beleg = _archived_or_404(tenant, beleg_id)
     return FileResponse(
-        OUTPUT_FINAL_PDF,
-        filename=filename,
+        beleg_archive.blob_path(beleg.sha256),
+        filename=beleg.filename,
         media_type="application/pdf",
+        headers={"ETag": f'"{beleg.sha256}"'},
+    )
+
+
+@app.get("/archive/{tenant_key}/export/{month}")
+def export_archive_month(month: str, tenant: str = Depends(tenant_access)):
+    """ZIP aller Belege eines Monats (YYYY-MM) mit belege.csv (DATEV-artig), gestreamt."""
+    try:
+        beleg_archive.month_range(month)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="month must be YYYY-MM")
+    return StreamingResponse(
+        beleg_archive.export_month_zip(tenant, month),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="Bewirtungsbelege_{tenant}_{month}.zip"'},
+    )
+
+
+# --------------------------------------------------
+# Endpoints: Admin / Profile
+# --------------------------------------------------
+
+def _require_admin(request: Request) -> None:
+    if not request_profiler.check_admin_token(request.headers.get("x-admin-token")):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+@app.get("/admin/profiles")
+def list_request_profiles(request: Request):
+    _require_admin(request)
+    return request_profiler.list_profiles()
+
+
+@app.get("/admin/profiles/{profile_id}")
+def get_request_profile(profile_id: str, request: Request):
+    """Zusammenfassung: Stage-Zeiten, tracemalloc-Peak, Top-Allokationen, Top-Funktionen (cumulative)."""
+    _require_admin(request)
+    summary = request_profiler.profile_summary(profile_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return summary
+
+
+@app.get("/admin/profiles/{profile_id}/prof")
+def download_request_profile(profile_id: str, request: Request):
+    """pstats-Datei (python -m pstats / snakeviz)."""
+    _require_admin(request)
+    path = request_profiler.profile_stats_path(profile_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, filename=f"{profile_id}.prof", media_type="application/octet-stream")
+
+
+# --------------------------------------------------
+# Endpoints: Abgleich mit Bank-/Kartenumsätzen
+# --------------------------------------------------
+
+@app.post("/reconciliation/{tenant_key}/transactions")
+async def import_bank_transactions(file: UploadFile = File(...), tenant: str = Depends(tenant_access)):
+    """CSV-Export des Bank-/Kartenkontos importieren (erneuter Import ist idempotent)."""
+    # wie Bons: chunkweise mit Größenlimit, große Exporte landen in einer Temp-Datei
+    ingested = await ingest_upload(file, sniff=sniff_csv, what="CSV")
+    try:
+        result = await run_in_threadpool(reconciliation.import_transactions, tenant, ingested.path())
+    except reconciliation.BankCsvError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        ingested.close()
+    log_event(log, "transactions_imported", tenant_key=tenant, **result.to_dict())
+    return result.to_dict()
+
+
+def _reconciliation_report(
+    tenant: str,
+    month: str | None,
+    date_from: date | None,
+    date_to: date | None,
+    tolerance_cents: int,
+    window_days: int,
+    include_matched: bool,
+    record: bool,
+) -> dict:
+    if month:
+        try:
+            date_from, date_to = beleg_archive.month_range(month)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="month must be YYYY-MM")
+    if date_from is None or date_to is None:
+        raise HTTPException(status_code=400, detail="month or date_from and date_to required")
+    report = reconciliation.reconcile(
+        tenant, date_from, date_to,
+        tolerance_cents=max(0, tolerance_cents), window_days=max(0, window_days), record=record,
+    )
+    if not include_matched:
+        report.pop("matched")
+    return report
+
+
+@app.get("/reconciliation/{tenant_key}")
+def reconcile_belege(
+    tenant: str = Depends(tenant_access),
+    month: str | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    tolerance_cents: int = reconciliation.RECON_AMOUNT_TOLERANCE_CENTS,
+    window_days: int = reconciliation.RECON_DATE_WINDOW_DAYS,
+    include_matched: bool = False,
+):
+    """
+    Archivierte Belege (Monat YYYY-MM oder date_from/date_to) gegen die importierten
+    Umsätze abgleichen; berichtet nicht gefundene und mehrdeutige Belege. Nur lesend.
+    """
+    return _reconciliation_report(
+        tenant, month, date_from, date_to, tolerance_cents, window_days, include_matched, record=False
+    )
+
+
+@app.post("/reconciliation/{tenant_key}")
+def record_reconciliation(
+    tenant: str = Depends(tenant_access),
+    month: str | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    tolerance_cents: int = reconciliation.RECON_AMOUNT_TOLERANCE_CENTS,
+    window_days: int = reconciliation.RECON_DATE_WINDOW_DAYS,
+    include_matched: bool = False,
+):
+    """Wie GET, speichert aber den Status pro Beleg (Statuswechsel zählen in reconciliation_belege_total)."""
+    return _reconciliation_report(
+        tenant, month, date_from, date_to, tolerance_cents, window_days, include_matched, record=True
     )
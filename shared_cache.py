@@ -0,0 +1,153 @@
+# shared_cache.py
+"""
+Zweistufiger Cache für den Betrieb mit mehreren Worker-Prozessen.
+
+- L1: pro Prozess, kleines LRU-Dict mit kurzer TTL (kein I/O im heißen Pfad)
+- L2: eine SQLite-Datei im WAL-Modus, von allen Workern gemeinsam genutzt
+  (parallele Leser, ein Schreiber; überlebt Worker-Neustarts)
+
+Werte müssen JSON-serialisierbar sein. Jede Instanz hat einen eigenen Namespace.
+"""
+import os
+import json
+import time
+import random
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable
+
+from metrics import Counter
+
+# -----------------------------
+# Konfiguration (ENV)
+# -----------------------------
+# private Laufzeitdaten (der Cache enthält Tenant-Zeilen samt Unterschrift): nur für den Service-User
+APP_STATE_DIR = Path(os.getenv("APP_STATE_DIR", str(Path.home() / ".cache" / "bewirtungsbeleg-agent")))
+SHARED_CACHE_PATH = Path(os.getenv("SHARED_CACHE_PATH", str(APP_STATE_DIR / "shared_cache.sqlite3")))
+# Anteil der Schreibzugriffe, die abgelaufene Einträge aufräumen
+_PURGE_PROBABILITY = 0.001
+
+CACHE_LOOKUPS = Counter("shared_cache_lookups_total", "Cache lookups by level", ["cache", "result"])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    namespace  TEXT NOT NULL,
+    key        TEXT NOT NULL,
+    value      TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+) WITHOUT ROWID;
+"""
+
+_local = threading.local()
+
+
+def _connection(path: Path) -> sqlite3.Connection:
+    """Eine Verbindung pro Thread und Prozess (nach fork neu öffnen)."""
+    conns = getattr(_local, "conns", None)
+    if conns is None or getattr(_local, "pid", None) != os.getpid():
+        conns = _local.conns = {}
+        _local.pid = os.getpid()
+    conn = conns.get(path)
+    if conn is None:
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        # Datei vorab mit 0600 anlegen (SQLite übernimmt die Rechte für -wal/-shm), alte Dateien nachziehen
+        os.close(os.open(path, os.O_CREAT | os.O_RDWR, 0o600))
+        os.chmod(path, 0o600)
+        conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        conns[path] = conn
+    return conn
+
+
+class SharedCache:
+    def __init__(
+        self,
+        namespace: str,
+        ttl: float,
+        l1_ttl: float | None = None,
+        l1_size: int = 256,
+        path: Path | None = None,
+    ):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.l1_ttl = min(ttl, l1_ttl) if l1_ttl is not None else ttl
+        self.l1_size = l1_size
+        self.path = Path(path or SHARED_CACHE_PATH)
+        self._l1: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._l1_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    # ---- L1 ----
+    def _l1_get(self, key: str):
+        with self._l1_lock:
+            hit = self._l1.get(key)
+            if hit is None:
+                return None
+            if hit[0] < time.monotonic():
+                del self._l1[key]
+                return None
+            self._l1.move_to_end(key)
+            return hit[1]
+
+    def _l1_set(self, key: str, value: Any) -> None:
+        with self._l1_lock:
+            self._l1[key] = (time.monotonic() + self.l1_ttl, value)
+            self._l1.move_to_end(key)
+            while len(self._l1) > self.l1_size:
+                self._l1.popitem(last=False)
+
+    # ---- Public API ----
+    def get(self, key: str) -> Any | None:
+        if not self.enabled:
+            return None
+        value = self._l1_get(key)
+        if value is not None:
+            CACHE_LOOKUPS.inc(cache=self.namespace, result="l1")
+            return value
+        row = _connection(self.path).execute(
+            "SELECT value FROM cache WHERE namespace = ? AND key = ? AND expires_at > ?",
+            (self.namespace, key, time.time()),
+        ).fetchone()
+        if row is None:
+            CACHE_LOOKUPS.inc(cache=self.namespace, result="miss")
+            return None
+        value = json.loads(row[0])
+        self._l1_set(key, value)
+        CACHE_LOOKUPS.inc(cache=self.namespace, result="l2")
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        if not self.enabled or value is None:
+            return
+        conn = _connection(self.path)
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            (self.namespace, key, json.dumps(value, ensure_ascii=False), now + self.ttl),
+        )
+        if random.random() < _PURGE_PROBABILITY:
+            conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+        self._l1_set(key, value)
+
+    def delete(self, key: str) -> None:
+        with self._l1_lock:
+            self._l1.pop(key, None)
+        if self.enabled:
+            _connection(self.path).execute(
+                "DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key)
+            )
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any]) -> Any:
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.set(key, value)
+        return value
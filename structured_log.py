@@ -0,0 +1,179 @@
+# structured_log.py
+"""
+Strukturiertes JSON-Logging über einen Queue-Handler (kein blockierendes
+stdout-I/O im Request-Pfad), mit Request-ID auf jeder Zeile, Sampling und
+Redaction von Payload-Feldern.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import atexit
+import hashlib
+import logging
+import logging.handlers
+from contextvars import ContextVar
+
+# -----------------------------
+# Konfiguration (ENV)
+# -----------------------------
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Anteil der Requests, deren Payload-Logs geschrieben werden (0.0 - 1.0)
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+# Felder, deren Inhalt nie im Klartext geloggt wird (nur Länge + Hash)
+LOG_REDACT_FIELDS = {
+    f.strip()
+    for f in os.getenv(
+        "LOG_REDACT_FIELDS",
+        "ocr_text,email_text,personen,anlass,adresse,signature_path,bew_data",
+    ).split(",")
+    if f.strip()
+}
+# Tenants, für die volle Payloads geloggt werden (Debug-Modus), z.B. "enpal,default"
+LOG_DEBUG_TENANTS = {t.strip().lower() for t in os.getenv("LOG_DEBUG_TENANTS", "").split(",") if t.strip()}
+
+LOGGER_NAME = "bewirtung"
+
+# -----------------------------
+# Request-Kontext
+# -----------------------------
+_request_id: ContextVar[str] = ContextVar("request_id", default="-")
+_tenant: ContextVar[str] = ContextVar("tenant", default="-")
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def set_request_id(request_id: str | None) -> str:
+    request_id = (request_id or "").strip()[:64] or new_request_id()
+    _request_id.set(request_id)
+    return request_id
+
+
+def get_request_id() -> str:
+    return _request_id.get()
+
+
+def set_tenant(tenant_key: str | None) -> None:
+    _tenant.set((tenant_key or "-").strip().lower())
+
+
+def get_tenant_key() -> str:
+    return _tenant.get()
+
+
+class _ContextFilter(logging.Filter):
+    # läuft im aufrufenden Thread/Task -> ContextVars sind noch gesetzt
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get()
+        record.tenant = _tenant.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "tenant": getattr(record, "tenant", "-"),
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# -----------------------------
+# Setup (QueueHandler -> Listener-Thread -> stdout)
+# -----------------------------
+_listener: logging.handlers.QueueListener | None = None
+
+
+def setup_logging() -> logging.Logger:
+    """Idempotent. Alle Logger unter 'bewirtung' schreiben asynchron als JSON nach stdout."""
+    global _listener
+    logger = logging.getLogger(LOGGER_NAME)
+    if _listener is not None:
+        return logger
+
+    q: queue.Queue = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(q)
+    queue_handler.addFilter(_ContextFilter())
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter())
+
+    _listener = logging.handlers.QueueListener(q, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    logger.handlers[:] = [queue_handler]
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    return logger
+
+
+def get_logger(name: str = "") -> logging.Logger:
+    return logging.getLogger(f"{LOGGER_NAME}.{name}" if name else LOGGER_NAME)
+
+
+# -----------------------------
+# Sampling + Redaction
+# -----------------------------
+def is_debug_tenant(tenant_key: str | None = None) -> bool:
+    return (tenant_key or _tenant.get()).lower() in LOG_DEBUG_TENANTS
+
+
+def payload_sampled(request_id: str | None = None) -> bool:
+    """Deterministisch pro Request: entweder alle Payload-Logs eines Requests oder keine."""
+    if is_debug_tenant():
+        return True
+    if LOG_SAMPLE_RATE >= 1.0:
+        return True
+    if LOG_SAMPLE_RATE <= 0.0:
+        return False
+    rid = request_id or _request_id.get()
+    bucket = int(hashlib.sha1(rid.encode()).hexdigest()[:8], 16) / 0xFFFFFFFF
+    return bucket < LOG_SAMPLE_RATE
+
+
+def redact(payload: dict) -> dict:
+    """Ersetzt sensible Felder durch Länge + Hash-Präfix (außer im Debug-Modus des Tenants)."""
+    if is_debug_tenant():
+        return payload
+    out = {}
+    for key, value in payload.items():
+        if key in LOG_REDACT_FIELDS and value not in (None, "", [], {}):
+            raw = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+            out[key] = {"redacted": True, "len": len(raw), "sha256": hashlib.sha256(raw.encode()).hexdigest()[:12]}
+        else:
+            out[key] = value
+    return out
+
+
+def log_event(
+    logger: logging.Logger,
+    event: str,
+    level: int = logging.INFO,
+    payload: dict | None = None,
+    exc_info: bool = False,
+    **fields,
+) -> None:
+    """
+    Eine strukturierte Log-Zeile. `fields` werden immer geloggt,
+    `payload` nur für gesampelte Requests und redacted.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    extra = dict(fields)
+    if payload and (level >= logging.WARNING or payload_sampled()):
+        extra.update(redact(payload))
+    logger.log(level, event, exc_info=exc_info, extra={"fields": extra})
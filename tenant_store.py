@@ -1,8 +1,14 @@
 import os
 import psycopg
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict, replace
 from typing import Optional
 
+from shared_cache import SharedCache
+
+# Tenant-Daten werden über alle Worker geteilt gecacht (0 = jedes Mal aus der DB)
+TENANT_CACHE_TTL = float(os.getenv("TENANT_CACHE_TTL", "300"))
+_tenant_cache = SharedCache("tenant", ttl=TENANT_CACHE_TTL, l1_ttl=30)
+
 @dataclass
 class Tenant:
     tenant_key: str
@@ -18,9 +24,36 @@ def _db_url() -> str:
         raise RuntimeError("TENANT_DATABASE_URL is not set")
     return url
 
+# absoluter Hard-Fallback falls DB leer/kaputt (wird nicht gecacht)
+_FALLBACK_TENANT = Tenant(
+    tenant_key="default",
+    display_name="Default Tenant",
+    default_city="Berlin",
+    signature_png_b64=None,
+    reply_from_email=None,
+    template_key="default",
+)
+
 def get_tenant(tenant_key: str) -> Tenant:
     tenant_key = (tenant_key or "default").strip().lower()
+    tenant = _cached_tenant(tenant_key)
+    # Fallback: nimm default, wenn tenant nicht existiert
+    if tenant is None and tenant_key != "default":
+        tenant = _cached_tenant("default")
+    return tenant or replace(_FALLBACK_TENANT)
+
+def _cached_tenant(tenant_key: str) -> Optional[Tenant]:
+    # nur echte Zeilen unter ihrem eigenen Key cachen: ein unbekannter Key darf nicht den
+    # Default-Tenant abbekommen (und ein später angelegter Tenant nicht TTL lang verdeckt sein)
+    cached = _tenant_cache.get(tenant_key)
+    if cached is not None:
+        return Tenant(**cached)
+    tenant = _load_tenant(tenant_key)
+    if tenant is not None:
+        _tenant_cache.set(tenant_key, asdict(tenant))
+    return tenant
 
+def _load_tenant(tenant_key: str) -> Optional[Tenant]:
     with psycopg.connect(_db_url()) as conn:
         with conn.cursor() as cur:
             cur.execute(
@@ -33,19 +66,4 @@ def get_tenant(tenant_key: str) -> Tenant:
             )
             row = cur.fetchone()
 
-    # Fallback: nimm default, wenn tenant nicht existiert
-    if not row and tenant_key != "default":
-        return get_tenant("default")
-
-    if not row:
-        # absoluter Hard-Fallback falls DB leer/kaputt
-        return Tenant(
-            tenant_key="default",
-            display_name="Default Tenant",
-            default_city="Berlin",
-            signature_png_b64=None,
-            reply_from_email=None,
-            template_key="default",
-        )
-
-    return Tenant(*row)
+    return Tenant(*row) if row else None
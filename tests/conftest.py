@@ -0,0 +1,9 @@
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# Module mit Gemini-Konfiguration beim Import; echte Calls werden in den Tests ersetzt
+os.environ.setdefault("GEMINI_API_KEY", "test")
@@ -0,0 +1,97 @@
+import csv
+import io
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi.testclient import TestClient
+
+import beleg_archive
+import service
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(beleg_archive, "ARCHIVE_DIR", tmp_path / "archive")
+    monkeypatch.setattr(service, "TENANT_API_TOKENS", {"acme": "acme-token", "other": "other-token"})
+    return TestClient(service.app)
+
+
+def _archive(tmp_path, tenant: str, datum: str, betrag: str, content: bytes) -> beleg_archive.ArchivedBeleg:
+    pdf = tmp_path / "beleg.pdf"
+    pdf.write_bytes(b"%PDF-1.4\n" + content)
+    bew_data = {"bewirtungsdatum": datum, "restaurant": "Da Mario", "betrag": betrag, "personen": ["Anna"]}
+    return beleg_archive.archive_beleg(str(pdf), bew_data, tenant, f"{content.decode()}.pdf")
+
+
+ACME = {"X-Tenant-Token": "acme-token"}
+
+
+def test_archive_requires_tenant_token(client, tmp_path):
+    beleg = _archive(tmp_path, "acme", "14.03.2025", "31,50 EUR", b"a")
+    urls = [
+        "/archive/acme/belege",
+        f"/archive/acme/belege/{beleg.beleg_id}",
+        f"/archive/acme/belege/{beleg.beleg_id}/pdf",
+        "/archive/acme/export/2025-03",
+    ]
+    for url in urls:
+        assert client.get(url).status_code == 403
+        assert client.get(url, headers={"X-Tenant-Token": "other-token"}).status_code == 403
+        assert client.get(url, headers=ACME).status_code == 200
+    # fremdes Token ist auch über den eigenen Tenant-Pfad nicht auf fremde Belege anwendbar
+    assert client.get(f"/archive/other/belege/{beleg.beleg_id}", headers={"X-Tenant-Token": "other-token"}).status_code == 404
+
+
+def test_amount_filter_reads_thousands_separator(client, tmp_path):
+    _archive(tmp_path, "acme", "14.03.2025", "31,50 EUR", b"small")
+    _archive(tmp_path, "acme", "15.03.2025", "1.250,00 EUR", b"large")
+
+    def names(**params):
+        r = client.get("/archive/acme/belege", params=params, headers=ACME)
+        assert r.status_code == 200, r.text
+        return sorted(b["filename"] for b in r.json())
+
+    assert names(min_betrag="1.000") == ["large.pdf"]
+    assert names(min_betrag="1.000,00") == ["large.pdf"]
+    assert names(min_betrag="1000.5") == ["large.pdf"]
+    assert names(max_betrag="31,50") == ["small.pdf"]
+    assert client.get("/archive/acme/belege", params={"min_betrag": "1,000"}, headers=ACME).status_code == 400
+
+
+def test_month_export_lists_every_pdf_once(client, tmp_path):
+    for i in range(3):
+        _archive(tmp_path, "acme", f"0{i + 1}.03.2025", "10,00 EUR", f"m{i}".encode())
+    _archive(tmp_path, "acme", "01.04.2025", "10,00 EUR", b"april")
+
+    r = client.get("/archive/acme/export/2025-03", headers=ACME)
+    assert r.status_code == 200
+    zf = zipfile.ZipFile(io.BytesIO(r.content))
+    assert zf.testzip() is None
+    rows = list(csv.reader(io.StringIO(zf.read("belege.csv").decode("cp1252")), delimiter=";"))
+    pdfs = sorted(n for n in zf.namelist() if n.endswith(".pdf"))
+
+    assert rows[0] == beleg_archive.DATEV_COLUMNS
+    assert sorted(row[7] for row in rows[1:]) == pdfs
+    assert len(pdfs) == 3
+
+
+def test_month_export_can_be_consumed_across_threads(client, tmp_path, monkeypatch):
+    # StreamingResponse holt die Chunks eines sync-Generators aus wechselnden Threads
+    monkeypatch.setattr(beleg_archive, "ARCHIVE_CHUNK_BYTES", 4)
+    for i in range(3):
+        _archive(tmp_path, "acme", f"0{i + 1}.03.2025", "10,00 EUR", f"thread{i}".encode())
+
+    chunks = beleg_archive.export_month_zip("acme", "2025-03")
+    with ThreadPoolExecutor(max_workers=1) as a, ThreadPoolExecutor(max_workers=1) as b:
+        out, i = [], 0
+        while True:
+            chunk = (a if i % 2 else b).submit(next, chunks, None).result()
+            if chunk is None:
+                break
+            out.append(chunk)
+            i += 1
+
+    zf = zipfile.ZipFile(io.BytesIO(b"".join(out)))
+    assert zf.testzip() is None
+    assert len([n for n in zf.namelist() if n.endswith(".pdf")]) == 3
@@ -0,0 +1,69 @@
+import os
+import time
+
+import pytest
+
+import conversion_sandbox
+import structured_log
+from conversion_sandbox import ConversionSandbox, ConversionTimeout
+
+pytestmark = pytest.mark.skipif(not os.path.isdir("/proc"), reason="needs /proc")
+
+
+def _live_members(pgid: int) -> list[int]:
+    """PIDs der Gruppe, die noch laufen (Zombies zählen nicht: PID 1 reapt im Container evtl. nicht)."""
+    out = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[2]) == pgid and fields[0] != "Z":
+            out.append(int(name))
+    return out
+
+
+def _wait_gone(pgid: int, timeout: float = 3.0) -> list[int]:
+    deadline = time.monotonic() + timeout
+    while (members := _live_members(pgid)) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return members
+
+
+def test_hanging_converter_group_is_killed(tmp_path):
+    pidfile = tmp_path / "pid"
+    # Kind im Hintergrund, Starter ignoriert SIGTERM (wie ein hängendes soffice)
+    script = f'echo $$ > {pidfile}; sleep 1000 & trap "" TERM; sleep 1000'
+    sandbox = ConversionSandbox(timeout=0.5, kill_grace=0.3, profile_root=tmp_path / "profiles")
+    kills = conversion_sandbox.CONVERSION_KILLS.get(reason="timeout", signal="SIGKILL")
+
+    with pytest.raises(ConversionTimeout):
+        sandbox.run(["sh", "-c", script])
+
+    pgid = int(pidfile.read_text())
+    assert _wait_gone(pgid) == []
+    assert conversion_sandbox.CONVERSION_KILLS.get(reason="timeout", signal="SIGKILL") == kills + 1
+
+
+def test_cpu_limit_of_child_process_is_counted(tmp_path):
+    # das Limit trifft das Kind (wie soffice.bin), der Starter endet mit eigenem Code
+    sandbox = ConversionSandbox(timeout=20, cpu_seconds=1, memory_mb=0, profile_root=tmp_path / "profiles")
+    hits = conversion_sandbox.CONVERSION_LIMITS.get(limit="cpu")
+
+    result = sandbox.run(["sh", "-c", "sh -c 'while :; do :; done'; exit 3"])
+
+    assert result.returncode == 3
+    assert conversion_sandbox.CONVERSION_LIMITS.get(limit="cpu") == hits + 1
+
+
+def test_limits_are_applied_without_preexec_fn(tmp_path):
+    sandbox = ConversionSandbox(timeout=5, cpu_seconds=7, memory_mb=512, profile_root=tmp_path / "profiles")
+    result = sandbox.run(["sh", "-c", "ulimit -S -t; ulimit -H -t; ulimit -v; ulimit -c"])
+    assert result.stdout.split() == ["7", "12", str(512 * 1024), "0"]
+
+
+def test_events_use_the_structured_logger():
+    assert conversion_sandbox.log.name == f"{structured_log.LOGGER_NAME}.conversion"
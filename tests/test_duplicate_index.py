@@ -0,0 +1,132 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import duplicate_index
+from pipeline_graph import Stage, StageTimeout, run_graph
+
+SHA = "ab" * 32
+
+
+@pytest.fixture(autouse=True)
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(duplicate_index, "DUPLICATE_DB_PATH", tmp_path / "duplicates.sqlite3")
+    monkeypatch.setattr(duplicate_index, "_tenants", {})
+
+
+def test_concurrent_identical_uploads_are_caught():
+    # beide Uploads prüfen, bevor einer registriert ist
+    assert duplicate_index.find_duplicates("acme", SHA, None, claim="a", request_id="req-a") == []
+    hits = duplicate_index.find_duplicates("acme", SHA, None, claim="b", request_id="req-b")
+    assert [(h.kind, h.request_id) for h in hits] == [("exact", "req-a")]
+    # anderer Tenant: eigene Reservierung
+    assert duplicate_index.find_duplicates("other", SHA, None, claim="c") == []
+
+
+def test_claims_race_between_threads():
+    barrier = threading.Barrier(8)
+    results = []
+
+    def upload(i):
+        barrier.wait()
+        results.append(duplicate_index.find_duplicates("acme", SHA, None, claim=f"c{i}", request_id=f"req-{i}"))
+
+    threads = [threading.Thread(target=upload, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sum(1 for hits in results if not hits) == 1
+
+
+def test_register_replaces_claim_and_release_frees_it():
+    duplicate_index.find_duplicates("acme", SHA, None, claim="a", request_id="req-a")
+    duplicate_index.register_receipt("acme", SHA, None, None, beleg_id="B1", request_id="req-a", claim="a")
+    hits = duplicate_index.find_duplicates("acme", SHA, None, claim="b")
+    assert [(h.kind, h.beleg_id) for h in hits] == [("exact", "B1")]
+
+    # fehlgeschlagener Upload: Reservierung freigeben, die Datei ist kein Duplikat
+    other = "cd" * 32
+    duplicate_index.find_duplicates("acme", other, None, claim="x")
+    duplicate_index.release_claim("acme", other, "x")
+    assert duplicate_index.find_duplicates("acme", other, None, claim="y") == []
+
+
+def test_known_file_is_not_reserved():
+    duplicate_index.register_receipt("acme", SHA, None, None, beleg_id="B1")
+    hits = duplicate_index.find_duplicates("acme", SHA, None, claim="a")
+    assert [h.beleg_id for h in hits] == ["B1"]
+    # reine Lesesuche: keine Schreibsperre, keine Reservierung
+    assert duplicate_index._connection().execute("SELECT COUNT(*) FROM receipt_claims").fetchone() == (0,)
+
+
+def test_orphaned_claim_expires(monkeypatch):
+    duplicate_index.find_duplicates("acme", SHA, None, claim="a")
+    monkeypatch.setattr(duplicate_index, "DUPLICATE_CLAIM_TTL", 0)
+    assert duplicate_index.find_duplicates("acme", SHA, None, claim="b") == []
+
+
+def _flip(h: int, bits) -> int:
+    for b in bits:
+        h ^= 1 << b
+    return h
+
+
+BASE = 0x0123_4567_89AB_CDEF
+
+
+def test_hamming_index_threshold():
+    index = duplicate_index.HammingIndex()
+    # Bänder à 16 Bit: Abweichungen über mehrere Bänder verteilt, ein Band bleibt (fast) gleich
+    index.add(BASE, "same")
+    index.add(_flip(BASE, [0, 17, 40]), "d3")
+    index.add(_flip(BASE, [1, 2, 18, 19, 33, 34]), "d6")     # 2/2/2/0 Bits pro Band
+    index.add(_flip(BASE, [3, 4, 20, 21, 35, 36, 50]), "d7")  # über dem Schwellwert
+    index.add(~BASE & (2**64 - 1), "far")
+
+    found = index.search(BASE, 6)
+    assert [(d, item) for d, item in found] == [(0, "same"), (3, "d3"), (6, "d6")]
+    assert [item for _, item in index.search(BASE, 7)][-1] == "d7"
+
+
+def test_hamming_index_pigeonhole_finds_spread_differences():
+    # 6 Bits in 4 Bändern verteilt (2/2/1/1): mindestens ein Band weicht um <= 1 Bit ab
+    index = duplicate_index.HammingIndex()
+    index.add(_flip(BASE, [5, 6, 22, 23, 37, 55]), "spread")
+    assert [(d, item) for d, item in index.search(BASE, 6)] == [(6, "spread")]
+    assert index.search(BASE, 5) == []
+
+
+def test_near_duplicate_within_threshold(monkeypatch):
+    monkeypatch.setattr(duplicate_index, "DUPLICATE_PHASH_DISTANCE", 6)
+    duplicate_index.register_receipt("acme", SHA, BASE, None, beleg_id="B1")
+
+    near = duplicate_index.find_duplicates("acme", "cd" * 32, _flip(BASE, [0, 20, 40, 60]))
+    assert [(h.kind, h.beleg_id, h.distance) for h in near] == [("near", "B1", 4)]
+    assert duplicate_index.find_duplicates("acme", "ef" * 32, _flip(BASE, range(0, 64, 9))) == []
+
+
+def test_optional_stage_timeout_is_skipped():
+    skipped = []
+
+    def slow():
+        time.sleep(0.3)
+        return "hits"
+
+    def skip(exc):
+        skipped.append(exc)
+        return None
+
+    stages = [
+        Stage("duplicate", slow, timeout=0.05, on_error=skip),
+        Stage("ocr", lambda: "text"),
+    ]
+    graph = asyncio.run(run_graph(stages))
+    assert graph.results == {"duplicate": None, "ocr": "text"}
+    assert isinstance(skipped[0], StageTimeout)
+
+    # ohne on_error bricht der Lauf weiterhin ab
+    with pytest.raises(StageTimeout):
+        asyncio.run(run_graph([Stage("duplicate", slow, timeout=0.05)]))
@@ -0,0 +1,90 @@
+import json
+from pathlib import Path
+
+import pytest
+
+import extract_agent_gemini
+import fast_extract
+from fast_extract_eval import evaluate, field_matches
+
+FIXTURES = Path(__file__).parent / "fixtures" / "fast_extract"
+
+
+def _case(name: str) -> tuple[str, str]:
+    case = FIXTURES / name
+    return (case / "ocr.txt").read_text(encoding="utf-8"), (case / "email.txt").read_text(encoding="utf-8")
+
+
+LLM_RESULT = {
+    "bewirtungsdatum": "01.01.2025",
+    "unterschriftsdatum": "01.01.2025",
+    "ort": "",
+    "restaurant": "LLM Restaurant",
+    "adresse": "LLM Adresse",
+    "anlass": "LLM Anlass",
+    "personen": ["LLM Person"],
+    "betrag": "1,00 EUR",
+}
+
+
+@pytest.fixture
+def fake_gemini(monkeypatch):
+    calls = []
+
+    def fake(receipt_text, email_text=None, tenant_key="default"):
+        calls.append(tenant_key)
+        return dict(LLM_RESULT)
+
+    monkeypatch.setattr(extract_agent_gemini, "extract_bewirtungsdaten_gemini", fake)
+    monkeypatch.setattr(fast_extract, "FAST_EXTRACT_MODE", "auto")
+    return calls
+
+
+def test_corpus_precision():
+    report, failures, ok = evaluate(FIXTURES, threshold=0.8, min_precision=0.95)
+    assert ok, failures
+    assert not failures
+    assert report["cases"] == len([p for p in FIXTURES.iterdir() if p.is_dir()])
+    # sichere Treffer nur dort, wo alles eindeutig ist – und dann vollständig korrekt
+    assert report["fast_path_hits"] == report["fast_path_hits_fully_correct"] == 2
+
+
+def test_hit_skips_gemini(fake_gemini):
+    ocr, email = _case("pizzeria_bar")
+    data = fast_extract.extract_bewirtungsdaten(ocr, email, tenant_key="acme")
+
+    assert fake_gemini == []
+    expected = json.loads((FIXTURES / "pizzeria_bar" / "expected_extract.json").read_text(encoding="utf-8"))
+    for field, value in expected.items():
+        assert data[field] == value
+    assert data["ort"] == ""
+
+
+@pytest.mark.parametrize("case, from_llm", [
+    ("cafe_zwei_daten", {"bewirtungsdatum", "betrag"}),
+    ("steakhaus_posten_groesser", {"betrag"}),
+    ("trattoria_iso_datum", {"personen"}),
+    ("hotel_ohne_strasse", {"restaurant", "adresse", "anlass", "personen"}),
+])
+def test_miss_falls_back_to_gemini(fake_gemini, case, from_llm):
+    ocr, email = _case(case)
+    data = fast_extract.extract_bewirtungsdaten(ocr, email, tenant_key="acme")
+
+    assert fake_gemini == ["acme"]
+    expected = json.loads((FIXTURES / case / "expected_extract.json").read_text(encoding="utf-8"))
+    for field in fast_extract.REQUIRED_FIELDS:
+        if field in from_llm:
+            # unsicher -> Wert vom LLM
+            assert data[field] == LLM_RESULT[field]
+        else:
+            # sichere lokale Felder gewinnen
+            assert field_matches(field, expected[field], data[field])
+
+
+def test_mode_off_always_calls_gemini(fake_gemini, monkeypatch):
+    monkeypatch.setattr(fast_extract, "FAST_EXTRACT_MODE", "off")
+    ocr, email = _case("pizzeria_bar")
+    data = fast_extract.extract_bewirtungsdaten(ocr, email)
+
+    assert fake_gemini == ["default"]
+    assert data["restaurant"] == "LLM Restaurant"
@@ -0,0 +1,230 @@
+import contextvars
+import threading
+import time
+
+import pytest
+
+import pipeline_graph
+from llm_scheduler import LLMScheduler, ManualClock, QueueFull, QueueTimeout, RateLimited, begin_request
+
+
+def _until(predicate, timeout=2.0):
+    end = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < end, "condition not reached"
+        time.sleep(0.005)
+
+
+class FakeModel:
+    """Modell-Callable pro Call: protokolliert die Reihenfolge, optional blockierend."""
+
+    def __init__(self):
+        self.calls: list[str] = []
+        self.lock = threading.Lock()
+
+    def __call__(self, name: str, gate: threading.Event | None = None):
+        def fn():
+            with self.lock:
+                self.calls.append(name)
+            if gate is not None:
+                gate.wait(5)
+            return name
+        return fn
+
+
+def _background(scheduler: LLMScheduler, fn, tenant: str, ctx: contextvars.Context | None = None, **kwargs) -> dict:
+    out: dict = {}
+
+    def run():
+        try:
+            out["result"] = scheduler.call(fn, tenant_key=tenant, **kwargs)
+        except Exception as exc:
+            out["error"] = exc
+
+    # Threads erben den Kontext nicht: ctx (z.B. mit begin_request) explizit mitgeben
+    out["thread"] = threading.Thread(target=ctx.run if ctx else run, args=(run,) if ctx else (), daemon=True)
+    out["thread"].start()
+    return out
+
+
+def _scheduler(clock, **kwargs) -> LLMScheduler:
+    defaults = dict(rpm=6000, tpm=10_000_000, max_concurrency=1, weights={}, batch_threshold=100,
+                    rate_limit_retries=3, max_wait=30, max_queued_per_tenant=0, clock=clock)
+    return LLMScheduler(**{**defaults, **kwargs})
+
+
+def _block(scheduler, model) -> tuple[threading.Event, dict]:
+    gate = threading.Event()
+    job = _background(scheduler, model("blocker", gate), "blocker")
+    _until(lambda: scheduler.inflight == 1)
+    return gate, job
+
+
+def test_other_tenant_overtakes_bulk_backlog():
+    clock = ManualClock()
+    scheduler = _scheduler(clock)
+    model = FakeModel()
+    gate, blocker = _block(scheduler, model)
+
+    jobs = []
+    for i in range(4):
+        jobs.append(_background(scheduler, model(f"bulk{i}"), "bulk", est_tokens=100))
+        _until(lambda: scheduler.queue_depth() == i + 1)
+    jobs.append(_background(scheduler, model("small"), "small", est_tokens=100))
+    _until(lambda: scheduler.queue_depth() == 5)
+
+    gate.set()
+    for job in [blocker, *jobs]:
+        job["thread"].join(2)
+    assert model.calls[:3] == ["blocker", "bulk0", "small"]
+    assert all("error" not in job for job in jobs)
+
+
+def test_rate_limit_waits_for_clock():
+    clock = ManualClock()
+    scheduler = _scheduler(clock, rpm=1, max_concurrency=4, max_wait=None)
+    model = FakeModel()
+
+    assert scheduler.call(model("first"), tenant_key="a") == "first"
+    second = _background(scheduler, model("second"), "a")
+    _until(lambda: scheduler.queue_depth() == 1)
+
+    clock.advance(30)
+    time.sleep(0.05)
+    assert model.calls == ["first"]
+
+    clock.advance(30)
+    second["thread"].join(2)
+    assert second["result"] == "second"
+
+
+def test_wait_deadline_leaves_queue_without_running():
+    clock = ManualClock()
+    scheduler = _scheduler(clock, max_wait=5)
+    model = FakeModel()
+    gate, blocker = _block(scheduler, model)
+
+    waiting = _background(scheduler, model("late"), "a", est_tokens=100)
+    _until(lambda: scheduler.queue_depth() == 1)
+    clock.advance(5)
+    waiting["thread"].join(2)
+    gate.set()
+    blocker["thread"].join(2)
+
+    assert isinstance(waiting["error"], QueueTimeout)
+    assert model.calls == ["blocker"]
+    assert scheduler.queue_depth() == 0
+    assert scheduler._open == {}
+
+
+def test_cancelled_stage_leaves_queue():
+    clock = ManualClock()
+    scheduler = _scheduler(clock)
+    model = FakeModel()
+    gate, blocker = _block(scheduler, model)
+
+    cancel = threading.Event()
+    out: dict = {}
+
+    def stage():
+        # wie ein Stage-Thread aus run_graph: Abbruch-Signal als ContextVar
+        pipeline_graph._deadline.set(pipeline_graph._Deadline(None, cancel))
+        try:
+            scheduler.call(model("after-504"), tenant_key="a")
+        except Exception as exc:
+            out["error"] = exc
+
+    thread = threading.Thread(target=stage, daemon=True)
+    thread.start()
+    _until(lambda: scheduler.queue_depth() == 1)
+    cancel.set()
+    clock.advance(0)
+    thread.join(2)
+    gate.set()
+    blocker["thread"].join(2)
+
+    assert isinstance(out["error"], QueueTimeout)
+    assert model.calls == ["blocker"]
+
+
+def test_queue_full_per_tenant():
+    clock = ManualClock()
+    scheduler = _scheduler(clock, max_queued_per_tenant=2)
+    model = FakeModel()
+    gate, blocker = _block(scheduler, model)
+
+    jobs = [_background(scheduler, model(f"bulk{i}"), "bulk") for i in range(2)]
+    _until(lambda: scheduler.queue_depth() == 2)
+    with pytest.raises(QueueFull):
+        scheduler.call(model("bulk2"), tenant_key="bulk")
+    # andere Tenants kommen weiter in die Queue
+    other = _background(scheduler, model("other"), "other")
+    _until(lambda: scheduler.queue_depth() == 3)
+
+    gate.set()
+    for job in [blocker, *jobs, other]:
+        job["thread"].join(2)
+    assert sorted(model.calls) == ["blocker", "bulk0", "bulk1", "other"]
+
+
+def _request_pages(scheduler, model, tenant: str, name: str, pages: int) -> list[dict]:
+    """Ein Request, der wie ein mehrseitiges PDF mehrere Calls gleichzeitig einreiht."""
+    ctx = contextvars.copy_context()
+    ctx.run(begin_request)
+    return [_background(scheduler, model(f"{name}-p{i}"), tenant, ctx=ctx.copy()) for i in range(pages)]
+
+
+def test_queue_cap_counts_requests_not_calls():
+    clock = ManualClock()
+    scheduler = _scheduler(clock, max_queued_per_tenant=2)
+    model = FakeModel()
+    gate, blocker = _block(scheduler, model)
+
+    # zwei mehrseitige PDFs desselben Tenants: 8 wartende Calls, aber nur 2 Requests
+    jobs = _request_pages(scheduler, model, "bulk", "a", 4)
+    _until(lambda: scheduler.queue_depth() == 4)
+    jobs += _request_pages(scheduler, model, "bulk", "b", 4)
+    _until(lambda: scheduler.queue_depth() == 8)
+    # ein dritter Request des Tenants bekommt 429
+    third = _request_pages(scheduler, model, "bulk", "c", 1)
+    third[0]["thread"].join(2)
+    assert isinstance(third[0]["error"], QueueFull)
+
+    gate.set()
+    for job in [blocker, *jobs]:
+        job["thread"].join(2)
+    assert all("error" not in job for job in jobs)
+    assert len(model.calls) == 9
+
+
+def test_rate_limit_error_is_retried_after_backoff():
+    clock = ManualClock()
+    scheduler = _scheduler(clock)
+    attempts = []
+
+    def flaky():
+        attempts.append(clock.monotonic())
+        if len(attempts) == 1:
+            raise RateLimited()
+        return "ok"
+
+    job = _background(scheduler, flaky, "a")
+    _until(lambda: scheduler.queue_depth() == 1)
+    assert len(attempts) == 1
+    clock.advance(3)
+    job["thread"].join(2)
+
+    assert job["result"] == "ok"
+    assert attempts == [0.0, 3.0]
+
+
+def test_idle_tenants_are_forgotten():
+    clock = ManualClock()
+    scheduler = _scheduler(clock, max_concurrency=4)
+    model = FakeModel()
+
+    for i in range(50):
+        scheduler.call(model(f"t{i}"), tenant_key=f"tenant-{i}", est_tokens=100)
+
+    assert scheduler._open == {}
+    assert scheduler._last_finish == {}
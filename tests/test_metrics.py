@@ -0,0 +1,107 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import metrics
+
+REQUESTS = metrics.Counter("test_requests_total", "test", ["path"])
+INFLIGHT = metrics.Gauge("test_inflight", "test")
+LATENCY = metrics.Histogram("test_latency_seconds", "test", buckets=(0.1, 1.0))
+
+
+@pytest.fixture
+def multiproc(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_MULTIPROC_DIR", str(tmp_path))
+    monkeypatch.setattr(metrics, "_retired", False)
+    return tmp_path
+
+
+def _dead_pid() -> int:
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    return proc.pid
+
+
+def _other_worker(directory, pid: int, requests: float, inflight: float, started: int | None = None):
+    started = metrics._start_time(pid) if started is None else started
+    path = directory / f"{pid}-{started or 0}.json"
+    path.write_text(json.dumps({
+        "test_requests_total": {"values": [[["/full-agent"], requests]]},
+        "test_inflight": {"values": [[[], inflight]]},
+        "test_latency_seconds": {"hist": [[[], [[1, 2], 2, 0.6]]]},
+    }))
+    return path
+
+
+def _value(text: str, series: str) -> float:
+    return float(next(l.rsplit(" ", 1)[1] for l in text.splitlines() if l.startswith(series + " ")))
+
+
+def test_render_sums_worker_files(multiproc):
+    REQUESTS.inc(path="/full-agent")
+    INFLIGHT.set(1)
+    LATENCY.observe(0.05)
+    metrics.flush()
+    assert metrics._own_file(multiproc).exists()
+
+    _other_worker(multiproc, os.getppid(), requests=4, inflight=2)
+    _other_worker(multiproc, _dead_pid(), requests=10, inflight=7)
+
+    text = metrics.render()
+    own = REQUESTS.get(path="/full-agent")
+    # Counter auch von beendeten Workern, Gauges nur von laufenden
+    assert _value(text, 'test_requests_total{path="/full-agent"}') == own + 14
+    assert _value(text, "test_inflight") == 3
+    assert _value(text, 'test_latency_seconds_bucket{le="0.1"}') == 3
+    assert _value(text, 'test_latency_seconds_bucket{le="+Inf"}') == 5
+    assert dict(((tuple(l.values()), v) for l, v in REQUESTS.items()))[("/full-agent",)] == own + 14
+
+
+def test_dead_worker_is_folded_into_aggregate(multiproc):
+    own = REQUESTS.get(path="/full-agent")
+    dead = _other_worker(multiproc, _dead_pid(), requests=10, inflight=7)
+    metrics.flush()
+
+    assert not dead.exists()
+    assert (multiproc / "aggregate.json").exists()
+    text = metrics.render()
+    assert _value(text, 'test_requests_total{path="/full-agent"}') == own + 10
+    assert _value(text, "test_inflight") == INFLIGHT.get()
+    # nochmal flush: nichts doppelt übernommen
+    metrics.flush()
+    assert _value(metrics.render(), 'test_requests_total{path="/full-agent"}') == own + 10
+
+
+def test_reused_pid_does_not_count_as_live(multiproc):
+    # Datei eines früheren Prozesses mit derselben PID wie ein laufender, aber anderer Startzeit
+    parent = os.getppid()
+    stale = _other_worker(multiproc, parent, requests=5, inflight=9, started=metrics._start_time(parent) + 1)
+    text = metrics.render()
+    assert _value(text, "test_inflight") == INFLIGHT.get()
+    metrics.flush()
+    assert not stale.exists()
+
+
+def test_stop_folds_own_file(multiproc, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_FLUSH_INTERVAL", 3600)
+    REQUESTS.inc(path="/full-agent")
+    own = REQUESTS.get(path="/full-agent")
+    metrics.start_flusher()
+    metrics.stop_flusher()
+
+    assert list(multiproc.glob("*-*.json")) == []
+    aggregate = metrics._read(multiproc / "aggregate.json")
+    assert aggregate["test_requests_total"]["values"][("/full-agent",)] == own
+    assert "test_inflight" not in aggregate
+    # kein doppeltes Zählen nach dem Übernehmen
+    assert _value(metrics.render(), 'test_requests_total{path="/full-agent"}') == own
+
+
+def test_single_process_without_dir(monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_MULTIPROC_DIR", "")
+    before = REQUESTS.get(path="/x")
+    REQUESTS.inc(path="/x")
+    assert f'test_requests_total{{path="/x"}} {before + 1:g}' in metrics.render()
@@ -0,0 +1,87 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import beleg_archive
+import reconciliation
+import service
+
+ACME = {"X-Tenant-Token": "acme-token"}
+
+CSV = (
+    "Kontoauszug DKB;;\n"
+    "\n"
+    "Buchungstag;Verwendungszweck;Betrag (EUR)\n"
+    "15.03.2025;PIZZERIA DA MARIO BERLIN;-31,50\n"
+    "16.03.2025;Gehalt;2.500,00\n"
+    "20.03.2025;Café Übersee;-1.012,00\n"
+).encode("cp1252")
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(beleg_archive, "ARCHIVE_DIR", tmp_path / "archive")
+    monkeypatch.setattr(reconciliation, "RECON_DB_PATH", tmp_path / "transactions.sqlite3")
+    monkeypatch.setattr(service, "TENANT_API_TOKENS", {"acme": "acme-token"})
+    return TestClient(service.app)
+
+
+def _archive(tmp_path, datum: str, betrag: str) -> None:
+    pdf = tmp_path / "beleg.pdf"
+    pdf.write_bytes(b"%PDF-1.4\n" + betrag.encode())
+    beleg_archive.archive_beleg(str(pdf), {"bewirtungsdatum": datum, "betrag": betrag}, "acme", "beleg.pdf")
+
+
+def _upload(client, content: bytes, headers=ACME):
+    return client.post(
+        "/reconciliation/acme/transactions", files={"file": ("umsaetze.csv", content, "text/csv")}, headers=headers
+    )
+
+
+def test_endpoints_require_tenant_token(client):
+    assert _upload(client, CSV, headers={}).status_code == 403
+    assert client.get("/reconciliation/acme", params={"month": "2025-03"}).status_code == 403
+    assert client.post("/reconciliation/acme", params={"month": "2025-03"}).status_code == 403
+
+
+def test_import_streams_csv_and_is_idempotent(client):
+    first = _upload(client, CSV)
+    assert first.status_code == 200, first.text
+    assert first.json() == {"imported": 2, "duplicates": 0}
+    assert _upload(client, CSV).json() == {"imported": 0, "duplicates": 2}
+
+    assert _upload(client, b"%PDF-1.4 kein csv").status_code == 415
+    assert _upload(client, b"").status_code == 400
+
+
+def _status_rows() -> list:
+    with reconciliation._connect() as conn:
+        return conn.execute("SELECT beleg_id, status FROM beleg_status").fetchall()
+
+
+def test_report_get_is_read_only(client, tmp_path):
+    _archive(tmp_path, "14.03.2025", "31,50 EUR")
+    unmatched = reconciliation.RECON_RESULTS.get(result="unmatched")
+    for _ in range(3):
+        r = client.get("/reconciliation/acme", params={"month": "2025-03"}, headers=ACME)
+        assert r.json()["summary"] == {"matched": 0, "ambiguous": 0, "unmatched": 1}
+    assert _status_rows() == []
+    assert reconciliation.RECON_RESULTS.get(result="unmatched") == unmatched
+
+
+def test_metric_counts_status_changes_not_requests(client, tmp_path):
+    _archive(tmp_path, "14.03.2025", "31,50 EUR")
+    _archive(tmp_path, "19.03.2025", "1.012,00 EUR")
+    matched = reconciliation.RECON_RESULTS.get(result="matched")
+    unmatched = reconciliation.RECON_RESULTS.get(result="unmatched")
+
+    for _ in range(3):
+        report = client.post("/reconciliation/acme", params={"month": "2025-03"}, headers=ACME).json()
+        assert report["summary"] == {"matched": 0, "ambiguous": 0, "unmatched": 2}
+    assert reconciliation.RECON_RESULTS.get(result="unmatched") == unmatched + 2
+
+    _upload(client, CSV)
+    for _ in range(3):
+        report = client.post("/reconciliation/acme", params={"month": "2025-03"}, headers=ACME).json()
+        assert report["summary"] == {"matched": 2, "ambiguous": 0, "unmatched": 0}
+    assert reconciliation.RECON_RESULTS.get(result="matched") == matched + 2
+    assert sorted(status for _, status in _status_rows()) == ["matched", "matched"]
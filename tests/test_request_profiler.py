@@ -0,0 +1,89 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import request_profiler
+import service
+from pipeline_graph import Stage
+
+ADMIN = {"X-Admin-Token": "admin-token"}
+
+
+@pytest.fixture(autouse=True)
+def profiler(tmp_path, monkeypatch):
+    monkeypatch.setattr(request_profiler, "PROFILE_ADMIN_TOKEN", "admin-token")
+    monkeypatch.setattr(request_profiler, "PROFILE_TENANTS", {"acme"})
+    monkeypatch.setattr(request_profiler, "PROFILE_DIR", tmp_path / "profiles")
+
+
+def _profile(tenant: str = "acme") -> dict:
+    profile = request_profiler.start_profile(tenant, "header", request_id="req-1")
+    stage = profile.wrap_stages([Stage("work", lambda: sum(i * i for i in range(10_000)))])[0]
+    stage.fn()
+    return profile.finish()
+
+
+def test_trigger_needs_admin_token_or_listed_tenant():
+    trigger = request_profiler.profile_trigger
+    assert trigger({"x-profile": "1", "x-admin-token": "admin-token"}, "other") == "header"
+    assert trigger({"x-profile": "1"}, "other") is None
+    assert trigger({"x-profile": "1", "x-admin-token": "wrong"}, "other") is None
+    assert trigger({}, "ACME") == "tenant"
+    assert trigger({}, "other") is None
+
+
+def test_trigger_is_off_without_configured_admin_token(monkeypatch):
+    monkeypatch.setattr(request_profiler, "PROFILE_ADMIN_TOKEN", "")
+    assert request_profiler.profile_trigger({"x-profile": "1", "x-admin-token": ""}, "other") is None
+
+
+def test_only_one_profile_at_a_time():
+    first = request_profiler.start_profile("acme", "tenant")
+    skipped = request_profiler.PROFILES_SKIPPED.get()
+    try:
+        assert request_profiler.start_profile("acme", "tenant") is None
+        assert request_profiler.PROFILES_SKIPPED.get() == skipped + 1
+    finally:
+        first.finish()
+    second = request_profiler.start_profile("acme", "tenant")
+    assert second is not None
+    second.finish()
+
+
+def test_finish_writes_summary_and_stats(tmp_path):
+    summary = _profile()
+    pid = summary["profile_id"]
+    assert summary["tenant"] == "acme" and summary["request_id"] == "req-1"
+    assert "work" in summary["stage_seconds"]
+    assert summary["tracemalloc_peak_bytes"] > 0
+    assert json.loads((tmp_path / "profiles" / f"{pid}.json").read_text())["profile_id"] == pid
+    assert (tmp_path / "profiles" / f"{pid}.prof").exists()
+
+
+def test_old_profiles_are_pruned(tmp_path, monkeypatch):
+    monkeypatch.setattr(request_profiler, "PROFILE_MAX_FILES", 2)
+    ids = []
+    for _ in range(3):
+        ids.append(_profile()["profile_id"])
+        # mtime-Auflösung: Reihenfolge eindeutig machen
+        path = tmp_path / "profiles" / f"{ids[-1]}.json"
+        path.touch()
+    kept = sorted(p.stem for p in (tmp_path / "profiles").glob("*.json"))
+    assert ids[0] not in kept and len(kept) == 2
+    assert not (tmp_path / "profiles" / f"{ids[0]}.prof").exists()
+
+
+def test_admin_endpoints_need_admin_token():
+    pid = _profile()["profile_id"]
+    client = TestClient(service.app)
+    urls = ["/admin/profiles", f"/admin/profiles/{pid}", f"/admin/profiles/{pid}/prof"]
+    for url in urls:
+        assert client.get(url).status_code == 403
+        assert client.get(url, headers={"X-Admin-Token": "wrong"}).status_code == 403
+        assert client.get(url, headers=ADMIN).status_code == 200
+
+    assert [p["profile_id"] for p in client.get("/admin/profiles", headers=ADMIN).json()] == [pid]
+    assert client.get(f"/admin/profiles/{pid}", headers=ADMIN).json()["tenant"] == "acme"
+    assert client.get("/admin/profiles/missing", headers=ADMIN).status_code == 404
+    assert client.get("/admin/profiles/..%2Fsecret", headers=ADMIN).status_code == 404
@@ -0,0 +1,57 @@
+import stat
+
+import pytest
+
+import shared_cache
+import tenant_store
+from tenant_store import Tenant
+
+
+def _tenant(key: str) -> Tenant:
+    return Tenant(key, key.title(), "Köln", "c2lnbmF0dXJl", None, "default")
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    rows = {"default": _tenant("default"), "acme": _tenant("acme")}
+    loads = []
+
+    def load(key):
+        loads.append(key)
+        return rows.get(key)
+
+    monkeypatch.setattr(tenant_store, "_load_tenant", load)
+    monkeypatch.setattr(tenant_store, "_tenant_cache", shared_cache.SharedCache(
+        "tenant", ttl=300, l1_ttl=30, path=tmp_path / "state" / "cache.sqlite3"
+    ))
+    return rows, loads
+
+
+def test_unknown_key_falls_back_without_caching_it(db):
+    rows, loads = db
+    assert tenant_store.get_tenant("newco").tenant_key == "default"
+    # Tenant wird angelegt: sofort sichtbar, nicht vom gecachten Default verdeckt
+    rows["newco"] = _tenant("newco")
+    assert tenant_store.get_tenant("newco").tenant_key == "newco"
+    assert loads == ["newco", "default", "newco"]
+
+
+def test_real_rows_are_cached(db):
+    _, loads = db
+    assert tenant_store.get_tenant("ACME ").tenant_key == "acme"
+    assert tenant_store.get_tenant("acme").tenant_key == "acme"
+    assert loads == ["acme"]
+
+
+def test_hard_fallback_when_db_is_empty(db):
+    rows, _ = db
+    rows.clear()
+    assert tenant_store.get_tenant("acme") == tenant_store._FALLBACK_TENANT
+    assert tenant_store.get_tenant("acme") is not tenant_store._FALLBACK_TENANT
+
+
+def test_cache_file_is_private(db, tmp_path):
+    tenant_store.get_tenant("acme")
+    path = tmp_path / "state" / "cache.sqlite3"
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
+    assert stat.S_IMODE(path.parent.stat().st_mode) == 0o700
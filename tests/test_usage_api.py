@@ -0,0 +1,33 @@
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+import llm_usage
+import request_profiler
+import service
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(request_profiler, "PROFILE_ADMIN_TOKEN", "admin-token")
+    monkeypatch.setattr(service, "TENANT_API_TOKENS", {"usagetest": "usage-token"})
+    usage = SimpleNamespace(prompt_token_count=120, candidates_token_count=30)
+    llm_usage.record_usage(SimpleNamespace(usage_metadata=usage), "usagetest", stage="ocr", kind="jpg")
+    return TestClient(service.app)
+
+
+def test_usage_of_all_tenants_needs_admin_token(client):
+    assert client.get("/usage").status_code == 403
+    assert client.get("/usage", headers={"X-Tenant-Token": "usage-token"}).status_code == 403
+    r = client.get("/usage", headers={"X-Admin-Token": "admin-token"})
+    assert r.status_code == 200
+    assert r.json()["usagetest"]["ocr"]["input_tokens"] >= 120
+
+
+def test_tenant_usage_needs_tenant_token(client):
+    assert client.get("/usage/usagetest").status_code == 403
+    assert client.get("/usage/usagetest", headers={"X-Tenant-Token": "wrong"}).status_code == 403
+    r = client.get("/usage/UsageTest", headers={"X-Tenant-Token": "usage-token"})
+    assert r.status_code == 200
+    assert r.json()["ocr"]["calls"] >= 1
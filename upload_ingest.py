@@ -0,0 +1,261 @@
+# upload_ingest.py
+import os
+import shutil
+import hashlib
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Optional
+
+from fastapi import HTTPException, UploadFile
+from starlette.responses import JSONResponse
+
+
+# -----------------------------
+# Konfiguration (ENV)
+# -----------------------------
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(25 * 1024 * 1024)))
+# bis zu dieser Größe bleibt der Upload im Speicher, darüber -> Temp-Datei
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", str(1024 * 1024)))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(64 * 1024)))
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR", "/tmp/input")
+# Spielraum für die übrigen Formularfelder (email_text, ...) und Multipart-Rahmen
+UPLOAD_FORM_OVERHEAD_BYTES = int(os.getenv("UPLOAD_FORM_OVERHEAD_BYTES", str(1024 * 1024)))
+
+# Wie viele Bytes wir für die Typ-Erkennung anschauen
+_SNIFF_BYTES = 1024
+
+
+# -----------------------------
+# Magic-Byte-Erkennung
+# -----------------------------
+def sniff_kind(head: bytes) -> Optional[tuple[str, str]]:
+    """
+    Erkennt den echten Dateityp anhand der ersten Bytes.
+    Returns (kind, suffix), e.g. ("pdf", ".pdf"), or None if unsupported.
+    """
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg", ".jpg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png", ".png"
+    # PDF-Header darf laut Spec innerhalb der ersten 1024 Bytes stehen
+    if b"%PDF-" in head[:_SNIFF_BYTES]:
+        return "pdf", ".pdf"
+    return None
+
+
+def sniff_csv(head: bytes) -> Optional[tuple[str, str]]:
+    """Text-Export (CSV): keine NUL-Bytes und kein bekanntes Binärformat am Anfang."""
+    if not head or b"\x00" in head or sniff_kind(head) is not None:
+        return None
+    return "csv", ".csv"
+
+
+# -----------------------------
+# Ergebnis der Ingestion
+# -----------------------------
+@dataclass
+class IngestedUpload:
+    sha256: str
+    size: int
+    kind: str
+    suffix: str
+    filename: str
+    peak_buffered_bytes: int
+    workdir: Path
+    _buffer: Optional[bytearray] = field(default=None, repr=False)
+    _path: Optional[Path] = field(default=None, repr=False)
+
+    @property
+    def in_memory(self) -> bool:
+        return self._buffer is not None
+
+    def path(self) -> str:
+        """
+        Gibt einen Dateipfad mit passender Endung zurück (z.B. für ocr_bon / PdfReader).
+        Kleine Uploads werden dafür erst bei Bedarf auf Platte geschrieben.
+        """
+        if self._path is None:
+            target = self.workdir / f"receipt{self.suffix}"
+            target.write_bytes(self._buffer or b"")
+            self._path = target
+        return str(self._path)
+
+    def read_bytes(self) -> bytes:
+        if self._buffer is not None:
+            return bytes(self._buffer)
+        return Path(self.path()).read_bytes()
+
+    def save_to(self, dest: str | Path) -> str:
+        dest = Path(dest)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        if self._buffer is not None:
+            dest.write_bytes(self._buffer)
+        else:
+            shutil.copyfile(self.path(), dest)
+        return str(dest)
+
+    def close(self) -> None:
+        self._buffer = None
+        self._path = None
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+# -----------------------------
+# Body-Limit vor dem Einlesen
+# -----------------------------
+class BodySizeLimitMiddleware:
+    """
+    ASGI-Middleware: begrenzt den Request-Body, bevor Starlette ihn für Form/File
+    einliest und spoolt. Eine zu große Content-Length wird abgelehnt, ohne ein Byte
+    zu lesen; bei chunked Uploads bricht receive() ab, sobald das Limit überschritten ist.
+    """
+
+    def __init__(self, app, max_bytes: int | None = None):
+        self.app = app
+        self.max_bytes = UPLOAD_MAX_BYTES + UPLOAD_FORM_OVERHEAD_BYTES if max_bytes is None else max_bytes
+
+    def _too_large(self) -> HTTPException:
+        return HTTPException(status_code=413, detail=f"Request body too large (max {self.max_bytes} bytes)")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        declared = dict(scope["headers"]).get(b"content-length", b"")
+        if declared.isdigit() and int(declared) > self.max_bytes:
+            err = self._too_large()
+            await JSONResponse({"detail": err.detail}, status_code=err.status_code)(scope, receive, send)
+            return
+
+        received = 0
+        started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # im Endpoint (Form-Parsing) wird daraus über die Exception-Handler ein 413
+                    raise self._too_large()
+            return message
+
+        async def tracked_send(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracked_send)
+        except HTTPException as e:
+            # außerhalb eines Endpoints gelesen (z.B. Middleware): selbst antworten
+            if e.status_code != 413 or started:
+                raise
+            await JSONResponse({"detail": e.detail}, status_code=413)(scope, receive, send)
+
+
+# -----------------------------
+# Streaming-Ingestion
+# -----------------------------
+async def ingest_upload(
+    upload: UploadFile,
+    max_bytes: int | None = None,
+    spool_bytes: int | None = None,
+    chunk_bytes: int | None = None,
+    sniff: Callable[[bytes], Optional[tuple[str, str]]] = sniff_kind,
+    what: str = "receipt",
+) -> IngestedUpload:
+    """
+    Liest einen Upload in Chunks, hasht dabei (SHA-256), erzwingt eine Maximalgröße
+    pro Datei (HTTP 413) und erkennt den Typ per Magic Bytes (`sniff`, default: Bon-Formate;
+    `what` steht in den Fehlermeldungen).
+
+    Starlette hat den Multipart-Body zu diesem Zeitpunkt schon eingelesen; den
+    Request als Ganzes begrenzt BodySizeLimitMiddleware, bevor er gelesen wird.
+
+    Kleine Dateien bleiben im Speicher, große werden in eine Temp-Datei in einem
+    eigenen Verzeichnis geschrieben. Aufrufer müssen close() aufrufen.
+    """
+    max_bytes = UPLOAD_MAX_BYTES if max_bytes is None else max_bytes
+    spool_bytes = UPLOAD_SPOOL_BYTES if spool_bytes is None else spool_bytes
+    chunk_bytes = UPLOAD_CHUNK_BYTES if chunk_bytes is None else chunk_bytes
+
+    # Größe ist nach dem Form-Parsing meist schon bekannt
+    declared = getattr(upload, "size", None)
+    if declared is not None and declared > max_bytes:
+        raise HTTPException(status_code=413, detail=f"{what.capitalize()} too large (max {max_bytes} bytes)")
+
+    Path(UPLOAD_TMP_DIR).mkdir(parents=True, exist_ok=True)
+    workdir = Path(tempfile.mkdtemp(prefix="upload-", dir=UPLOAD_TMP_DIR))
+
+    hasher = hashlib.sha256()
+    buffer: Optional[bytearray] = bytearray()
+    spill = None
+    spill_path = workdir / "receipt.part"
+    head = b""
+    size = 0
+    peak = 0
+
+    try:
+        while True:
+            chunk = await upload.read(chunk_bytes)
+            if not chunk:
+                break
+
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail=f"{what.capitalize()} too large (max {max_bytes} bytes)")
+
+            hasher.update(chunk)
+            if len(head) < _SNIFF_BYTES:
+                head += chunk[: _SNIFF_BYTES - len(head)]
+
+            if spill is None and size > spool_bytes:
+                spill = open(spill_path, "wb")
+                spill.write(buffer)
+                buffer = None
+
+            if spill is not None:
+                spill.write(chunk)
+                peak = max(peak, len(chunk))
+            else:
+                buffer.extend(chunk)
+                peak = max(peak, len(buffer))
+
+        if spill is not None:
+            spill.close()
+            spill = None
+
+        if size == 0:
+            raise HTTPException(status_code=400, detail=f"Uploaded {what} is empty")
+
+        sniffed = sniff(head)
+        if sniffed is None:
+            expected = "PDF, JPG or PNG" if sniff is sniff_kind else "text"
+            raise HTTPException(status_code=415, detail=f"Unsupported {what} type (expected {expected})")
+        kind, suffix = sniffed
+
+        path = None
+        if buffer is None:
+            path = workdir / f"receipt{suffix}"
+            spill_path.replace(path)
+
+        return IngestedUpload(
+            sha256=hasher.hexdigest(),
+            size=size,
+            kind=kind,
+            suffix=suffix,
+            filename=os.path.basename(upload.filename or "receipt"),
+            peak_buffered_bytes=peak,
+            workdir=workdir,
+            _buffer=buffer,
+            _path=path,
+        )
+    except BaseException:
+        if spill is not None:
+            spill.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise